@@ -1 +1,35 @@
 __version__ = "0.2.4"
+
+import importlib
+import sys
+
+# converters are only imported on first access, so that `import nekton` does
+# not pay for SimpleITK, nibabel etc. when only a single converter is needed
+_LAZY_CONVERTERS = {
+    "Dcm2Nii": ".dcm2nii",
+    "DcmSeg2Nii": ".dcmseg2nii",
+    "Nii2DcmSeg": ".nii2dcm",
+    "Nii2Gsps": ".nii2gsps",
+}
+
+__all__ = ["__version__"] + list(_LAZY_CONVERTERS)
+
+
+def __getattr__(name: str):
+    if name in _LAZY_CONVERTERS:
+        module = importlib.import_module(_LAZY_CONVERTERS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_CONVERTERS))
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ (PEP 562) needs python 3.7, the converters are imported
+    # eagerly instead; their heavy dependencies are still loaded on first use
+    from .dcm2nii import Dcm2Nii  # noqa: F401
+    from .dcmseg2nii import DcmSeg2Nii  # noqa: F401
+    from .nii2dcm import Nii2DcmSeg  # noqa: F401
+    from .nii2gsps import Nii2Gsps  # noqa: F401
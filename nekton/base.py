@@ -1,21 +1,65 @@
-from .utils.json_helpers import write_json
+from .utils.dicom import DicomHeaderCache, deduplicate_dicoms, read_header
+from .utils.geometry import SliceGeometry
+from .utils.instrumentation import Instrumentation
+from .utils.json_helpers import write_json, verify_label_dcmqii_json
+from .utils.lazy import lazy_import
+import logging
 import os
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
+
+np = lazy_import("numpy")
+pydicom = lazy_import("pydicom")
+pydicom_seg = lazy_import("pydicom_seg")
+
+logger = logging.getLogger(__name__)
 
 
 class BaseConverter:
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        instrumentation: Instrumentation = None,
+        header_cache: DicomHeaderCache = None,
+        deduplicate: str = None,
+    ):
+        """Common state of the converters
+
+        Args:
+            instrumentation (Instrumentation, optional): collects the timing spans and
+             counters of the conversion phases, pass one with hooks to observe them.
+             Defaults to a new one without hooks.
+            header_cache (DicomHeaderCache, optional): cache of the parsed source dicom
+             headers, shared by all the conversions of the converter. Defaults to
+             reading the headers again for every conversion.
+            deduplicate (str, optional): drop repeated copies of a source dicom, "uid"
+             by SOPInstanceUID, "content" only byte-identical copies; the dropped
+             dicoms of the last conversion are in `duplicates`. Defaults to None.
+
+        Raises:
+            ValueError: for an unknown deduplication
+        """
+        if deduplicate not in (None, "uid", "content"):
+            raise ValueError(f"Unknown deduplication '{deduplicate}'")
+        self.instrumentation = instrumentation or Instrumentation()
+        self.header_cache = header_cache
+        self.deduplicate = deduplicate
+        self.duplicates: Dict[Path, Path] = {}
 
     @staticmethod
-    def write_dict_json(directory: Path, data_dict: dict, name: str) -> Path:
+    def write_dict_json(
+        directory: Path, data_dict: dict, name: str, indent: int = 4
+    ) -> Path:
         """write a dictionary type to json file
 
         Args:
             directory (Path): directory where the json has to be stored
             data_dict (dict): dictionary to be made json
             name (Path): name of the json file
+            indent (int, optional): indentation of the json, None writes it
+             compactly. Defaults to 4.
 
         Returns:
             Path: the path of the stored json
@@ -23,7 +67,7 @@ class BaseConverter:
         if ".json" not in name:
             name += ".json"
         output_filepath = Path(os.path.join(directory, name))
-        write_json(data_dict, output_filepath)
+        write_json(data_dict, output_filepath, indent)
         return output_filepath
 
     @staticmethod
@@ -35,3 +79,132 @@ class BaseConverter:
             raise NameError("Folder has Multiple Series; Cannot handle it yet!!")
 
         return sorted_nii_list
+
+    @staticmethod
+    def _load_segmap(segmentation_map: Path) -> "Dataset":
+        """Read the segmentation mapping from the dcmqii standard json
+
+        Args:
+            segmentation_map (Path): Path to the json file
+
+        Returns:
+            Dataset: dataset information extracted from the json
+        """
+        assert os.path.exists(segmentation_map), "Seg mapping `.json` missing"
+
+        assert verify_label_dcmqii_json(
+            segmentation_map
+        ), "Seg mapping `.json` not confirming to DCIM-QII standard, "
+
+        return pydicom_seg.template.from_dcmqi_metainfo(str(segmentation_map))
+
+    @staticmethod
+    def _check_all_lables(seg_map: "Dataset", segImage: "np.ndarray"):
+        """Check the integrity of the labels in the segmentation and the mapping provided
+            in the json
+
+        Args:
+            seg_map (Dataset): mapping extracted from the corresponding json
+            segImage (np.ndarray): 3d nifti segmentation
+
+        Raises:
+            ValueError: the segmentation is not found in the json
+        """
+        total_unique_segs = [
+            seg for seg in list(np.unique(np.uint8(segImage))) if seg != 0
+        ]
+
+        assert len(seg_map.SegmentSequence) >= len(
+            total_unique_segs
+        ), "Not all the segmentation have a mapping in the json"
+        # check all individual labels exist
+        max_length_seq = len(seg_map.SegmentSequence)
+        all_seq = [
+            seg_map.SegmentSequence[i].SegmentNumber for i in range(max_length_seq)
+        ]
+        for seg in total_unique_segs:
+            found = seg in all_seq
+            if not found:
+                raise ValueError(
+                    f"No Segmentation mapping found for label {seg} in json"
+                )
+
+    def _read_dicom_headers(self, dcmfiles: List[Path]) -> List["Dataset"]:
+        """Read the headers of the source dicoms without their pixel data, through
+            the header cache if the converter has one
+
+        Args:
+            dcmfiles (List[Path]): list of path to original dicom files
+
+        Returns:
+            List[Dataset]: header of every dicom in the same order, shared with the
+             cache and not to be modified
+        """
+        # only the bytes of the headers are counted, the pixel data is not read
+        cache = self.header_cache
+        if cache is None:
+            headers, sizes = [], 0
+            for path in dcmfiles:
+                header, size = read_header(path)
+                headers.append(header)
+                sizes += size
+            self.instrumentation.count("bytes_read", sizes)
+            return headers
+
+        hits, misses, bytes_read = cache.hits, cache.misses, cache.bytes_read
+        headers = [cache.read(path) for path in dcmfiles]
+        self.instrumentation.count("bytes_read", cache.bytes_read - bytes_read)
+        self.instrumentation.count("header_cache_hits", cache.hits - hits)
+        self.instrumentation.count("header_cache_misses", cache.misses - misses)
+        return headers
+
+    @staticmethod
+    def _slice_geometry(
+        affine: "np.ndarray", n_slices: int, dcm_headers: List["Dataset"]
+    ) -> SliceGeometry:
+        """Match the slices of a segmentation to the source dicoms. Falls back
+            to the instance number order if the geometries cannot be matched.
+
+        Args:
+            affine (np.ndarray): affine of the nifti segmentation
+            n_slices (int): number of slices in the segmentation
+            dcm_headers (List[Dataset]): headers of the source dicoms
+
+        Returns:
+            SliceGeometry: mapping of the nifti slices to the dicoms
+        """
+        try:
+            return SliceGeometry.from_affine(affine, n_slices, dcm_headers)
+        except ValueError as err:
+            logger.warning(f"{err}; matching slices by InstanceNumber instead")
+        return SliceGeometry(
+            sorted(range(len(dcm_headers)), key=lambda i: dcm_headers[i].InstanceNumber)
+        )
+
+    def _deduplicate_dicoms(
+        self, dcmfiles: List[Path], headers: List["Dataset"]
+    ) -> Tuple[List[Path], List["Dataset"]]:
+        """Drop the repeated source dicoms if the converter deduplicates, and report
+            them in `duplicates`, the `duplicates_dropped` counter and the log
+
+        Args:
+            dcmfiles (List[Path]): list of path to original dicom files
+            headers (List[Dataset]): header of every dicom in the same order
+
+        Returns:
+            Tuple[List[Path], List[Dataset]]: the unique dicoms and their headers
+        """
+        if self.deduplicate is None:
+            self.duplicates = {}
+            return list(dcmfiles), list(headers)
+
+        with self.instrumentation.span("deduplicate"):
+            dcmfiles, headers, self.duplicates = deduplicate_dicoms(
+                dcmfiles, headers, content_hash=self.deduplicate == "content"
+            )
+        self.instrumentation.count("duplicates_dropped", len(self.duplicates))
+        for path, kept in self.duplicates.items():
+            logger.info(f"Dropped {path}, a copy of {kept}")
+        if self.duplicates:
+            logger.warning(f"Dropped {len(self.duplicates)} duplicate dicoms")
+        return dcmfiles, headers
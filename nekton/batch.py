@@ -0,0 +1,366 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+from .utils.instrumentation import Instrumentation
+from .utils.sidecar import SidecarManager
+
+logger = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+RUNNING = "running"
+
+
+class BatchItem(NamedTuple):
+    """A single conversion of a batch
+
+    Attributes:
+        id (str): unique name of the item in the manifest, e.g. the study uid
+        inputs (dict): keyword arguments of the task, e.g. `dicom_directory`
+    """
+
+    id: str
+    inputs: dict
+
+
+# receives a finished item, its outputs and the error message or None
+ItemCallback = Callable[[BatchItem, Sequence[Path], Optional[str]], None]
+# runs the pending items of a round, e.g. in parallel, and calls back for every item
+Executor = Callable[[List[BatchItem], ItemCallback], None]
+
+
+def _input_paths(value) -> List[str]:
+    """all existing files and directories among the values of the inputs"""
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _input_paths(item)]
+    if isinstance(value, dict):
+        return [path for item in value.values() for path in _input_paths(item)]
+    if isinstance(value, (str, Path)) and os.path.exists(value):
+        return [str(value)]
+    return []
+
+
+def retry_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """seconds before a retry, doubled for every further retry up to the limit
+
+    Args:
+        attempt (int): number of the retry, starting at 1
+        backoff (float): seconds before the first retry
+        max_backoff (float): upper limit of the wait
+
+    Returns:
+        float: seconds to wait
+    """
+    return min(backoff * 2 ** (attempt - 1), max_backoff)
+
+
+def fingerprint(
+    inputs: dict, output_keys: Sequence[str] = (), outputs: Sequence[Path] = ()
+) -> str:
+    """Fingerprint of the inputs of an item from the paths, sizes and modification
+        times of all input files, directories are walked. Files are not read, so
+        the fingerprint stays cheap for large studies.
+
+    Args:
+        inputs (dict): keyword arguments of the task
+        output_keys (Sequence[str], optional): inputs that are output locations,
+         their files are not part of the fingerprint. Defaults to none.
+        outputs (Sequence[Path], optional): outputs of the item, ignored together
+         with their json sidecars when they are inside an input directory.
+         Defaults to none.
+
+    Returns:
+        str: hex digest that changes when an input file is added, removed or modified
+    """
+    ignored = set()
+    for output in outputs:
+        ignored.add(os.path.abspath(output))
+        ignored.add(os.path.abspath(SidecarManager.sidecar_path(output)))
+
+    sources = {key: value for key, value in inputs.items() if key not in output_keys}
+    files = []
+    for path in _input_paths(sources):
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+
+    digest = hashlib.sha1(
+        json.dumps({key: str(value) for key, value in sorted(inputs.items())}).encode()
+    )
+    for path in sorted(set(files)):
+        if os.path.abspath(path) in ignored:
+            continue
+        stat = os.stat(path)
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class Manifest:
+    def __init__(self, path: Path = None):
+        """Append-only JSON lines record of the items of a batch. Every change of
+            an item appends a line and the last line of an item is its state, so a
+            crash loses at most the line being written.
+
+        Args:
+            path (Path, optional): path of the manifest, created on the first record.
+             Defaults to keeping the records in memory only.
+        """
+        self.path = Path(path) if path is not None else None
+        self.records: Dict[str, dict] = {}
+        if self.path is not None and self.path.exists():
+            with open(self.path) as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut off by a crash
+                        logger.warning(f"Skipping corrupt manifest line in {self.path}")
+                        continue
+                    self.records[record["id"]] = record
+
+    def record(self, item_id: str, **fields) -> dict:
+        """update the state of an item and append it to the manifest
+
+        Args:
+            item_id (str): id of the item
+            **fields: fields of the record that changed, e.g. `status`
+
+        Returns:
+            dict: the complete record of the item
+        """
+        record = dict(self.records.get(item_id, {}), id=item_id, **fields)
+        record["timestamp"] = time.time()
+        self.records[item_id] = record
+        if self.path is None:
+            return record
+        with open(self.path, "a") as outfile:
+            outfile.write(json.dumps(record, default=str) + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        return record
+
+    def is_complete(self, item: BatchItem, output_keys: Sequence[str] = ()) -> bool:
+        """True if the item was converted from unchanged inputs and all outputs exist
+
+        Args:
+            item (BatchItem): the item
+            output_keys (Sequence[str], optional): inputs that are output locations.
+             Defaults to none.
+        """
+        record = self.records.get(item.id)
+        if record is None or record.get("status") != DONE:
+            return False
+        outputs = record.get("outputs", [])
+        return all(os.path.exists(path) for path in outputs) and record.get(
+            "fingerprint"
+        ) == fingerprint(item.inputs, output_keys, outputs)
+
+    def compact(self):
+        """rewrite the manifest with only the last record of every item"""
+        if self.path is None:
+            return
+        partial = Path(f"{self.path}.{os.getpid()}.partial")
+        with open(partial, "w") as outfile:
+            for record in self.records.values():
+                outfile.write(json.dumps(record, default=str) + "\n")
+        os.replace(partial, self.path)
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        task: Callable[..., List[Path]],
+        manifest: Path,
+        retries: int = 2,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        output_keys: Sequence[str] = ("out_directory",),
+        instrumentation: Instrumentation = None,
+        executor: Executor = None,
+    ):
+        """Run a conversion for many items, e.g. `Dcm2Nii().run` for every study of
+            an archive, and record every item in a manifest. A restarted batch skips
+            the items whose inputs are unchanged since they were converted.
+
+        Args:
+            task (Callable[..., List[Path]]): conversion called with the inputs of an
+             item as keyword arguments, returning the output paths; None if an
+             `executor` runs the items
+            manifest (Path): path of the JSON lines manifest, None to keep the
+             records in memory only
+            retries (int, optional): retries of a failing item. Defaults to 2.
+            backoff (float, optional): seconds before the first retry, doubled for
+             every further retry. Defaults to 1.0.
+            max_backoff (float, optional): upper limit of the wait between retries.
+             Defaults to 60.0.
+            output_keys (Sequence[str], optional): inputs that are output locations,
+             they are not fingerprinted. Defaults to `out_directory` of `Dcm2Nii.run`.
+            instrumentation (Instrumentation, optional): collects a span per item and
+             the counters of the batch. Defaults to a new one.
+            executor (Executor, optional): runs all pending items of a round, e.g. in
+             parallel on a `ResourceScheduler`, the failed items are retried in the
+             next round. Defaults to running the task for one item after the other,
+             with its retries.
+        """
+        if task is None and executor is None:
+            raise ValueError("BatchRunner needs a task or an executor")
+        self.task = task
+        self.manifest = Manifest(manifest)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.output_keys = tuple(output_keys)
+        self.instrumentation = instrumentation or Instrumentation()
+        self.executor = executor
+
+    def _wait_before(self, attempt: int):
+        if attempt > 0:
+            time.sleep(retry_delay(attempt, self.backoff, self.max_backoff))
+
+    def _record_attempt(self, item: BatchItem, attempt: int):
+        self.manifest.record(
+            item.id, status=RUNNING, inputs=item.inputs, attempts=attempt + 1
+        )
+
+    def _record_done(
+        self, item: BatchItem, outputs: Sequence[Path], seconds: float = None
+    ) -> dict:
+        outputs = [str(path) for path in outputs or []]
+        fields = dict(
+            status=DONE,
+            outputs=outputs,
+            fingerprint=fingerprint(item.inputs, self.output_keys, outputs),
+            error=None,
+        )
+        if seconds is not None:
+            fields["seconds"] = round(seconds, 4)
+        return self.manifest.record(item.id, **fields)
+
+    def run_item(self, item: BatchItem) -> dict:
+        """convert a single item with retries and record the result. The fingerprint
+            is taken after the conversion, without the outputs of the item.
+
+        Args:
+            item (BatchItem): the item
+
+        Returns:
+            dict: the final record of the item
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            self._wait_before(attempt)
+            self._record_attempt(item, attempt)
+            start = time.perf_counter()
+            try:
+                with self.instrumentation.span("batch_item", item=item.id):
+                    outputs = self.task(**item.inputs)
+            except Exception as err:
+                error = f"{type(err).__name__}: {err}"
+                logger.warning(f"Item {item.id} failed on attempt {attempt + 1}: {error}")
+                continue
+            return self._record_done(item, outputs, time.perf_counter() - start)
+        return self.manifest.record(item.id, status=FAILED, error=error)
+
+    def _run_rounds(self, items: List[BatchItem]) -> Iterable[dict]:
+        """run the items with the executor, retrying the failed ones in rounds"""
+        errors: Dict[str, str] = {}
+        pending = items
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt > 0:
+                logger.info(f"Retrying {len(pending)} failed items")
+            self._wait_before(attempt)
+            for item in pending:
+                self._record_attempt(item, attempt)
+            results = []
+
+            def finished(item: BatchItem, outputs: Sequence[Path], error: str):
+                if error is None:
+                    errors.pop(item.id, None)
+                    results.append(self._record_done(item, outputs))
+                else:
+                    errors[item.id] = error
+                    logger.warning(
+                        f"Item {item.id} failed on attempt {attempt + 1}: {error}"
+                    )
+
+            self.executor(pending, finished)
+            done = set(record["id"] for record in results)
+            for item in pending:
+                if item.id not in done and item.id not in errors:
+                    errors[item.id] = "RuntimeError: the executor did not run the item"
+            yield from results
+            pending = [item for item in pending if item.id in errors]
+        for item in pending:
+            yield self.manifest.record(item.id, status=FAILED, error=errors[item.id])
+
+    def run(self, items: Iterable[BatchItem]) -> dict:
+        """Convert all items that are not complete in the manifest
+
+        Args:
+            items (Iterable[BatchItem]): the items of the batch, ids must be unique
+
+        Raises:
+            ValueError: duplicate item ids
+
+        Returns:
+            dict: number of `done`, `skipped` and `failed` items, the `failures` by id,
+             the status of every item by id in `items`, the total `seconds` and the
+             `items_per_second` of the converted items
+        """
+        items = list(items)
+        ids = [item.id for item in items]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Batch items must have unique ids")
+
+        summary = {"done": 0, "skipped": 0, "failed": 0, "failures": {}, "items": {}}
+        start = time.perf_counter()
+        pending = []
+        for item in items:
+            if self.manifest.is_complete(item, self.output_keys):
+                summary["skipped"] += 1
+                summary["items"][item.id] = "skipped"
+                self.instrumentation.count("items_skipped")
+            else:
+                pending.append(item)
+
+        if self.executor is None:
+            records = (self.run_item(item) for item in pending)
+        else:
+            records = self._run_rounds(pending)
+        for record in records:
+            summary["items"][record["id"]] = record["status"]
+            if record["status"] == DONE:
+                summary["done"] += 1
+                self.instrumentation.count("items_done")
+            else:
+                summary["failed"] += 1
+                summary["failures"][record["id"]] = record["error"]
+                self.instrumentation.count("items_failed")
+            position = summary["done"] + summary["failed"] + summary["skipped"]
+            self._log_progress(position, len(items), summary, time.perf_counter() - start)
+
+        summary["seconds"] = round(time.perf_counter() - start, 4)
+        converted = summary["done"] + summary["failed"]
+        summary["items_per_second"] = (
+            round(converted / summary["seconds"], 4) if summary["seconds"] > 0 else 0.0
+        )
+        return summary
+
+    @staticmethod
+    def _log_progress(position: int, total: int, summary: dict, seconds: float):
+        converted = summary["done"] + summary["failed"]
+        rate = converted / seconds if seconds > 0 else 0.0
+        remaining = (total - position) / rate if rate > 0 else float("nan")
+        logger.info(
+            f"[{position}/{total}] {summary['done']} done, {summary['skipped']} skipped, "
+            f"{summary['failed']} failed; {rate:.2f} items/s, ~{remaining:.0f}s left"
+        )
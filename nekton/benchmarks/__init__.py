@@ -0,0 +1,17 @@
+from .suite import (
+    compare_layouts,
+    compare_to_baseline,
+    load_baseline,
+    run_suite,
+    save_baseline,
+)
+from .synthetic import make_study
+
+__all__ = [
+    "compare_layouts",
+    "compare_to_baseline",
+    "load_baseline",
+    "make_study",
+    "run_suite",
+    "save_baseline",
+]
@@ -0,0 +1,84 @@
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from .suite import (
+    DEFAULT_BASELINE,
+    DEFAULT_SIZES,
+    compare_layouts,
+    compare_to_baseline,
+    load_baseline,
+    run_suite,
+    save_baseline,
+)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m nekton.benchmarks",
+        description="Benchmark the nekton converters on synthetic studies",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+        help="number of slices of the synthetic studies",
+    )
+    parser.add_argument("--matrix", type=int, default=128, help="rows and columns per slice")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, fastest is kept")
+    parser.add_argument("--select", default="", help="only run cases containing this string")
+    parser.add_argument("--work-dir", type=Path, help="keep the studies in this directory")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store this run as the baseline"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5,
+        help="allowed ratio of time and peak RSS to the baseline",
+    )
+    parser.add_argument("--output", type=Path, help="write the report as json")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="nekton-benchmark-"))
+    try:
+        report = run_suite(
+            work_dir, args.sizes, args.matrix, args.matrix, args.repeat, args.select
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'case':<55} {'seconds':>10} {'slices/s':>10} {'peak MB':>10}")
+    for name, result in report["results"].items():
+        print(
+            f"{name:<55} {result['seconds']:>10.3f} "
+            f"{result['slices_per_second']:>10.1f} {result['peak_rss_mb']:>10.1f}"
+        )
+    comparisons = compare_layouts(report)
+    if comparisons:
+        print()
+    for comparison in comparisons:
+        print(comparison)
+
+    if args.output is not None:
+        save_baseline(report, args.output)
+    if args.save_baseline:
+        save_baseline(report, args.baseline)
+        print(f"\nBaseline stored @ {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"\nNo baseline found @ {args.baseline}")
+        return 0
+    regressions = compare_to_baseline(report, load_baseline(args.baseline), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"\n{len(regressions)} regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
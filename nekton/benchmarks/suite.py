@@ -0,0 +1,364 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+from ..utils.json_helpers import read_json, write_json
+from .synthetic import make_study, write_label_map
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (100, 1000, 3000)
+SLAB_SIZE = 64
+DEFAULT_BASELINE = Path(os.path.join(os.path.dirname(__file__), "baseline.json"))
+
+
+class BenchmarkCase(NamedTuple):
+    operation: str
+    variant: str
+    n_slices: int
+    inputs: dict
+
+    @property
+    def name(self) -> str:
+        return f"{self.operation}[{self.variant}-{self.n_slices}]"
+
+
+def _get_all_dicoms(inputs: dict):
+    from ..dcm2nii import Dcm2Nii
+
+    Dcm2Nii.get_all_dicoms(inputs["dicom_dir"])
+
+
+def _check_slice_thickness_variable(inputs: dict):
+    from ..dcm2nii import Dcm2Nii
+
+    Dcm2Nii.check_slice_thickness_variable(inputs["dcmfiles"])
+
+
+def _dcm2nii_run(inputs: dict):
+    from ..dcm2nii import Dcm2Nii
+
+    os.makedirs(inputs["out_directory"], exist_ok=True)
+    converter = Dcm2Nii(engine=inputs.get("engine", "dcm2niix"))
+    converter.run(inputs["dicom_dir"], inputs["out_directory"])
+
+
+def _multiclass_converter(inputs: dict):
+    from ..nii2dcm import Nii2DcmSeg
+
+    Nii2DcmSeg().multiclass_converter(
+        inputs["segfile"],
+        inputs["mapping"],
+        inputs["dcmfiles"],
+        inputs.get("multiLayer", False),
+        inputs.get("slab_size"),
+        inputs.get("layouts"),
+    )
+
+
+def _find_contours(inputs: dict):
+    import nibabel as nib
+    import numpy as np
+
+    from ..utils.contours import find_contours
+
+    # label map in dicom layout (slices, rows, columns)
+    masks = np.asanyarray(nib.load(str(inputs["segfile"])).dataobj).T > 0
+    if inputs.get("noise"):
+        # flipped pixels add many small contours to the few large ones
+        masks ^= np.random.RandomState(0).rand(*masks.shape) < inputs["noise"]
+    find_contours(masks)
+
+
+_OPERATIONS: Dict[str, Callable[[dict], None]] = {
+    "get_all_dicoms": _get_all_dicoms,
+    "check_slice_thickness_variable": _check_slice_thickness_variable,
+    "Dcm2Nii.run": _dcm2nii_run,
+    "multiclass_converter": _multiclass_converter,
+    "find_contours": _find_contours,
+}
+# modules of every operation and the dependencies it imports on first use, they
+# are imported before the operation is timed
+_IMPORTS: Dict[str, Sequence[str]] = {
+    "get_all_dicoms": ["..dcm2nii", "pydicom"],
+    "check_slice_thickness_variable": ["..dcm2nii", "numpy", "pydicom"],
+    "Dcm2Nii.run": ["..dcm2nii", "numpy", "nibabel", "pydicom"],
+    "multiclass_converter": [
+        "..nii2dcm",
+        "jsonschema",
+        "numpy",
+        "nibabel",
+        "pydicom",
+        "pydicom_seg",
+    ],
+    "find_contours": ["..utils.contours", "numpy", "nibabel"],
+}
+
+
+def _peak_rss_mb() -> float:
+    """peak resident set size of this process and its finished children in MB"""
+    try:
+        import resource
+    except ImportError:  # not available on windows
+        return float("nan")
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_case(operation: str, inputs: dict) -> Tuple[float, float]:
+    for module in _IMPORTS[operation]:
+        importlib.import_module(module, __package__)
+    start = time.perf_counter()
+    _OPERATIONS[operation](inputs)
+    return time.perf_counter() - start, _peak_rss_mb()
+
+
+def generate_cases(
+    work_dir: Path, sizes: Sequence[int] = DEFAULT_SIZES, rows: int = 128, cols: int = 128
+) -> List[BenchmarkCase]:
+    """generate the synthetic studies and the benchmark cases running on them
+
+    Args:
+        work_dir (Path): directory where the studies and outputs are written
+        sizes (Sequence[int], optional): number of slices of the studies. Defaults
+         to DEFAULT_SIZES.
+        rows (int, optional): rows per slice. Defaults to 128.
+        cols (int, optional): columns per slice. Defaults to 128.
+
+    Returns:
+        List[BenchmarkCase]: all cases for all study sizes
+    """
+    cases = []
+    for n_slices in sizes:
+        logger.info(f"Generating synthetic studies with {n_slices} slices")
+        single = make_study(
+            Path(os.path.join(work_dir, f"single_{n_slices}")), n_slices, rows, cols
+        )
+        multi = make_study(
+            Path(os.path.join(work_dir, f"multi_{n_slices}")),
+            n_slices,
+            rows,
+            cols,
+            n_series=2,
+        )
+        segfiles = {
+            "dense": single["segfile"],
+            "sparse": write_label_map(
+                Path(os.path.join(work_dir, f"single_{n_slices}", "labels_sparse.nii.gz")),
+                single["dcmfiles"],
+                "sparse",
+            ),
+        }
+
+        for variant, study in [("single", single), ("multi", multi)]:
+            cases.append(BenchmarkCase("get_all_dicoms", variant, n_slices, study))
+        cases.append(
+            BenchmarkCase("check_slice_thickness_variable", "single", n_slices, single)
+        )
+        for variant, study in [("single", single), ("multi", multi)]:
+            out_directory = Path(os.path.join(work_dir, f"nifti_{variant}_{n_slices}"))
+            cases.append(
+                BenchmarkCase(
+                    "Dcm2Nii.run",
+                    variant,
+                    n_slices,
+                    dict(study, out_directory=out_directory),
+                )
+            )
+        cases.append(
+            BenchmarkCase(
+                "Dcm2Nii.run",
+                "native-single",
+                n_slices,
+                dict(
+                    single,
+                    out_directory=Path(os.path.join(work_dir, f"nifti_native_{n_slices}")),
+                    engine="native",
+                ),
+            )
+        )
+        for layer, multi_layer in [("single-layer", False), ("multi-layer", True)]:
+            for density, segfile in segfiles.items():
+                cases.append(
+                    BenchmarkCase(
+                        "multiclass_converter",
+                        f"{layer}-{density}",
+                        n_slices,
+                        dict(single, segfile=segfile, multiLayer=multi_layer),
+                    )
+                )
+            cases.append(
+                BenchmarkCase(
+                    "multiclass_converter",
+                    f"{layer}-dense-slab{SLAB_SIZE}",
+                    n_slices,
+                    dict(
+                        single,
+                        segfile=segfiles["dense"],
+                        multiLayer=multi_layer,
+                        slab_size=SLAB_SIZE,
+                    ),
+                )
+            )
+        cases.append(
+            BenchmarkCase(
+                "multiclass_converter",
+                "both-layouts-dense",
+                n_slices,
+                dict(single, segfile=segfiles["dense"], layouts=("single", "multi")),
+            )
+        )
+        for density, noise in [("dense", None), ("noisy", 0.01)]:
+            cases.append(
+                BenchmarkCase(
+                    "find_contours",
+                    density,
+                    n_slices,
+                    dict(single, segfile=segfiles["dense"], noise=noise),
+                )
+            )
+    return cases
+
+
+def run_suite(
+    work_dir: Path,
+    sizes: Sequence[int] = DEFAULT_SIZES,
+    rows: int = 128,
+    cols: int = 128,
+    repeat: int = 1,
+    select: str = "",
+) -> dict:
+    """Run the benchmark suite on synthetic studies. Every case runs in a fresh
+        interpreter, so that the peak RSS belongs to the case alone.
+
+    Args:
+        work_dir (Path): directory where the studies and outputs are written
+        sizes (Sequence[int], optional): number of slices of the studies. Defaults
+         to DEFAULT_SIZES.
+        rows (int, optional): rows per slice. Defaults to 128.
+        cols (int, optional): columns per slice. Defaults to 128.
+        repeat (int, optional): runs per case, the fastest one is reported.
+         Defaults to 1.
+        select (str, optional): only run the cases whose name contains this string.
+         Defaults to all cases.
+
+    Returns:
+        dict: the machine and the results of every case by name
+    """
+    cases = [
+        case
+        for case in generate_cases(work_dir, sizes, rows, cols)
+        if select in case.name
+    ]
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for case in cases:
+        runs = []
+        for _ in range(repeat):
+            with context.Pool(1) as pool:
+                runs.append(pool.apply(_run_case, (case.operation, case.inputs)))
+        seconds = min(run[0] for run in runs)
+        peak_rss_mb = max(run[1] for run in runs)
+        n_images = case.n_slices * (2 if case.variant == "multi" else 1)
+        results[case.name] = {
+            "operation": case.operation,
+            "variant": case.variant,
+            "n_slices": case.n_slices,
+            "seconds": round(seconds, 4),
+            "slices_per_second": round(n_images / seconds, 1),
+            "peak_rss_mb": round(peak_rss_mb, 1),
+        }
+        logger.info(
+            f"{case.name}: {seconds:.3f}s, {n_images / seconds:.1f} slices/s, "
+            f"{peak_rss_mb:.1f} MB peak RSS"
+        )
+
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "matrix": [rows, cols],
+        "results": results,
+    }
+
+
+def compare_to_baseline(
+    report: dict, baseline: dict, tolerance: float = 1.5
+) -> List[str]:
+    """Compare the results of a run with a baseline
+
+    Args:
+        report (dict): report of `run_suite`
+        baseline (dict): a previously stored report
+        tolerance (float, optional): allowed ratio of the time and peak RSS to the
+         baseline. Defaults to 1.5.
+
+    Returns:
+        List[str]: a description of every regression, empty if there is none
+    """
+    regressions = []
+    if report.get("matrix") != baseline.get("matrix"):
+        logger.warning("Baseline was recorded with a different matrix size")
+    for name, result in report["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if reference[metric] > 0 and result[metric] > tolerance * reference[metric]:
+                regressions.append(
+                    f"{name}: {metric} {result[metric]} > {tolerance} x baseline "
+                    f"{reference[metric]}"
+                )
+    return regressions
+
+
+def compare_layouts(report: dict) -> List[str]:
+    """Compare the conversion of both DICOM-SEG layouts in one pass with the
+        conversions of each layout on its own
+
+    Args:
+        report (dict): report of `run_suite`
+
+    Returns:
+        List[str]: a description of the comparison for every study size
+    """
+    results = report["results"]
+    comparisons = []
+    for name, result in results.items():
+        if result["variant"] != "both-layouts-dense":
+            continue
+        n_slices = result["n_slices"]
+        separate = [
+            results.get(f"{result['operation']}[{layer}-dense-{n_slices}]")
+            for layer in ["single-layer", "multi-layer"]
+        ]
+        if None in separate:
+            continue
+        separate_seconds = sum(layout["seconds"] for layout in separate)
+        comparisons.append(
+            f"{name}: {result['seconds']:.3f}s in one pass, {separate_seconds:.3f}s "
+            f"for each layout on its own ({separate_seconds / result['seconds']:.2f}x)"
+        )
+    return comparisons
+
+
+def load_baseline(path: Path = DEFAULT_BASELINE) -> dict:
+    return read_json(path)
+
+
+def save_baseline(report: dict, path: Path = DEFAULT_BASELINE) -> Path:
+    return Path(write_json(report, path))
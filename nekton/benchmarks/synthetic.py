@@ -0,0 +1,208 @@
+import os
+from pathlib import Path
+from typing import List
+
+from ..utils.geometry import dicom_series_affine
+from ..utils.json_helpers import write_json
+from ..utils.lazy import lazy_import
+
+np = lazy_import("numpy")
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def _phantom(rows: int, cols: int, seed: int) -> "np.ndarray":
+    """smooth CT-like phantom with a little noise, so that it compresses realistically"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[-1 : 1 : rows * 1j, -1 : 1 : cols * 1j]  # noqa
+    body = (x / 0.9) ** 2 + (y / 0.7) ** 2 < 1
+    organ = ((x - 0.3) / 0.3) ** 2 + (y / 0.25) ** 2 < 1
+    image = np.where(body, 40, -1000) + np.where(organ, 60, 0)
+    return (image + rng.normal(0, 10, (rows, cols)) + 1024).astype(np.int16)
+
+
+def write_series(
+    directory: Path,
+    n_slices: int,
+    rows: int = 128,
+    cols: int = 128,
+    series_number: int = 1,
+    study_uid: str = None,
+    slice_thickness: float = 2.5,
+    seed: int = 0,
+) -> List[Path]:
+    """write a synthetic, uncompressed axial CT series
+
+    Args:
+        directory (Path): directory where the dicoms are written
+        n_slices (int): number of slices
+        rows (int, optional): rows per slice. Defaults to 128.
+        cols (int, optional): columns per slice. Defaults to 128.
+        series_number (int, optional): series number, also used in the file names. Defaults to 1.
+        study_uid (str, optional): study the series belongs to. Defaults to a new study.
+        slice_thickness (float, optional): thickness and spacing of the slices. Defaults to 2.5.
+        seed (int, optional): seed of the noise. Defaults to 0.
+
+    Returns:
+        List[Path]: paths of the written dicoms
+    """
+    os.makedirs(directory, exist_ok=True)
+    study_uid = study_uid or pydicom.uid.generate_uid()
+    series_uid = pydicom.uid.generate_uid()
+    frame_of_reference_uid = pydicom.uid.generate_uid()
+    pixel_data = _phantom(rows, cols, seed).tobytes()
+
+    paths = []
+    for i in range(n_slices):
+        file_meta = pydicom.dataset.FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds = pydicom.dataset.FileDataset(
+            None, {}, file_meta=file_meta, preamble=b"\0" * 128
+        )
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        ds.SOPClassUID = CT_IMAGE_STORAGE
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.PatientName = "Synthetic^Study"
+        ds.PatientID = "NEKTON-BENCHMARK"
+        ds.StudyInstanceUID = study_uid
+        ds.StudyDate = "20010101"
+        ds.StudyTime = "000000"
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = f"Synthetic_{series_number}"
+        ds.ProtocolName = f"Synthetic_{series_number}"
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.Modality = "CT"
+        ds.AcquisitionDate = "20010101"
+        ds.AcquisitionTime = "000000"
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, i * slice_thickness]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = [0.8, 0.8]
+        ds.SliceThickness = slice_thickness
+        ds.Rows, ds.Columns = rows, cols
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept, ds.RescaleSlope = -1024, 1
+        ds.PixelData = pixel_data
+
+        path = Path(os.path.join(directory, f"{series_number:03d}_{i:05d}.dcm"))
+        ds.save_as(path, write_like_original=False)
+        paths.append(path)
+    return paths
+
+
+def write_label_map(
+    path: Path, dcmfiles: List[Path], density: str = "dense", n_labels: int = 3
+) -> Path:
+    """write a label map matching the geometry of a synthetic series
+
+    Args:
+        path (Path): path of the nifti label map
+        dcmfiles (List[Path]): dicoms of the series, sorted by position
+        density (str, optional): "dense" for labels on most slices or "sparse" for
+         small labels on a few slices. Defaults to "dense".
+        n_labels (int, optional): number of labels. Defaults to 3.
+
+    Returns:
+        Path: path of the nifti label map
+    """
+    headers = [pydicom.dcmread(p, stop_before_pixels=True) for p in dcmfiles]
+    cols, rows, n_slices = headers[0].Columns, headers[0].Rows, len(headers)
+
+    x, y, z = np.ogrid[-1 : 1 : cols * 1j, -1 : 1 : rows * 1j, -1 : 1 : n_slices * 1j]  # noqa
+    labels = np.zeros((cols, rows, n_slices), dtype=np.uint8)
+    for label in range(1, n_labels + 1):
+        center = -0.6 + 1.2 * (label - 1) / max(n_labels - 1, 1)
+        if density == "dense":
+            blob = ((x - center) / 0.35) ** 2 + (y / 0.5) ** 2 + (z / 0.95) ** 2 < 1
+        else:
+            # a few slices around the center, at least one on small studies
+            center_slice = int(round((center + 1) / 2 * (n_slices - 1)))
+            near = np.abs(np.arange(n_slices) - center_slice) <= n_slices // 50
+            blob = ((x - center) / 0.1) ** 2 + (y / 0.1) ** 2 < 1
+            blob = blob & near[None, None, :]
+        labels[blob] = label
+
+    nib.save(nib.Nifti1Image(labels, dicom_series_affine(headers)), path)
+    return Path(path)
+
+
+def write_mapping(path: Path, n_labels: int = 3) -> Path:
+    """write a dcmqi segmentation mapping for the labels of `write_label_map`"""
+    segment_attributes = [
+        {
+            "labelID": label,
+            "SegmentDescription": f"Synthetic label {label}",
+            "SegmentedPropertyCategoryCodeSequence": {
+                "CodeValue": "123037004",
+                "CodingSchemeDesignator": "SCT",
+                "CodeMeaning": "Anatomical Structure",
+            },
+            "SegmentedPropertyTypeCodeSequence": {
+                "CodeValue": "10200004",
+                "CodingSchemeDesignator": "SCT",
+                "CodeMeaning": "Liver",
+            },
+            "SegmentAlgorithmType": "AUTOMATIC",
+            "SegmentAlgorithmName": "nekton-benchmark",
+        }
+        for label in range(1, n_labels + 1)
+    ]
+    mapping = {
+        "ContentCreatorName": "Benchmark",
+        "ClinicalTrialSeriesID": "Session1",
+        "ClinicalTrialTimePointID": "1",
+        "SeriesDescription": "Benchmark",
+        "SeriesNumber": "300",
+        "InstanceNumber": "1",
+        "segmentAttributes": [segment_attributes],
+    }
+    return Path(write_json(mapping, path))
+
+
+def make_study(
+    directory: Path,
+    n_slices: int,
+    rows: int = 128,
+    cols: int = 128,
+    n_series: int = 1,
+    density: str = "dense",
+) -> dict:
+    """generate a synthetic study with a label map and mapping for the first series
+
+    Args:
+        directory (Path): directory of the study
+        n_slices (int): number of slices per series
+        rows (int, optional): rows per slice. Defaults to 128.
+        cols (int, optional): columns per slice. Defaults to 128.
+        n_series (int, optional): number of series in the study directory. Defaults to 1.
+        density (str, optional): "dense" or "sparse" label map. Defaults to "dense".
+
+    Returns:
+        dict: `dicom_dir`, `dcmfiles` of the first series, `segfile` and `mapping`
+    """
+    dicom_dir = Path(os.path.join(directory, "dicom"))
+    study_uid = pydicom.uid.generate_uid()
+    series = [
+        write_series(dicom_dir, n_slices, rows, cols, i + 1, study_uid, seed=i)
+        for i in range(n_series)
+    ]
+    segfile = write_label_map(
+        Path(os.path.join(directory, f"labels_{density}.nii.gz")), series[0], density
+    )
+    mapping = write_mapping(Path(os.path.join(directory, "mapping.json")))
+    return {
+        "dicom_dir": dicom_dir,
+        "dcmfiles": series[0],
+        "segfile": segfile,
+        "mapping": mapping,
+    }
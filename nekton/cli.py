@@ -0,0 +1,401 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from . import __version__
+from .batch import FAILED, BatchItem, BatchRunner, Executor, ItemCallback
+from .scheduler import (
+    Job,
+    ResourceScheduler,
+    dcm2nii_job,
+    nii2dcmseg_job,
+    source_dicoms,
+)
+from .utils.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+def _dcm2nii_task(options: dict, **inputs) -> dict:
+    from .dcm2nii import Dcm2Nii
+
+    instrumentation = Instrumentation()
+    converter = Dcm2Nii(instrumentation=instrumentation, **options)
+    if inputs.get("out_directory") is not None:
+        os.makedirs(inputs["out_directory"], exist_ok=True)
+    outputs = converter.run(**inputs)
+    return {
+        "outputs": [str(path) for path in outputs],
+        "profile": instrumentation.summary(),
+    }
+
+
+def _nii2seg_task(options: dict, **inputs) -> dict:
+    from .nii2dcm import Nii2DcmSeg
+
+    instrumentation = Instrumentation()
+    converter = Nii2DcmSeg(instrumentation=instrumentation, **options)
+    # the dicoms of a directory are discovered in the job, not in the parent
+    with instrumentation.span("discovery"):
+        inputs["dcmfiles"] = source_dicoms(inputs["dcmfiles"], converter.cache_dir)
+    outputs = converter.multiclass_converter(**inputs)
+    return {
+        "outputs": [str(path) for path in outputs],
+        "profile": instrumentation.summary(),
+    }
+
+
+def expand_inputs(patterns: List[str], manifest: Path = None) -> List[dict]:
+    """Inputs from glob patterns and a manifest file. Every line of the manifest is
+        a path or a json object with the inputs of an item, e.g.
+        `{"segfile": ..., "dicom_dir": ..., "mapping": ...}`.
+
+    Args:
+        patterns (List[str]): paths or glob patterns, `**` matches subdirectories
+        manifest (Path, optional): manifest file. Defaults to None.
+
+    Raises:
+        ValueError: a pattern matches nothing
+
+    Returns:
+        List[dict]: the items, paths are under the key `path`
+    """
+    items = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise ValueError(f"No inputs match '{pattern}'")
+        items.extend({"path": match} for match in matches)
+    if manifest is not None:
+        with open(manifest) as infile:
+            for line in infile:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                item = json.loads(line) if line.startswith("{") else {"path": line}
+                items.append(item)
+    return items
+
+
+def _dcm2nii_jobs(
+    args: argparse.Namespace, items: List[dict]
+) -> Tuple[List[Job], dict]:
+    options = {
+        "engine": args.engine,
+        "compress": args.compression == "gz",
+        "deduplicate": args.deduplicate,
+        "cache_dir": args.cache_dir,
+    }
+    if args.workers_per_job:
+        options["workers"] = args.workers_per_job
+    jobs = []
+    for item in items:
+        dicom_directory = Path(item.get("dicom_dir") or item["path"])
+        out_directory = item.get("out_dir")
+        if out_directory is None and args.out_dir is not None:
+            out_directory = os.path.join(args.out_dir, dicom_directory.name)
+        job = dcm2nii_job(
+            item.get("id") or str(dicom_directory),
+            dicom_directory,
+            Path(out_directory) if out_directory is not None else None,
+            item.get("name", args.name),
+            engine=args.engine,
+            workers=args.workers_per_job,
+        )
+        jobs.append(job._replace(task=_dcm2nii_task))
+    return jobs, options
+
+
+def _nii2seg_jobs(
+    args: argparse.Namespace, items: List[dict]
+) -> Tuple[List[Job], dict]:
+    options = {"cache_dir": args.cache_dir, "deduplicate": args.deduplicate}
+    jobs = []
+    for item in items:
+        segfile = Path(item.get("segfile") or item["path"])
+        dicom_dir = item.get("dicom_dir") or args.dicom_dir
+        mapping = item.get("mapping") or args.mapping
+        if dicom_dir is None or mapping is None:
+            raise ValueError(f"{segfile} needs a dicom directory and a mapping")
+        job = nii2dcmseg_job(
+            item.get("id") or str(segfile),
+            segfile,
+            Path(mapping),
+            Path(dicom_dir),
+            slab_size=item.get("slab_size", args.slab_size),
+            layouts=item.get("layouts", args.layouts),
+        )
+        jobs.append(job._replace(task=_nii2seg_task))
+    return jobs, options
+
+
+def merge_profiles(profiles: List[dict]) -> dict:
+    """sum the instrumentation summaries of several conversions"""
+    spans: Dict[str, dict] = {}
+    counters: Dict[str, int] = {}
+    for profile in profiles:
+        for name, stats in profile["spans"].items():
+            total = spans.setdefault(
+                name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            total["count"] += stats["count"]
+            total["seconds"] += stats["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], stats["max_seconds"])
+        for name, value in profile["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    return {"spans": spans, "counters": counters}
+
+
+def scheduler_executor(
+    jobs: List[Job], options: dict, scheduler: ResourceScheduler, profiles: List[dict]
+) -> Executor:
+    """Executor of a `BatchRunner` running the jobs of the pending items in parallel
+
+    Args:
+        jobs (List[Job]): the jobs by item id, with a task returning outputs and profile
+        options (dict): keyword arguments of the converter, passed on to every job
+        scheduler (ResourceScheduler): runs the jobs within its budgets
+        profiles (List[dict]): receives the profile of every converted item
+
+    Returns:
+        Executor: the executor
+    """
+    jobs_by_id = {job.id: job for job in jobs}
+
+    def execute(items: List[BatchItem], finished: ItemCallback):
+        items_by_id = {item.id: item for item in items}
+
+        def job_finished(job: Job, result: dict, error: str):
+            if error is None:
+                profiles.append(result["profile"])
+            finished(items_by_id[job.id], result["outputs"] if error is None else [], error)
+
+        pending = [
+            jobs_by_id[item.id]._replace(
+                inputs=dict(jobs_by_id[item.id].inputs, options=options)
+            )
+            for item in items
+        ]
+        scheduler.run(pending, job_finished)
+
+    return execute
+
+
+def run_jobs(
+    jobs: List[Job],
+    options: dict,
+    workers: int = None,
+    memory_budget: int = None,
+    state: Path = None,
+    retries: int = 0,
+    backoff: float = 1.0,
+    max_backoff: float = 60.0,
+) -> dict:
+    """Run conversion jobs in parallel with a `BatchRunner`, skipping and recording
+        the items in its manifest
+
+    Args:
+        jobs (List[Job]): the jobs with a task returning outputs and profile
+        options (dict): keyword arguments of the converter
+        workers (int, optional): jobs running in parallel. Defaults to all cores.
+        memory_budget (int, optional): bytes the running jobs may use together.
+         Defaults to 80% of the physical memory.
+        state (Path, optional): manifest of the `BatchRunner`, completed items with
+         unchanged inputs are skipped. Defaults to no state.
+        retries (int, optional): rounds of retrying the failed jobs. Defaults to 0.
+        backoff (float, optional): seconds before the first retry round, doubled for
+         every further round. Defaults to 1.0.
+        max_backoff (float, optional): upper limit of the wait between rounds.
+         Defaults to 60.0.
+
+    Returns:
+        dict: the `items` with status and outputs, a `summary` and the merged `profile`
+    """
+    profiles: List[dict] = []
+    executor = scheduler_executor(
+        jobs, options, ResourceScheduler(workers, memory_budget), profiles
+    )
+    runner = BatchRunner(
+        None,
+        state,
+        retries=retries,
+        backoff=backoff,
+        max_backoff=max_backoff,
+        # the output directories of dcm2nii are not part of the fingerprint
+        output_keys=("out_directory",),
+        executor=executor,
+    )
+    # the converter options are not part of the items
+    summary = runner.run(
+        BatchItem(
+            job.id, {key: value for key, value in job.inputs.items() if key != "options"}
+        )
+        for job in jobs
+    )
+
+    items = []
+    for job in jobs:
+        record = runner.manifest.records[job.id]
+        status = summary["items"][job.id]
+        items.append(
+            {
+                "id": job.id,
+                "status": status,
+                "outputs": record.get("outputs", []) if status != FAILED else [],
+                "error": record.get("error"),
+            }
+        )
+    return {
+        "items": items,
+        "summary": {
+            key: summary[key]
+            for key in ["done", "skipped", "failed", "seconds", "items_per_second"]
+        },
+        "profile": merge_profiles(profiles),
+    }
+
+
+def _print_report(result: dict, profile: bool, stream=None):
+    stream = stream or sys.stdout
+    for item in result["items"]:
+        line = f"{item['status']:<8} {item['id']}"
+        if item.get("error"):
+            line += f": {item['error']}"
+        print(line, file=stream)
+    summary = result["summary"]
+    print(
+        f"\n{summary['done']} done, {summary['skipped']} skipped, {summary['failed']} "
+        f"failed in {summary['seconds']:.2f}s ({summary['items_per_second']:.2f} items/s)",
+        file=stream,
+    )
+    if profile:
+        print(f"\n{'phase':<25} {'count':>7} {'seconds':>10} {'max s':>10}", file=stream)
+        for name, stats in result["profile"]["spans"].items():
+            print(
+                f"{name:<25} {stats['count']:>7} {stats['seconds']:>10.3f} "
+                f"{stats['max_seconds']:>10.3f}",
+                file=stream,
+            )
+        for name, value in result["profile"]["counters"].items():
+            print(f"{name:<25} {value:>7}", file=stream)
+
+
+def _add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("inputs", nargs="*", help="paths or glob patterns of the inputs")
+    parser.add_argument(
+        "--manifest", type=Path,
+        help="file with one input path or json object of inputs per line",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="conversions running in parallel, default all cores"
+    )
+    parser.add_argument(
+        "--memory-budget", type=int,
+        help="MB the parallel conversions may use together, default 80%% of the memory",
+    )
+    parser.add_argument(
+        "--state", type=Path,
+        help="json lines state file, completed inputs are skipped on a rerun",
+    )
+    parser.add_argument("--retries", type=int, default=0, help="retries of failed inputs")
+    parser.add_argument(
+        "--cache-dir", type=Path,
+        help="reuse the dicoms found in a directory across runs; nii2seg also "
+        "decompresses .nii.gz inputs once into this directory and memory-maps them",
+    )
+    parser.add_argument(
+        "--deduplicate", choices=["uid", "content"],
+        help="drop repeated copies of a source dicom by SOPInstanceUID or by content",
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="report the seconds per conversion phase"
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the progress")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="nekton", description="Convert DICOM, NifTi and DICOM-SEG in batches"
+    )
+    parser.add_argument("--version", action="version", version=f"nekton {__version__}")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    dcm2nii = subparsers.add_parser("dcm2nii", help="convert dicom directories to NifTi")
+    _add_common_arguments(dcm2nii)
+    dcm2nii.add_argument(
+        "--out-dir", help="store the NifTi of every input in a subdirectory of this"
+    )
+    dcm2nii.add_argument("--name", default="", help="name of the output files")
+    dcm2nii.add_argument(
+        "--engine", choices=["dcm2niix", "native"], default="dcm2niix",
+        help="native converts simple series in-process and falls back to dcm2niix",
+    )
+    dcm2nii.add_argument(
+        "--compression", choices=["gz", "none"], default="gz",
+        help="write .nii.gz or uncompressed .nii",
+    )
+    dcm2nii.add_argument(
+        "--workers-per-job", type=int,
+        help="threads or processes reading the slices of the native engine",
+    )
+
+    nii2seg = subparsers.add_parser("nii2seg", help="convert NifTi labels to DICOM-SEG")
+    _add_common_arguments(nii2seg)
+    nii2seg.add_argument("--dicom-dir", help="source dicoms of all inputs")
+    nii2seg.add_argument("--mapping", help="dcmqi segmentation mapping of all inputs")
+    nii2seg.add_argument(
+        "--layouts", nargs="+", choices=["single", "multi"],
+        help="DICOM-SEG layouts to create in one pass, default single layer",
+    )
+    nii2seg.add_argument(
+        "--slab-size", type=int,
+        help="slices per slab to bound the memory, default the whole volume",
+    )
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """entry point of the `nekton` command, returns 1 if a conversion failed"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s [%(name)s:%(levelname)s] %(message)s",
+    )
+
+    try:
+        items = expand_inputs(args.inputs, args.manifest)
+        if not items:
+            parser.error("no inputs given")
+        if args.command == "dcm2nii":
+            jobs, options = _dcm2nii_jobs(args, items)
+        else:
+            args.slab_size = args.slab_size or None
+            jobs, options = _nii2seg_jobs(args, items)
+    except (ValueError, NameError, OSError) as err:
+        parser.error(str(err))
+
+    memory_budget = args.memory_budget * 1024**2 if args.memory_budget else None
+    result = run_jobs(
+        jobs, options, args.workers, memory_budget, args.state, args.retries
+    )
+    result["command"] = args.command
+    if args.json:
+        if not args.profile:
+            result.pop("profile")
+        json.dump(result, sys.stdout, indent=2, default=str)
+        print()
+    else:
+        _print_report(result, args.profile)
+    return 1 if result["summary"]["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,101 @@
 import glob
+import logging
 import os
-from typing import List
+import shutil
+import tempfile
+from typing import TYPE_CHECKING, List
 from pathlib import Path
 
-import pydicom
-
-from .utils.dicom import is_file_a_dicom
+from .utils.dicom import DicomHeaderCache, find_dicoms
 from .utils.bin import make_exec_bin, run_bin
-from .utils.fileops import rename_file
+from .utils.series import (
+    NATIVE_TRANSFER_SYNTAXES,
+    bids_sidecar,
+    dcm2niix_name,
+    group_series,
+    native_support,
+    read_series_volume,
+    series_nifti,
+)
+from .utils.sidecar import SidecarManager
+from .utils.instrumentation import Instrumentation
+from .utils.lazy import lazy_import
 
 from .base import BaseConverter
 
+if TYPE_CHECKING:
+    from numpy import ndarray
+    from pydicom.dataset import Dataset
+
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+
+logger = logging.getLogger(__name__)
+
 
 class Dcm2Nii(BaseConverter):
-    def __init__(self):
+    def __init__(
+        self,
+        instrumentation: Instrumentation = None,
+        provenance: bool = False,
+        engine: str = "dcm2niix",
+        compress: bool = True,
+        workers: int = None,
+        header_cache: DicomHeaderCache = None,
+        deduplicate: str = None,
+        cache_dir: Path = None,
+    ):
+        """DICOM to NifTi converter running dcm2niix or the native engine
+
+        Args:
+            instrumentation (Instrumentation, optional): collects the timing spans and
+             counters of the conversion phases. Defaults to a new one.
+            provenance (bool, optional): add the nekton version and the timings of the
+             conversion to the json sidecars of dcm2niix. Defaults to False.
+            engine (str, optional): "native" converts uncompressed single-frame series
+             in-process and falls back to dcm2niix for anything else, "dcm2niix"
+             always runs dcm2niix. Defaults to "dcm2niix".
+            compress (bool, optional): write `.nii.gz` instead of `.nii`. Defaults to
+             True.
+            workers (int, optional): threads reading or processes decoding the slices
+             of the native engine. Defaults to up to 8 threads or all cores.
+            header_cache (DicomHeaderCache, optional): e.g. `DicomHeaderCache()`,
+             headers of the native engine are read once and compressed slices are
+             decoded without parsing them again. Defaults to None.
+            deduplicate (str, optional): "uid" or "content", repeated copies of a dicom
+             in the directory are dropped after the discovery; dcm2niix then converts
+             a staging directory with links to the unique dicoms. Defaults to None.
+            cache_dir (Path, optional): directory where the dicoms found in a directory
+             are remembered, so that a rerun or a later conversion of the same files
+             skips the discovery. Defaults to None.
+
+        Raises:
+            ValueError: for an unknown engine
+        """
+        if engine not in ("dcm2niix", "native"):
+            raise ValueError(f"Unknown engine '{engine}'")
         make_exec_bin()
         self.run_bin = run_bin
-        """ 
-        merge flag:  -m : merge 2D slices from same series regardless of echo, exposure, etc. (n/y or 0/1/2, default 2) [no, yes, auto]
-        ignore flag: -i : ignore derived, localizer and 2D images (y/n, default n)
-        """
+        # dcm2niix merge flag -m: merge 2D slices from same series regardless of echo,
+        #  exposure, etc. (n/y or 0/1/2, default 2) [no, yes, auto]
+        # dcm2niix ignore flag -i: ignore derived, localizer and 2D images (y/n, default n)
         self.ignore_flag = "n"
         self.merge_flag = "2"
-        super().__init__()
+        self.provenance = provenance
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.compress = compress
+        self.workers = workers
+        super().__init__(instrumentation, header_cache, deduplicate)
 
     @staticmethod
-    def get_all_dicoms(dicom_directory: Path) -> List[Path]:
+    def get_all_dicoms(dicom_directory: Path, cache_dir: Path = None) -> List[Path]:
         """Class method to read all dicoms in adirectory
 
         Args:
             dicom_directory (Path): the directory where
+            cache_dir (Path, optional): directory where the dicoms found are
+             remembered. Defaults to checking every file.
 
         Raises:
             NameError: when the directory does not contain a single dicom
@@ -42,18 +108,17 @@ class Dcm2Nii(BaseConverter):
         if not os.path.exists(dicom_directory):
             raise NameError(f"directory: '{dicom_directory}' not found!")
 
-        # all the files in the directory
+        # all the files in the directory, sorted so that the first copy of a
+        # duplicate dicom is kept on every run
         file_path_list = [
             file_path
-            for file_path in glob.glob(os.path.join(dicom_directory, "**"))
+            for file_path in sorted(glob.glob(os.path.join(dicom_directory, "**")))
             if os.path.isfile(file_path)
         ]
 
         # check for dicoms only
         dicom_path_list = [
-            Path(file_path)
-            for file_path in file_path_list
-            if is_file_a_dicom(file_path)
+            Path(file_path) for file_path in find_dicoms(file_path_list, cache_dir)
         ]
 
         if len(dicom_path_list) == 0:
@@ -61,18 +126,25 @@ class Dcm2Nii(BaseConverter):
         return dicom_path_list
 
     @staticmethod
-    def check_slice_thickness_variable(all_dcm_paths: List[Path]) -> bool:
+    def check_slice_thickness_variable(
+        all_dcm_paths: List[Path], headers: List["Dataset"] = None
+    ) -> bool:
         """read file header slice thickness to determine if uniform thickness or variable
 
         Args:
             all_dcm_paths (List[Path]): list of path to DICOMs
+            headers (List[Dataset], optional): headers of the DICOMs if already read.
+             Defaults to reading them.
 
         Returns:
             bool: True if variable slice thickness else False
         """
-        all_slice_thickness = set(
-            [pydicom.read_file(path).SliceThickness for path in all_dcm_paths]
-        )
+        if headers is None:
+            headers = [
+                pydicom.read_file(path, stop_before_pixels=True)
+                for path in all_dcm_paths
+            ]
+        all_slice_thickness = set([header.SliceThickness for header in headers])
         return False if len(all_slice_thickness) == 1 else True
 
     def _run_conv_variable(self, dicom_directory: Path, out_directory: Path) -> List[Path]:
@@ -81,37 +153,69 @@ class Dcm2Nii(BaseConverter):
         )
 
     def rename_converted_files(
-        self, inp_file_list: List[Path], name: str
+        self, inp_file_list: List[Path], name: str, sidecars: SidecarManager = None
     ) -> List[Path]:
-        """Rename a file while preserving the suffix from dcm2niix
+        """Rename a file while preserving the suffix from dcm2niix. The files and
+            their json sidecars are renamed as one batch.
 
         Args:
             inp_file_list (List[Path]): list of files to renamed
             name (str): new name of the file
+            sidecars (SidecarManager, optional): sidecars of the files kept in
+             memory, they are moved along. Defaults to a new manager.
 
         Returns:
             List[Path]: list of renamed files
         """
-        # preserve all suffixes
-        dcm2niix_suffix = [
-            os.path.basename(file_path).split("_")[1:] for file_path in inp_file_list
-        ]
-
-        out_file_list = []
+        sidecars = sidecars or SidecarManager()
+        renames = []
 
         # rename files
-        for i, file_path in enumerate(inp_file_list):
-            # name + "_" + "_".join(dcm2niix_suffix[i])
+        for file_path in inp_file_list:
+            directory, file_name = os.path.split(str(file_path))
+            ext = next(
+                (ext for ext in [".nii.gz", ".nii"] if file_name.endswith(ext)),
+                os.path.splitext(file_name)[1],
+            )
+            # preserve all suffixes
+            dcm2niix_suffix = file_name[: len(file_name) - len(ext)].split("_")[1:]
+
+            # name + "_" + "_".join(dcm2niix_suffix)
             # if suffix exists only
             # fileName_ + sufix1_suffi2
             # fileName_sufix1_suffi2
             fname = (
-                name + "_" + "_".join(dcm2niix_suffix[i])
-                if len(dcm2niix_suffix[i]) > 0
+                name + "_" + "_".join(dcm2niix_suffix)
+                if len(dcm2niix_suffix) > 0
                 else name
             )
-            out_file_list.append(rename_file(str(file_path), fname))
-        return out_file_list
+            renames.append((Path(file_path), Path(os.path.join(directory, fname + ext))))
+        return sidecars.rename(renames)
+
+    @staticmethod
+    def _stage_dicoms(dcmfiles: List[Path], dicom_directory: Path, staging: Path) -> Path:
+        """link the dicoms into a directory named like the dicom directory, so that
+            dcm2niix converts only them and still names the niftis after the directory
+
+        Args:
+            dcmfiles (List[Path]): dicoms to convert
+            dicom_directory (Path): directory of the dicoms
+            staging (Path): temporary directory for the links
+
+        Returns:
+            Path: the staged dicom directory
+        """
+        staged = Path(
+            os.path.join(staging, os.path.basename(os.path.normpath(str(dicom_directory))))
+        )
+        os.makedirs(staged)
+        for path in dcmfiles:
+            link = os.path.join(staged, Path(path).name)
+            try:
+                os.symlink(os.path.abspath(path), link)
+            except OSError:  # e.g. without the privilege on windows
+                shutil.copy2(path, link)
+        return staged
 
     def _run_conv_uniform(self, dicom_directory: Path, out_directory:Path) -> List[Path]:
         """run the binary on the input directory
@@ -122,12 +226,90 @@ class Dcm2Nii(BaseConverter):
         Returns:
             List[Path]: output NifTi files post conversion
         """
-        self.run_bin(dicom_directory, out_directory,self.ignore_flag,self.merge_flag)
+        compress_flag = "y" if self.compress else "n"
+        self.run_bin(
+            dicom_directory, out_directory, self.ignore_flag, self.merge_flag, compress_flag
+        )
         if out_directory is not None:
             dicom_directory = out_directory
         output_files = list(Path(dicom_directory).glob("*.nii*"))
         return output_files
 
+    def _pixel_bytes_read(
+        self, dcmfiles: List[Path], header: "Dataset", volume: "ndarray"
+    ) -> int:
+        """bytes of the dicoms read for the pixel data of a series by the native engine
+
+        Args:
+            dcmfiles (List[Path]): dicoms of the series
+            header (Dataset): header of a dicom of the series
+            volume (ndarray): volume read from the series
+
+        Returns:
+            int: the frames of uncompressed series, the pixel data of compressed ones
+             and the whole files if their header is read again by the decoders
+        """
+        if str(header.file_meta.TransferSyntaxUID) in NATIVE_TRANSFER_SYNTAXES:
+            return volume.nbytes
+        sizes = sum(os.path.getsize(path) for path in dcmfiles)
+        if self.header_cache is None:
+            return sizes
+        return sizes - sum(self.header_cache.pixel_data_offset(path) for path in dcmfiles)
+
+    def _run_conv_native(
+        self,
+        all_dcm_paths: List[Path],
+        dicom_directory: Path,
+        out_directory: Path,
+        sidecars: SidecarManager,
+        headers: List["Dataset"] = None,
+    ) -> List[Path]:
+        """convert every series in-process, if all of them are supported
+
+        Args:
+            all_dcm_paths (List[Path]): all dicoms of the directory
+            dicom_directory (Path): directory of the dicoms
+            out_directory (Path): directory to store the niftis, defaults to the
+             dicom directory
+            sidecars (SidecarManager): receives the json sidecars of the niftis
+            headers (List[Dataset], optional): headers of the dicoms if already read.
+             Defaults to reading them.
+
+        Returns:
+            List[Path]: output NifTi files, None if a series needs dcm2niix
+        """
+        from . import __version__
+
+        if headers is None:
+            headers = self._read_dicom_headers(all_dcm_paths)
+        series = group_series(all_dcm_paths, headers)
+        names = {}
+        for uid, (_, series_headers) in series.items():
+            reason = native_support(series_headers)
+            if reason:
+                logger.info(f"Series {uid} needs dcm2niix: {reason}")
+                return None
+            names[uid] = dcm2niix_name(dicom_directory, series_headers[0])
+        if len(set(names.values())) != len(names):
+            logger.info("Series with the same name need dcm2niix")
+            return None
+
+        out_directory = out_directory if out_directory is not None else dicom_directory
+        ext = ".nii.gz" if self.compress else ".nii"
+        output_files = []
+        for uid, (dcmfiles, series_headers) in series.items():
+            volume, affine = read_series_volume(
+                dcmfiles, series_headers, self.workers, self.header_cache
+            )
+            self.instrumentation.count(
+                "bytes_read", self._pixel_bytes_read(dcmfiles, series_headers[0], volume)
+            )
+            output = Path(os.path.join(out_directory, names[uid] + ext))
+            nib.save(series_nifti(volume, affine, series_headers[0]), str(output))
+            sidecars.set(output, bids_sidecar(series_headers[0], __version__))
+            output_files.append(output)
+        return output_files
+
     def run(self, dicom_directory: Path, out_directory:Path=None, name: str = "") -> List[Path]:
         """Run the dcm to nifti conversion in a directory
 
@@ -144,29 +326,82 @@ class Dcm2Nii(BaseConverter):
         Returns:
             List[Path]: output list of Nifti files
         """
+        instrumentation = self.instrumentation
+        spans_before = instrumentation.summary()["spans"]
+        sidecars = SidecarManager()
         try:
-            all_dcm_paths = self.get_all_dicoms(dicom_directory)
+            with instrumentation.span("discovery"):
+                all_dcm_paths = self.get_all_dicoms(dicom_directory, self.cache_dir)
+                # the headers are read once for the deduplication and the checks
+                headers = self._read_dicom_headers(all_dcm_paths)
+            instrumentation.count("dicoms_found", len(all_dcm_paths))
+            all_dcm_paths, headers = self._deduplicate_dicoms(all_dcm_paths, headers)
         except Exception as err:
             raise RuntimeError(f"Error parsing dicoms: {err}")
 
         try:
-            if self.check_slice_thickness_variable(all_dcm_paths):
-                converted_file_paths = self._run_conv_variable(dicom_directory, out_directory)
-            else:
-                converted_file_paths = self._run_conv_uniform(dicom_directory, out_directory)
+            with instrumentation.span("slice_thickness_check"):
+                variable_thickness = self.check_slice_thickness_variable(
+                    all_dcm_paths, headers
+                )
+
+            converted_file_paths = None
+            if self.engine == "native" and not variable_thickness:
+                with instrumentation.span("native"):
+                    converted_file_paths = self._run_conv_native(
+                        all_dcm_paths, dicom_directory, out_directory, sidecars, headers
+                    )
+                if converted_file_paths is None:
+                    instrumentation.count("native_fallbacks")
+
+            if converted_file_paths is None:
+                with instrumentation.span(
+                    "dcm2niix"
+                ), tempfile.TemporaryDirectory() as staging:
+                    source_directory = dicom_directory
+                    if self.duplicates:
+                        # dcm2niix reads every file of a directory
+                        source_directory = self._stage_dicoms(
+                            all_dcm_paths, dicom_directory, staging
+                        )
+                        if out_directory is None:
+                            out_directory = dicom_directory
+                    if variable_thickness:
+                        converted_file_paths = self._run_conv_variable(
+                            source_directory, out_directory
+                        )
+                    else:
+                        converted_file_paths = self._run_conv_uniform(
+                            source_directory, out_directory
+                        )
+            instrumentation.count_bytes("bytes_written", *converted_file_paths)
         except Exception as err:
             raise RuntimeError(f"Error converting DCM to NifTi: {err}")
 
         if name != "":
             try:
-                converted_file_paths = self.rename_converted_files(
-                    converted_file_paths, name
-                )
+                with instrumentation.span("rename"):
+                    converted_file_paths = self.rename_converted_files(
+                        converted_file_paths, name, sidecars
+                    )
             except Exception as err:
                 raise RuntimeError(f"Error renaming output NifTi: {err}")
 
-        print(
-            f"\nConverted {len(all_dcm_paths)} DCM to Nifti; Output stored @ {Path(converted_file_paths[0]).parent}\n"
+        if self.provenance:
+            timings = {
+                phase: stats["seconds"]
+                - spans_before.get(phase, {}).get("seconds", 0.0)
+                for phase, stats in instrumentation.summary()["spans"].items()
+            }
+            for path in converted_file_paths:
+                sidecars.add_provenance(path, type(self).__name__, timings)
+        if len(sidecars) > 0:
+            with instrumentation.span("sidecar"):
+                sidecars.write()
+
+        logger.info(
+            f"Converted {len(all_dcm_paths)} DCM to Nifti; "
+            f"Output stored @ {Path(converted_file_paths[0]).parent}"
         )
 
         return converted_file_paths
@@ -0,0 +1,295 @@
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Tuple
+
+from .base import BaseConverter
+from .utils.dicom import DicomHeaderCache
+from .utils.geometry import (
+    dicom_series_affine,
+    dicom_slice_normal,
+    dicom_slice_positions,
+    nearest_slices,
+)
+from .utils.instrumentation import Instrumentation
+from .utils.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
+
+np = lazy_import("numpy")
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+
+DCMQI_SEG_SCHEMA = (
+    "https://raw.githubusercontent.com/qiicr/dcmqi/master/doc/schemas/seg-schema.json#"
+)
+
+
+class DcmSeg2Nii(BaseConverter):
+    def __init__(
+        self,
+        frames_per_chunk: int = 256,
+        instrumentation: Instrumentation = None,
+        header_cache: DicomHeaderCache = None,
+    ):
+        """DICOM-SEG to NifTi converter
+
+        Args:
+            frames_per_chunk (int, optional): number of frames that are unpacked at
+             once, bounds the memory of the decoding on top of the label map.
+             Defaults to 256.
+            instrumentation (Instrumentation, optional): collects the timing spans and
+             counters of the conversion phases. Defaults to a new one.
+            header_cache (DicomHeaderCache, optional): e.g. `DicomHeaderCache()`, so
+             that repeated conversions against the same referenced dicoms do not read
+             them again. Defaults to None.
+        """
+        self.frames_per_chunk = frames_per_chunk
+        super().__init__(instrumentation, header_cache)
+
+    @staticmethod
+    def _load_dcmseg(dcmseg_file: Path) -> "Dataset":
+        """Read a DICOM-SEG and check if it can be decoded
+
+        Args:
+            dcmseg_file (Path): path to the DICOM-SEG
+
+        Raises:
+            TypeError: the file is not a DICOM-SEG
+            NotImplementedError: the segmentation is fractional
+
+        Returns:
+            Dataset: the DICOM-SEG
+        """
+        assert os.path.exists(dcmseg_file), "DICOM-SEG missing"
+
+        dcmseg = pydicom.dcmread(dcmseg_file)
+        if dcmseg.get("Modality") != "SEG":
+            raise TypeError(f"{dcmseg_file} is not a DICOM-SEG")
+        if dcmseg.SegmentationType != "BINARY":
+            raise NotImplementedError(
+                "Only binary DICOM-SEG can be decoded to NifTi yet!!"
+            )
+        return dcmseg
+
+    def _load_reference_series(self, dcmfiles: List[Path]) -> List["Dataset"]:
+        """Read the headers of the referenced dicoms sorted along the slice normal
+
+        Args:
+            dcmfiles (List[Path]): list of paths of all the referenced dicom files
+
+        Returns:
+            List[Dataset]: sorted headers of the dicoms
+        """
+        headers = self._read_dicom_headers(dcmfiles)
+        order = np.argsort(dicom_slice_positions(headers), kind="stable")
+        return [headers[i] for i in order]
+
+    @staticmethod
+    def _frame_metadata(dcmseg: "Dataset") -> Tuple["np.ndarray", "np.ndarray"]:
+        """Segment number and plane position of every frame of the DICOM-SEG
+
+        Args:
+            dcmseg (Dataset): the DICOM-SEG
+
+        Raises:
+            ValueError: frames without a plane position
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: segment numbers (n,) and positions (n, 3)
+        """
+        per_frame = dcmseg.PerFrameFunctionalGroupsSequence
+        try:
+            segments = np.array(
+                [f.SegmentIdentificationSequence[0].ReferencedSegmentNumber for f in per_frame]
+            )
+            positions = np.array(
+                [f.PlanePositionSequence[0].ImagePositionPatient for f in per_frame],
+                dtype=float,
+            )
+        except AttributeError as err:
+            raise ValueError(f"Incomplete per-frame information in DICOM-SEG: {err}")
+        return segments, positions
+
+    def _decode_label_map(
+        self, dcmseg: "Dataset", ref_headers: List["Dataset"]
+    ) -> "np.ndarray":
+        """Unpack all frames and place them on the slices of the referenced series.
+            Where segments overlap the higher segment number is kept.
+
+        Args:
+            dcmseg (Dataset): the DICOM-SEG
+            ref_headers (List[Dataset]): sorted headers of the referenced dicoms
+
+        Raises:
+            ValueError: the frames do not fit the referenced series
+
+        Returns:
+            np.ndarray: label map with shape (slices, rows, columns)
+        """
+        rows, cols = int(dcmseg.Rows), int(dcmseg.Columns)
+        if (rows, cols) != (int(ref_headers[0].Rows), int(ref_headers[0].Columns)):
+            raise ValueError("DICOM-SEG frames do not match the referenced image size")
+
+        segments, positions = self._frame_metadata(dcmseg)
+        normal = dicom_slice_normal(ref_headers[0])
+        slice_positions = dicom_slice_positions(ref_headers)
+        frame_positions = positions @ normal
+        slice_idx = nearest_slices(slice_positions, frame_positions)
+
+        spacing = (
+            np.median(np.diff(slice_positions)) if len(slice_positions) > 1 else 1.0
+        )
+        if np.any(np.abs(slice_positions[slice_idx] - frame_positions) > 0.1 * spacing):
+            raise ValueError("DICOM-SEG frames do not lie on the referenced slices")
+
+        n_frames = len(segments)
+        dtype = np.uint8 if segments.max(initial=0) < 256 else np.uint16
+        label_map = np.zeros((len(ref_headers), rows, cols), dtype=dtype)
+
+        # frames are unpacked in chunks; a chunk only starts on a byte boundary
+        # if the frames fill whole bytes, otherwise everything is unpacked at once
+        packed = np.frombuffer(dcmseg.PixelData, dtype=np.uint8)
+        frame_bits = rows * cols
+        chunk = self.frames_per_chunk if frame_bits % 8 == 0 else n_frames
+        for start in range(0, n_frames, chunk):
+            stop = min(start + chunk, n_frames)
+            frames = np.unpackbits(
+                packed[start * frame_bits // 8:],
+                count=(stop - start) * frame_bits,
+                bitorder="little",
+            ).reshape(-1, rows, cols)
+
+            chunk_segments = segments[start:stop]
+            for segment in np.unique(chunk_segments):
+                selected = chunk_segments == segment
+                idx = slice_idx[start:stop][selected]
+                label_map[idx] = np.maximum(
+                    label_map[idx], frames[selected] * dtype(segment)
+                )
+
+        return label_map
+
+    @staticmethod
+    def _dcmqi_metainfo(dcmseg: "Dataset") -> dict:
+        """Create the dcmqi segmentation mapping from the segments of a DICOM-SEG
+
+        Args:
+            dcmseg (Dataset): the DICOM-SEG
+
+        Returns:
+            dict: mapping following the dcmqi seg-schema
+        """
+
+        def code(sequence: "Dataset") -> dict:
+            # missing tags are left out instead of written as "None"
+            return {
+                tag: str(sequence[0].get(tag))
+                for tag in ["CodeValue", "CodingSchemeDesignator", "CodeMeaning"]
+                if sequence[0].get(tag) is not None
+            }
+
+        metainfo = {"@schema": DCMQI_SEG_SCHEMA}
+        for tag in [
+            "ContentCreatorName",
+            "ClinicalTrialSeriesID",
+            "ClinicalTrialTimePointID",
+            "ClinicalTrialCoordinatingCenterName",
+            "SeriesDescription",
+            "SeriesNumber",
+            "InstanceNumber",
+            "BodyPartExamined",
+        ]:
+            if dcmseg.get(tag) not in [None, ""]:
+                metainfo[tag] = str(dcmseg.get(tag))
+
+        segment_attributes = []
+        for segment in dcmseg.SegmentSequence:
+            attributes = {"labelID": int(segment.SegmentNumber)}
+            for tag in [
+                "SegmentDescription",
+                "SegmentLabel",
+                "SegmentAlgorithmType",
+                "SegmentAlgorithmName",
+                "TrackingIdentifier",
+                "TrackingUniqueIdentifier",
+            ]:
+                if segment.get(tag) not in [None, ""]:
+                    attributes[tag] = str(segment.get(tag))
+            for tag in [
+                "SegmentedPropertyCategoryCodeSequence",
+                "SegmentedPropertyTypeCodeSequence",
+                "SegmentedPropertyTypeModifierCodeSequence",
+                "AnatomicRegionSequence",
+                "AnatomicRegionModifierSequence",
+            ]:
+                if tag in segment:
+                    attributes[tag] = code(segment.get(tag))
+            if "RecommendedDisplayCIELabValue" in segment:
+                attributes["RecommendedDisplayCIELabValue"] = [
+                    int(x) for x in segment.RecommendedDisplayCIELabValue
+                ]
+            segment_attributes.append(attributes)
+        metainfo["segmentAttributes"] = [segment_attributes]
+
+        return metainfo
+
+    def run(
+        self,
+        dcmseg_file: Path,
+        dcmfiles: List[Path],
+        out_directory: Path = None,
+        name: str = "",
+    ) -> List[Path]:
+        """Run the DICOM-SEG to nifti label map conversion
+
+        Args:
+            dcmseg_file (Path): path to the DICOM-SEG
+            dcmfiles (List[Path]): list of paths of all the referenced dicom files
+            out_directory (Path, optional): directory to store the outputs. Defaults
+             to the directory of the DICOM-SEG.
+            name (str, optional): Name to be given to the output files. Defaults to
+             the name of the DICOM-SEG.
+
+        Raises:
+            RuntimeError: Parsing dicom error
+            RuntimeError: Conversion error
+
+        Returns:
+            List[Path]: path to the nifti label map and the dcmqi mapping json
+        """
+        instrumentation = self.instrumentation
+        try:
+            with instrumentation.span("load_dcmseg"):
+                dcmseg = self._load_dcmseg(dcmseg_file)
+            instrumentation.count_bytes("bytes_read", dcmseg_file)
+            with instrumentation.span("parse_headers"):
+                ref_headers = self._load_reference_series(dcmfiles)
+        except Exception as err:
+            raise RuntimeError(f"Error parsing dicoms: {err}")
+
+        try:
+            with instrumentation.span("decode"):
+                label_map = self._decode_label_map(dcmseg, ref_headers)
+            # nifti axes run along the dicom columns, rows and slices
+            label_img = nib.Nifti1Image(
+                label_map.transpose(2, 1, 0), dicom_series_affine(ref_headers)
+            )
+        except Exception as err:
+            raise RuntimeError(f"Error converting DICOM-SEG to NifTi: {err}")
+
+        if out_directory is None:
+            out_directory = Path(dcmseg_file).parent
+        os.makedirs(out_directory, exist_ok=True)
+        if name == "":
+            name = Path(dcmseg_file).stem
+
+        out_niftifile = Path(os.path.join(out_directory, name + ".nii.gz"))
+        with instrumentation.span("save_as"):
+            nib.save(label_img, out_niftifile)
+        instrumentation.count_bytes("bytes_written", out_niftifile)
+        out_jsonfile = self.write_dict_json(
+            out_directory, self._dcmqi_metainfo(dcmseg), name
+        )
+
+        return [out_niftifile, out_jsonfile]
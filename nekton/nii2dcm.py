@@ -1,43 +1,52 @@
+import logging
 import os
+import tempfile
 from pathlib import Path
-from typing import List, Union
+from typing import TYPE_CHECKING, Dict, List, Sequence
 
-import numpy as np
-import nibabel as nib
-import pydicom
-from pydicom.dataset import FileDataset, Dataset
-import pydicom_seg
-from pydicom_seg.segmentation_dataset import SegmentationDataset
-import SimpleITK as sitk
+from .base import BaseConverter
+from .utils.dicom import DicomHeaderCache
+from .utils.dicomseg import FrameItems, SegFrameWriter, encode_frame
+from .utils.instrumentation import Instrumentation
+from .utils.lazy import lazy_import
+from .utils.nifti import is_memory_mapped, label_volume, load_nifti
 
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
 
-from .base import BaseConverter
-from .utils.json_helpers import verify_label_dcmqii_json
+# heavy dependencies are only imported once a conversion is run
+np = lazy_import("numpy")
 
+logger = logging.getLogger(__name__)
 
-class Nii2DcmSeg(BaseConverter):
-    def __init__(self):
-        super().__init__()
 
-    @staticmethod
-    def _load_segmap(segmentation_map: Path) -> Dataset:
-        """Read the segmentation mapping from the dcmqii standard json
+class Nii2DcmSeg(BaseConverter):
+    def __init__(
+        self,
+        instrumentation: Instrumentation = None,
+        cache_dir: Path = None,
+        header_cache: DicomHeaderCache = None,
+        deduplicate: str = None,
+    ):
+        """NifTi to DICOM-SEG converter
 
         Args:
-            segmentation_map (Path): Path to the json file
-
-        Returns:
-            Dataset: dataset information extracted from the json
+            instrumentation (Instrumentation, optional): collects the timing spans and
+             counters of the conversion phases. Defaults to a new one.
+            cache_dir (Path, optional): directory where `.nii.gz` segmentations are
+             decompressed once, so that repeated conversions of the same volume read
+             the memory-mapped copy. Defaults to None.
+            header_cache (DicomHeaderCache, optional): e.g. `DicomHeaderCache()`, so
+             that repeated conversions against the same source dicoms do not read
+             them again. Defaults to None.
+            deduplicate (str, optional): "uid" or "content", repeated copies of a
+             source dicom are dropped before they are matched with the slices of the
+             segmentation. Defaults to None.
         """
-        assert os.path.exists(segmentation_map), "Seg mapping `.json` missing"
-
-        assert verify_label_dcmqii_json(
-            segmentation_map
-        ), "Seg mapping `.json` not confirming to DCIM-QII standard, "
+        self.cache_dir = cache_dir
+        super().__init__(instrumentation, header_cache, deduplicate)
 
-        return pydicom_seg.template.from_dcmqi_metainfo(segmentation_map)
-
-    def _check_all_dicoms(self, dcmfiles: List[Path], seg: np.ndarray) -> List[Path]:
+    def _check_all_dicoms(self, dcmfiles: List[Path], seg: "np.ndarray") -> List[Path]:
         """Verifies if the number of dicoms and the layers in segmentation match. Also sorts
             DICOMs based on the instance number.
 
@@ -48,173 +57,230 @@ class Nii2DcmSeg(BaseConverter):
         Returns:
             List[Path]: sorted list of dicoms based on the order
         """
+        dcmfiles, headers = self._deduplicate_dicoms(
+            dcmfiles, self._read_dicom_headers(dcmfiles)
+        )
         assert len(dcmfiles) in list(
             seg.shape
         ), f"""Need 1 DICOM per slice of NifTi;
-        Found {len(dcmfiles)} DICOMS for {len(seg)} NifTi slice"""
+        Found {len(dcmfiles)} DICOMS for {seg.shape[-1]} NifTi slice"""
 
-        z_locs = [pydicom.dcmread(path).InstanceNumber for path in dcmfiles]
+        z_locs = [header.InstanceNumber for header in headers]
 
         return self.sort_order(z_locs, dcmfiles)
 
-    @staticmethod
-    def _check_all_lables(seg_map: Dataset, segImage: np.ndarray):
-        """Check the integrity of the labels in the segmentation and the mapping provided in the json
-
-        Args:
-            seg_map (Dataset): mapping extracted from the corresponding json
-            segImage (np.ndarray): 3d nifti segmentation
-
-        Raises:
-            ValueError: the segmentation is not found in the json
-        """
-        total_unique_segs = [
-            seg for seg in list(np.unique(np.uint8(segImage))) if seg != 0
-        ]
-
-        assert len(seg_map.SegmentSequence) >= len(
-            total_unique_segs
-        ), "Not all the segmentation have a mapping in the json"
-        # check all individual labels exist
-        max_length_seq = len(seg_map.SegmentSequence)
-        all_seq = [
-            seg_map.SegmentSequence[i].SegmentNumber for i in range(max_length_seq)
-        ]
-        for seg in total_unique_segs:
-            found = seg in all_seq
-            if not found:
-                raise ValueError(
-                    f"No Segmentation mapping found for label {seg} in json"
-                )
-
-    @staticmethod
-    def _create_dicomseg(
-        seg_map: Dataset,
-        segImage: np.ndarray,
-        dcmImage: Union[FileDataset, List[FileDataset]],
-    ) -> SegmentationDataset:
-        """create a dicomseg for storage
+    def multilabel_converter(
+        self, segfiles: List[Path], segMapping: Path, dcmfiles: List[Path]
+    ) -> List[Path]:
+        """Convert a binary nifti mask per label to a single multi-segment dicomseg.
+            The masks are read one at a time and only the frames within the bounding
+            box of each mask are encoded, the segments are allowed to overlap.
 
         Args:
-            seg_map (Dataset): Dataset info extraced from the mapping json
-            segImage (np.ndarray): a single slice of the segmentation nifti image
-            dcmImage (Union[FileDataset,List[FileDataset]]): input dicom to which
-             the dicomseg is to be linked to, if a list a multilayer dicomseg will
-             be created, else a single dicomseg for a single layer will be created
+            segfiles (List[Path]): paths to the binary nifti masks, one per segment
+             in the same order as the segments in the mapping
+            segMapping (Path): path to the dcmqii format segmentation mapping json
+            dcmfiles (List[Path]): list of paths of all the source dicom files
 
         Returns:
-            SegmentationDataset: created dicomseg file
+            List[Path]: path of the generated dicomseg file
         """
+        instrumentation = self.instrumentation
+        # load the segmentation mapping
+        with instrumentation.span("load_segmap"):
+            seg_map = self._load_segmap(segMapping)
+        segments = [segment.SegmentNumber for segment in seg_map.SegmentSequence]
+        assert len(segfiles) == len(
+            segments
+        ), f"Need 1 NifTi mask per segment; Found {len(segfiles)} for {len(segments)}"
+
+        with instrumentation.span("parse_headers"):
+            dcm_headers = self._read_dicom_headers(dcmfiles)
+        dcmfiles, dcm_headers = self._deduplicate_dicoms(dcmfiles, dcm_headers)
+        writer = SegFrameWriter(seg_map, dcm_headers, segments)
+
+        for segfile, segment in zip(segfiles, segments):
+            # only the header is read here, the voxels of one mask at a time below
+            mask_img = load_nifti(segfile, self.cache_dir)
+            assert (
+                mask_img.shape[-1] == len(dcmfiles)
+            ), f"""Need 1 DICOM per slice of NifTi;
+            Found {len(dcmfiles)} DICOMS for {mask_img.shape[-1]} NifTi slice"""
+            geometry = self._slice_geometry(
+                mask_img.affine, mask_img.shape[-1], dcm_headers
+            )
 
-        # convert to itk image
-        segImage_itk = sitk.GetImageFromArray(segImage.astype(np.uint8))
-
-        writer = pydicom_seg.MultiClassWriter(
-            template=seg_map,
-            inplane_cropping=False,  # Crop image slices to the minimum bounding box on
-            # x and y axes. Maybe not supported by other frameworks.
-            skip_empty_slices=True,  # Don't encode slices with only zeros
-            skip_missing_segment=True,  # If a segment definition is missing in the
-            # template, then raise an error instead of
-            # skipping it.
-        )
-
-        # add fake storage info if necessary
-        appendedImagePosition = False
-        if type(dcmImage) == FileDataset:
-            try:
-                dcmImage.ImagePositionPatient
-            except Exception:
-                appendedImagePosition = True
-                dcmImage.ImagePositionPatient = [0, 0, 0]
-            # write the image
-            dcmseg = writer.write(segImage_itk, source_images=[dcmImage])
-
-            # correct the acquition time and other info if neccesary
-            dcmseg.AcquisitionTime = dcmImage.AcquisitionTime
-        elif type(dcmImage) == list:
-            dcmseg = writer.write(segImage_itk, source_images=dcmImage)
-            # correct the acquition time and other info if neccesary
-            dcmseg.AcquisitionTime = dcmImage[0].AcquisitionTime
-
-        if appendedImagePosition:
-            dcmseg.ImagePositionPatient = None
-
-        return dcmseg
-
-    def _store_singlelayer_dicomseg(
-        self,
-        sorted_dcmfiles: List[Path],
-        seg_map: Dataset,
-        seg: np.ndarray,
-        out_folder: Path,
-    ) -> List[Path]:
-        """stores each individual layer as a single dcm
-
-        Args:
-            sorted_dcmfiles (List[Path]): list of paths of all the source
-             dicom files sorted by z-axis
-            seg_map (Dataset): Dataset info extraced from the mapping json
-            seg (np.ndarray): numpy array from a  segmentation nifti image
-            out_folder (Path): path to folder to store the output to
+            with instrumentation.span("load_segmentation", segment=segment):
+                mask = label_volume(mask_img)
+            instrumentation.count_bytes("bytes_read", segfile)
+            occupied_slices = np.flatnonzero(mask.any(axis=(0, 1)))
+            if len(occupied_slices) == 0:
+                logger.warning(f"Skipping empty mask {segfile}")
+                continue
+
+            with instrumentation.span("encode", segment=segment):
+                for i in range(occupied_slices[0], occupied_slices[-1] + 1):
+                    frame = geometry.to_frame(mask[..., i])
+                    if frame.any():
+                        writer.add_frame(frame, segment, geometry.slice_to_source[i])
+            del mask
+
+        with instrumentation.span("assemble"):
+            dcmseg = writer.finalize()
+
+        # create folder to store the dicomseg
+        parent_dir = Path(segfiles[0]).parent
+        out_folder = Path(os.path.join(parent_dir, "dicomseg"))
+        os.makedirs(out_folder, exist_ok=True)
 
-        Returns:
-            List[Path]: path to each individual dcm
-        """
-        # list to contain all the output paths of the dicomseg created
-        out_list = []
-
-        for i in range(len(sorted_dcmfiles)):
-
-            # for non-empty segmenetation only
-            non_zero_labels = np.unique(seg[..., i : i + 1]) != 0  # noqa
-            if sum(non_zero_labels) > 0:
-                dcm_file = Path(sorted_dcmfiles[i])
-                dcm = pydicom.read_file(dcm_file)
-                dcmseg = self._create_dicomseg(
-                    seg_map, seg[..., i : i + 1], dcm  # noqa
-                )
-                out_dcmfile = Path(os.path.join(out_folder, dcm_file.name))
-                dcmseg.save_as(out_dcmfile)
-                out_list.append(out_dcmfile)
+        first_dcmfile = Path(
+            dcmfiles[min(range(len(dcmfiles)), key=lambda i: dcm_headers[i].InstanceNumber)]
+        )
+        out_dcmfile = Path(os.path.join(out_folder, first_dcmfile.name))
+        with instrumentation.span("save_as"):
+            dcmseg.save_as(out_dcmfile)
+        instrumentation.count_bytes("bytes_written", out_dcmfile)
 
-        return out_list
+        return [out_dcmfile]
 
-    def _store_multilayer_dicomseg(
+    def _store_slabwise_dicomseg(
         self,
-        sorted_dcmfiles: List[Path],
-        seg_map: Dataset,
-        seg: np.ndarray,
-        out_folder: Path,
-    ) -> List[Path]:
-        """stores all individual layer as a single multilayer dcm
+        segfile: Path,
+        seg_map: "Dataset",
+        dcmfiles: List[Path],
+        out_folders: Dict[str, Path],
+        slab_size: int = None,
+        scratch_dir: Path = None,
+    ) -> Dict[str, List[Path]]:
+        """streams the segmentation in slabs of slices through the nifti array proxy,
+            so that at most `slab_size` slices are decoded at once. Every frame is
+            bit-packed once and shared by all layouts: single layer dicomsegs are
+            written per slab, the frames of a multilayer dicomseg are accumulated
+            until the last slab. The dicomsegs do not depend on the slab size, the
+            whole segmentation is a single slab.
 
         Args:
-            sorted_dcmfiles (List[Path]): list of paths of all the source
-             dicom files sorted by z-axis
+            segfile (Path): path to the nifti segmentation file
             seg_map (Dataset): Dataset info extraced from the mapping json
-            seg (np.ndarray): numpy array from a  segmentation nifti image
-            out_folder (Path): path to folder to store the output to
+            dcmfiles (List[Path]): list of paths of all the source dicom files
+            out_folders (Dict[str, Path]): folder to store the output to for each
+             layout, "single" and/or "multi"
+            slab_size (int, optional): number of slices read at once. Defaults to
+             all slices.
+            scratch_dir (Path, optional): temporary directory to decompress a
+             `.nii.gz` into when it is read in more than one slab and the converter
+             has no `cache_dir`. Defaults to reading the slabs from the gzip stream.
 
         Returns:
-            List[Path]: path to dcmseg
+            Dict[str, List[Path]]: paths of the generated dicomseg files per layout
         """
-        sorted_dcm = [pydicom.read_file(dcm_file) for dcm_file in sorted_dcmfiles]
-        dcmseg = self._create_dicomseg(seg_map, seg, sorted_dcm)
-        out_dcmfile = Path(os.path.join(out_folder, Path(sorted_dcmfiles[0]).name))
-        dcmseg.save_as(out_dcmfile)
-
-        return [out_dcmfile]
-
-    def multilabel_converter(
-        self, segfiles=List[Path], dcmfiles=List[Path]
-    ) -> List[Path]:
-        # all_individual_segs = [nib.load(file).get_fdata() for file in segfiles]
-        # de-priorisited for now
+        assert (
+            slab_size is None or slab_size > 0
+        ), "slab_size has to be a positive number of slices"
+        instrumentation = self.instrumentation
+
+        # only the header is read here, the voxels slab by slab below
+        seg_img = load_nifti(segfile, self.cache_dir)
+        n_slices = seg_img.shape[-1]
+        if (
+            not is_memory_mapped(seg_img)
+            and scratch_dir is not None
+            and (slab_size or n_slices) < n_slices
+        ):
+            # every slab of a gzip stream is decompressed from the start of the file,
+            # so it is decompressed once and the slabs are read from the copy
+            with instrumentation.span("decompress"):
+                seg_img = load_nifti(segfile, scratch_dir)
+        # slabs are views into the memory map if the file is uncompressed
+        volume = label_volume(seg_img) if is_memory_mapped(seg_img) else seg_img.dataobj
+        with instrumentation.span("parse_headers"):
+            dcm_headers = self._read_dicom_headers(dcmfiles)
+        dcmfiles, dcm_headers = self._deduplicate_dicoms(dcmfiles, dcm_headers)
+        assert n_slices == len(
+            dcmfiles
+        ), f"""Need 1 DICOM per slice of NifTi;
+        Found {len(dcmfiles)} DICOMS for {n_slices} NifTi slice"""
+        geometry = self._slice_geometry(seg_img.affine, n_slices, dcm_headers)
+
+        outputs = {layout: [] for layout in out_folders}
+        # encoded frames of the multilayer dicomseg as (segment, source index, frame)
+        frames = []
+        # the functional group items of a source are shared by all dicomsegs
+        items = FrameItems()
+        slab_size = slab_size or n_slices
+        for start in range(0, n_slices, slab_size):
+            stop = min(start + slab_size, n_slices)
+            with instrumentation.span("load_segmentation", slab=start):
+                slab = np.asarray(volume[..., start:stop])
+            with instrumentation.span("check_labels", slab=start):
+                self._check_all_lables(seg_map, slab)
+
+            for i in range(start, stop):
+                labels = geometry.to_frame(slab[..., i - start])
+                segments = [int(x) for x in np.unique(labels) if x != 0]
+                if len(segments) == 0:
+                    continue
+                source_idx = geometry.slice_to_source[i]
+
+                with instrumentation.span("encode", slice=i):
+                    encoded = [encode_frame(labels == segment) for segment in segments]
+                if "multi" in outputs:
+                    frames.extend(
+                        (segment, source_idx, frame)
+                        for segment, frame in zip(segments, encoded)
+                    )
+                if "single" not in outputs:
+                    continue
+
+                with instrumentation.span("assemble", slice=i):
+                    # the labels of a label map are mutually exclusive
+                    writer = SegFrameWriter(
+                        seg_map,
+                        [dcm_headers[source_idx]],
+                        segments,
+                        segments_overlap="NO",
+                        items=items,
+                    )
+                    for segment, frame in zip(segments, encoded):
+                        writer.add_frame(frame, segment, 0)
+                    dcmseg = writer.finalize()
+                out_dcmfile = Path(
+                    os.path.join(out_folders["single"], Path(dcmfiles[source_idx]).name)
+                )
+                with instrumentation.span("save_as", slice=i):
+                    dcmseg.save_as(out_dcmfile)
+                instrumentation.count_bytes("bytes_written", out_dcmfile)
+                outputs["single"].append(out_dcmfile)
+            del slab
+        instrumentation.count_bytes("bytes_read", segfile)
+
+        if "multi" not in outputs:
+            return outputs
+
+        # frames ordered by segment, then along the slices
+        frames.sort(key=lambda frame: frame[0])
+        with instrumentation.span("assemble"):
+            writer = SegFrameWriter(
+                seg_map,
+                dcm_headers,
+                set(segment for segment, _, _ in frames),
+                segments_overlap="NO",
+                items=items,
+            )
+            for segment, source_idx, frame in frames:
+                writer.add_frame(frame, segment, source_idx)
+            dcmseg = writer.finalize()
 
-        raise NotImplementedError(
-            "Multilabel NifTi s to DICOMSeg cannot to be handled yet!!"
+        first_dcmfile = Path(
+            dcmfiles[min(range(len(dcmfiles)), key=lambda i: dcm_headers[i].InstanceNumber)]
         )
+        out_dcmfile = Path(os.path.join(out_folders["multi"], first_dcmfile.name))
+        with instrumentation.span("save_as"):
+            dcmseg.save_as(out_dcmfile)
+        instrumentation.count_bytes("bytes_written", out_dcmfile)
+        outputs["multi"].append(out_dcmfile)
+
+        return outputs
 
     def multiclass_converter(
         self,
@@ -222,6 +288,8 @@ class Nii2DcmSeg(BaseConverter):
         segMapping: Path,
         dcmfiles: List[Path],
         multiLayer: bool = False,
+        slab_size: int = None,
+        layouts: Sequence[str] = None,
     ) -> List[Path]:
         """Convert a given nifti segmentation to dicomseg for multiclass segmentations
 
@@ -230,32 +298,45 @@ class Nii2DcmSeg(BaseConverter):
             segMapping (Path): path to the dcmqii format segmentation mapping json
             dcmfiles (List[Path]): list of paths of all the source dicom files
             multiLayer (bool, optional): create a single multilayer dicomseg. Defaults to False.
+            slab_size (int, optional): stream the segmentation in slabs of this many
+             slices to bound the memory, the dicomsegs are the same for every slab
+             size. Defaults to loading the whole segmentation.
+            layouts (Sequence[str], optional): create several layouts, "single" and/or
+             "multi", in one pass; replaces `multiLayer`. With more than one layout
+             each is stored in a subfolder named after it. Defaults to `multiLayer`.
+
+        Raises:
+            ValueError: unknown layout
 
         Returns:
-            List[Path]: list of paths of all generated dicomseg files
+            List[Path]: list of paths of all generated dicomseg files, in the order
+             of the layouts
         """
 
+        instrumentation = self.instrumentation
         # load the segmentation mapping
-        seg_map = self._load_segmap(segMapping)
-        # load the segmentation and verify if all dicoms exist
-        seg = nib.load(segfile).get_fdata()
-        sorted_dcmfiles = self._check_all_dicoms(dcmfiles, seg)
+        with instrumentation.span("load_segmap"):
+            seg_map = self._load_segmap(segMapping)
 
-        self._check_all_lables(seg_map, seg)
+        if layouts is None:
+            layouts = ["multi"] if multiLayer else ["single"]
+        layouts = list(dict.fromkeys(layouts))
+        unknown = set(layouts) - {"single", "multi"}
+        if unknown:
+            raise ValueError(f"Unknown DICOM-SEG layouts {sorted(unknown)}")
 
         # create folder to store the dicomsegs
-        parent_dir = Path(segfile).parent
-        out_folder = Path(os.path.join(parent_dir, "dicomseg"))
-        os.makedirs(out_folder, exist_ok=True)
-
-        # create store individual dicomseg
-        if multiLayer:
-            out_list = self._store_multilayer_dicomseg(
-                sorted_dcmfiles, seg_map, seg, out_folder
-            )
-        else:
-            out_list = self._store_singlelayer_dicomseg(
-                sorted_dcmfiles, seg_map, seg, out_folder
+        out_folder = Path(os.path.join(Path(segfile).parent, "dicomseg"))
+        out_folders = {
+            layout: out_folder
+            if len(layouts) == 1
+            else Path(os.path.join(out_folder, layout))
+            for layout in layouts
+        }
+        for folder in out_folders.values():
+            os.makedirs(folder, exist_ok=True)
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            outputs = self._store_slabwise_dicomseg(
+                segfile, seg_map, dcmfiles, out_folders, slab_size, scratch_dir
             )
-
-        return out_list
+        return [path for layout in layouts for path in outputs[layout]]
@@ -0,0 +1,261 @@
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from .base import BaseConverter
+from .utils.contours import find_contours, simplify_contour
+from .utils.instrumentation import Instrumentation
+from .utils.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset, FileDataset
+
+np = lazy_import("numpy")
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+
+GRAYSCALE_SOFTCOPY_PRESENTATION_STATE = "1.2.840.10008.5.1.4.1.1.11.1"
+
+# polylines of every segment for every source dicom index
+Annotations = Dict[Tuple[int, int], List["np.ndarray"]]
+
+
+class Nii2Gsps(BaseConverter):
+    def __init__(
+        self,
+        tolerance: float = 0.5,
+        instrumentation: Instrumentation = None,
+        deduplicate: str = None,
+    ):
+        """NifTi to GSPS contour converter
+
+        Args:
+            tolerance (float, optional): maximum distance in pixels between a contour
+             and its simplified polyline, 0 keeps every corner of the contour.
+             Defaults to 0.5.
+            instrumentation (Instrumentation, optional): collects the timing spans and
+             counters of the conversion phases. Defaults to a new one.
+            deduplicate (str, optional): "uid" or "content", repeated copies of a
+             source dicom are dropped before they are matched with the slices of the
+             segmentation. Defaults to None.
+        """
+        self.tolerance = tolerance
+        super().__init__(instrumentation, deduplicate=deduplicate)
+
+    def _extract_annotations(
+        self, frames: "np.ndarray", segments: List[int]
+    ) -> Annotations:
+        """Extract the simplified contour polylines of every segment on every frame
+
+        Args:
+            frames (np.ndarray): label map in dicom layout (slices, rows, columns)
+            segments (List[int]): segment numbers to be extracted
+
+        Returns:
+            Annotations: polylines of (column, row) points per (slice, segment)
+        """
+        annotations = {}
+        for segment in segments:
+            for slice_idx, contours in find_contours(frames == segment).items():
+                annotations[(slice_idx, segment)] = [
+                    simplify_contour(contour, self.tolerance)[:, ::-1]
+                    for contour in contours
+                ]
+        return annotations
+
+    @staticmethod
+    def _graphic_layer(segment: int) -> str:
+        return f"SEGMENT_{segment}"
+
+    def _create_gsps(
+        self,
+        seg_map: "Dataset",
+        dcm_headers: List["Dataset"],
+        annotations: Annotations,
+    ) -> "FileDataset":
+        """create a grayscale softcopy presentation state for storage
+
+        Args:
+            seg_map (Dataset): Dataset info extraced from the mapping json
+            dcm_headers (List[Dataset]): headers of the source dicoms
+            annotations (Annotations): polylines per (source dicom index, segment)
+
+        Returns:
+            FileDataset: created gsps file
+        """
+        reference = dcm_headers[0]
+
+        file_meta = pydicom.dataset.FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = GRAYSCALE_SOFTCOPY_PRESENTATION_STATE
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        gsps = pydicom.dataset.FileDataset(
+            None, {}, file_meta=file_meta, preamble=b"\0" * 128
+        )
+        gsps.is_little_endian = True
+        gsps.is_implicit_VR = False
+
+        gsps.SpecificCharacterSet = "ISO_IR 100"
+        gsps.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        gsps.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+
+        # patient and study of the source images
+        for tag in [
+            "PatientName",
+            "PatientID",
+            "PatientBirthDate",
+            "PatientSex",
+            "StudyInstanceUID",
+            "StudyDate",
+            "StudyTime",
+            "ReferringPhysicianName",
+            "StudyID",
+            "AccessionNumber",
+        ]:
+            if tag in reference:
+                gsps[tag] = reference[tag]
+
+        # presentation series and state
+        timestamp = datetime.now()
+        gsps.Modality = "PR"
+        gsps.SeriesInstanceUID = pydicom.uid.generate_uid()
+        gsps.SeriesNumber = seg_map.get("SeriesNumber", "300")
+        gsps.SeriesDescription = seg_map.get("SeriesDescription", "")
+        gsps.Manufacturer = "nekton"
+        gsps.InstanceNumber = seg_map.get("InstanceNumber", "1")
+        gsps.ContentLabel = "SEGMENTATION"
+        gsps.ContentDescription = seg_map.get("ContentDescription", "")
+        gsps.ContentCreatorName = seg_map.get("ContentCreatorName", "")
+        gsps.PresentationCreationDate = timestamp.strftime("%Y%m%d")
+        gsps.PresentationCreationTime = timestamp.strftime("%H%M%S.%f")
+        gsps.PresentationLUTShape = "IDENTITY"
+
+        # references to all the source images
+        series = pydicom.Dataset()
+        series.SeriesInstanceUID = reference.SeriesInstanceUID
+        series.ReferencedImageSequence = [
+            self._image_reference(header) for header in dcm_headers
+        ]
+        gsps.ReferencedSeriesSequence = [series]
+
+        displayed_area = pydicom.Dataset()
+        displayed_area.DisplayedAreaTopLeftHandCorner = [1, 1]
+        displayed_area.DisplayedAreaBottomRightHandCorner = [
+            reference.Columns,
+            reference.Rows,
+        ]
+        displayed_area.PresentationSizeMode = "SCALE TO FIT"
+        gsps.DisplayedAreaSelectionSequence = [displayed_area]
+
+        # a graphic layer per segment
+        gsps.GraphicLayerSequence = []
+        for order, segment in enumerate(seg_map.SegmentSequence, start=1):
+            layer = pydicom.Dataset()
+            layer.GraphicLayer = self._graphic_layer(segment.SegmentNumber)
+            layer.GraphicLayerOrder = order
+            layer.GraphicLayerDescription = segment.get(
+                "SegmentLabel", segment.get("SegmentDescription", "")
+            )
+            if "RecommendedDisplayCIELabValue" in segment:
+                layer.GraphicLayerRecommendedDisplayCIELabValue = (
+                    segment.RecommendedDisplayCIELabValue
+                )
+            gsps.GraphicLayerSequence.append(layer)
+
+        # the contours of a segment on a source image as closed polylines
+        gsps.GraphicAnnotationSequence = []
+        for (source_idx, segment), polylines in sorted(annotations.items()):
+            annotation = pydicom.Dataset()
+            annotation.ReferencedImageSequence = [
+                self._image_reference(dcm_headers[source_idx])
+            ]
+            annotation.GraphicLayer = self._graphic_layer(segment)
+            annotation.GraphicObjectSequence = []
+            for polyline in polylines:
+                # pixel centres are at .5 in the gsps pixel coordinates
+                closed = np.vstack([polyline, polyline[:1]]) + 0.5
+                graphic = pydicom.Dataset()
+                graphic.GraphicAnnotationUnits = "PIXEL"
+                graphic.GraphicDimensions = 2
+                graphic.NumberOfGraphicPoints = len(closed)
+                graphic.GraphicData = closed.ravel().tolist()
+                graphic.GraphicType = "POLYLINE"
+                graphic.GraphicFilled = "N"
+                annotation.GraphicObjectSequence.append(graphic)
+            gsps.GraphicAnnotationSequence.append(annotation)
+
+        return gsps
+
+    @staticmethod
+    def _image_reference(header: "Dataset") -> "Dataset":
+        reference = pydicom.Dataset()
+        reference.ReferencedSOPClassUID = header.SOPClassUID
+        reference.ReferencedSOPInstanceUID = header.SOPInstanceUID
+        return reference
+
+    def multiclass_converter(
+        self,
+        segfile: Path,
+        segMapping: Path,
+        dcmfiles: List[Path],
+    ) -> List[Path]:
+        """Convert a given nifti segmentation to a gsps with the contours of every label
+
+        Args:
+            segfile (Path): path to the nifti segmentation file
+            segMapping (Path): path to the dcmqii format segmentation mapping json
+            dcmfiles (List[Path]): list of paths of all the source dicom files
+
+        Returns:
+            List[Path]: path of the generated gsps file
+        """
+        instrumentation = self.instrumentation
+        # load the segmentation mapping
+        with instrumentation.span("load_segmap"):
+            seg_map = self._load_segmap(segMapping)
+
+        # load the segmentation and verify if all dicoms exist
+        seg_img = nib.load(segfile)
+        with instrumentation.span("parse_headers"):
+            dcm_headers = self._read_dicom_headers(dcmfiles)
+        dcmfiles, dcm_headers = self._deduplicate_dicoms(dcmfiles, dcm_headers)
+        assert seg_img.shape[-1] == len(
+            dcmfiles
+        ), f"""Need 1 DICOM per slice of NifTi;
+        Found {len(dcmfiles)} DICOMS for {seg_img.shape[-1]} NifTi slice"""
+        geometry = self._slice_geometry(seg_img.affine, seg_img.shape[-1], dcm_headers)
+
+        with instrumentation.span("load_segmentation"):
+            seg = np.asanyarray(seg_img.dataobj)
+        instrumentation.count_bytes("bytes_read", segfile)
+        with instrumentation.span("check_labels"):
+            self._check_all_lables(seg_map, seg)
+
+        # label map in dicom layout, ordered like the source dicoms
+        frames = np.zeros(
+            (len(dcm_headers), dcm_headers[0].Rows, dcm_headers[0].Columns),
+            dtype=seg.dtype,
+        )
+        for i, source_idx in enumerate(geometry.slice_to_source):
+            frames[source_idx] = geometry.to_frame(seg[..., i])
+
+        segments = [segment.SegmentNumber for segment in seg_map.SegmentSequence]
+        with instrumentation.span("encode"):
+            annotations = self._extract_annotations(frames, segments)
+            gsps = self._create_gsps(seg_map, dcm_headers, annotations)
+
+        # create folder to store the gsps
+        parent_dir = Path(segfile).parent
+        out_folder = Path(os.path.join(parent_dir, "gsps"))
+        os.makedirs(out_folder, exist_ok=True)
+
+        first_dcmfile = Path(
+            dcmfiles[min(range(len(dcmfiles)), key=lambda i: dcm_headers[i].InstanceNumber)]
+        )
+        out_gspsfile = Path(os.path.join(out_folder, first_dcmfile.name))
+        with instrumentation.span("save_as"):
+            gsps.save_as(out_gspsfile, write_like_original=False)
+        instrumentation.count_bytes("bytes_written", out_gspsfile)
+
+        return [out_gspsfile]
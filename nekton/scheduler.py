@@ -0,0 +1,392 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Sequence, Union
+
+from .utils.decode import can_decode
+from .utils.dicom import DicomHeaderCache
+from .utils.instrumentation import Instrumentation
+from .utils.lazy import lazy_import
+
+pydicom = lazy_import("pydicom")
+
+logger = logging.getLogger(__name__)
+
+# rough estimates, calibrated with the benchmark suite (`nekton.benchmarks`)
+# memory of an interpreter with the imported libraries
+BASE_MEMORY = 50 * 1024**2
+# parsed header, dataset and per-frame functional groups of a source slice
+HEADER_MEMORY = 50 * 1024
+# dcm2niix holds the volume and parts of its compressed copy
+DCM2NII_VOLUME_FACTOR = 1.5
+# label slab and masks per voxel of the slab, the whole volume without streaming
+SEG_SLAB_VOXEL_BYTES = 8
+# packed frames and functional groups per voxel of the volume and layout
+SEG_FRAME_VOXEL_BYTES = 1.5
+
+
+class Job(NamedTuple):
+    """A conversion with its estimated resources
+
+    Attributes:
+        id (str): unique name of the job
+        task (Callable[..., List[Path]]): picklable conversion called with the inputs
+        inputs (dict): keyword arguments of the task
+        memory (int): estimated peak memory in bytes
+        cpus (int): number of cores the job keeps busy
+    """
+
+    id: str
+    task: Callable[..., List[Path]]
+    inputs: dict
+    memory: int
+    cpus: int = 1
+
+
+# receives a finished job, its result and the error message or None
+JobCallback = Callable[[Job, object, str], None]
+
+
+class VolumeInfo(NamedTuple):
+    rows: int
+    cols: int
+    slices: int
+    bytes_per_voxel: int
+
+    @property
+    def voxels(self) -> int:
+        return self.rows * self.cols * self.slices
+
+    @property
+    def nbytes(self) -> int:
+        return self.voxels * self.bytes_per_voxel
+
+
+def volume_info(
+    dcmfiles: Sequence[Path], header_cache: DicomHeaderCache = None
+) -> VolumeInfo:
+    """Size of the volume of a series from the header of its first dicom, assuming
+        the other dicoms of the series share the matrix
+
+    Args:
+        dcmfiles (Sequence[Path]): dicoms of the series
+        header_cache (DicomHeaderCache, optional): header index to read the header
+         from. Defaults to reading it from the file.
+
+    Returns:
+        VolumeInfo: rows, columns, number of slices and bytes per voxel
+    """
+    if len(dcmfiles) == 0:
+        return VolumeInfo(0, 0, 0, 0)
+    if header_cache is not None:
+        header = header_cache.read(dcmfiles[0])
+    else:
+        header = pydicom.dcmread(dcmfiles[0], stop_before_pixels=True)
+    frames = int(header.get("NumberOfFrames", 1) or 1)
+    bits = int(header.get("BitsAllocated", 16)) * int(header.get("SamplesPerPixel", 1))
+    return VolumeInfo(
+        int(header.Rows), int(header.Columns), len(dcmfiles) * frames, bits // 8
+    )
+
+
+def _directory_files(directory: Path) -> List[Path]:
+    """files of a directory without parsing them, sorted by name"""
+    return sorted(
+        Path(entry.path) for entry in os.scandir(directory) if entry.is_file()
+    )
+
+
+def _first_dicom(
+    files: List[Path], header_cache: DicomHeaderCache = None
+) -> List[Path]:
+    """the files starting at the first dicom, skipping e.g. leftover outputs"""
+    for i, path in enumerate(files):
+        try:
+            if header_cache is not None:
+                header_cache.read(path)
+            else:
+                pydicom.dcmread(path, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        return files[i:]
+    return []
+
+
+def _run_dcm2nii(options: dict = None, **inputs) -> List[Path]:
+    from .dcm2nii import Dcm2Nii
+
+    return Dcm2Nii(**(options or {})).run(**inputs)
+
+
+def source_dicoms(
+    dcmfiles: Union[Sequence[Path], Path], cache_dir: Path = None
+) -> List[Path]:
+    """the source dicoms of a job, discovered in the job if given as a directory"""
+    if isinstance(dcmfiles, (str, Path)):
+        from .dcm2nii import Dcm2Nii
+
+        return sorted(Dcm2Nii.get_all_dicoms(dcmfiles, cache_dir))
+    return list(dcmfiles)
+
+
+def _run_nii2dcmseg(options: dict = None, **inputs) -> List[Path]:
+    from .nii2dcm import Nii2DcmSeg
+
+    converter = Nii2DcmSeg(**(options or {}))
+    inputs["dcmfiles"] = source_dicoms(inputs["dcmfiles"], converter.cache_dir)
+    return converter.multiclass_converter(**inputs)
+
+
+def dcm2nii_cpus(
+    dcmfiles: Sequence[Path],
+    engine: str = "dcm2niix",
+    workers: int = None,
+    header_cache: DicomHeaderCache = None,
+) -> int:
+    """Cores a `Dcm2Nii` conversion keeps busy. dcm2niix runs on a single core, the
+        native engine decodes compressed slices in a pool of `workers` processes
+        (default all cores) and reads uncompressed slices with `workers` threads
+        that mostly wait for the disk (counted as a single core by default).
+
+    Args:
+        dcmfiles (Sequence[Path]): dicoms of the series, the first one is read
+        engine (str, optional): engine of the converter. Defaults to "dcm2niix".
+        workers (int, optional): workers of the converter. Defaults to None.
+        header_cache (DicomHeaderCache, optional): header index to read the header
+         from. Defaults to reading it from the file.
+
+    Returns:
+        int: number of cores, at most all cores
+    """
+    if engine != "native" or len(dcmfiles) == 0:
+        return 1
+    if header_cache is not None:
+        header = header_cache.read(dcmfiles[0])
+    else:
+        header = pydicom.dcmread(dcmfiles[0], stop_before_pixels=True)
+    transfer_syntax = str(getattr(header.get("file_meta"), "TransferSyntaxUID", ""))
+    cores = os.cpu_count() or 1
+    if transfer_syntax and not pydicom.uid.UID(transfer_syntax).is_compressed:
+        return min(workers or 1, cores)
+    if transfer_syntax and can_decode(transfer_syntax):
+        return min(workers or cores, cores)
+    # falls back to dcm2niix
+    return 1
+
+
+def dcm2nii_job(
+    job_id: str,
+    dicom_directory: Path,
+    out_directory: Path = None,
+    name: str = "",
+    header_cache: DicomHeaderCache = None,
+    engine: str = "dcm2niix",
+    workers: int = None,
+) -> Job:
+    """Job converting a dicom directory with `Dcm2Nii.run`. dcm2niix runs in a
+        subprocess on a single core and holds the volume and its compressed copy,
+        the cores of the native engine are estimated by `dcm2nii_cpus`.
+
+    Args:
+        job_id (str): unique name of the job
+        dicom_directory (Path): directory of the dicoms
+        out_directory (Path, optional): directory of the niftis. Defaults to the
+         dicom directory.
+        name (str, optional): name of the niftis. Defaults to the dcm2niix name.
+        header_cache (DicomHeaderCache, optional): header index used for the estimate.
+         Defaults to reading the header once.
+        engine (str, optional): engine of the `Dcm2Nii` converter. Defaults to
+         "dcm2niix".
+        workers (int, optional): workers of the `Dcm2Nii` converter. Defaults to None.
+
+    Returns:
+        Job: the job with its estimated memory and cores
+    """
+    # the first dicom is read for the volume and the cores, but only once
+    header_cache = header_cache or DicomHeaderCache(max_entries=1)
+    dcmfiles = _first_dicom(_directory_files(dicom_directory), header_cache)
+    info = volume_info(dcmfiles, header_cache)
+    memory = BASE_MEMORY + int(DCM2NII_VOLUME_FACTOR * info.nbytes)
+    inputs = {"dicom_directory": dicom_directory, "out_directory": out_directory}
+    if name:
+        inputs["name"] = name
+    if engine != "dcm2niix" or workers is not None:
+        inputs["options"] = {"engine": engine, "workers": workers}
+    cpus = dcm2nii_cpus(dcmfiles, engine, workers, header_cache)
+    return Job(job_id, _run_dcm2nii, inputs, memory, cpus)
+
+
+def nii2dcmseg_job(
+    job_id: str,
+    segfile: Path,
+    segMapping: Path,
+    dcmfiles: Union[List[Path], Path],
+    multiLayer: bool = False,
+    slab_size: int = None,
+    layouts: Sequence[str] = None,
+    header_cache: DicomHeaderCache = None,
+) -> Job:
+    """Job converting a segmentation with `Nii2DcmSeg.multiclass_converter`. The
+        conversion runs in python on a single core, its memory grows with the number
+        of headers, with the label volume or the slab of it that is streamed, and
+        with the packed frames of every layout.
+
+    Args:
+        job_id (str): unique name of the job
+        segfile (Path): path to the nifti segmentation file
+        segMapping (Path): path to the dcmqii format segmentation mapping json
+        dcmfiles (Union[List[Path], Path]): list of paths of all the source dicom
+         files, or their directory; the dicoms of a directory are discovered in the
+         job and the estimate assumes that all files are dicoms
+        multiLayer (bool, optional): create a single multilayer dicomseg. Defaults to False.
+        slab_size (int, optional): stream the segmentation in slabs. Defaults to None.
+        layouts (Sequence[str], optional): layouts to create in one pass. Defaults to None.
+        header_cache (DicomHeaderCache, optional): header index used for the estimate.
+         Defaults to reading the header.
+
+    Returns:
+        Job: the job with its estimated memory
+    """
+    if isinstance(dcmfiles, (str, Path)):
+        info = volume_info(
+            _first_dicom(_directory_files(dcmfiles), header_cache), header_cache
+        )
+    else:
+        info = volume_info(dcmfiles, header_cache)
+    memory = BASE_MEMORY + HEADER_MEMORY * info.slices
+    slab_voxels = info.rows * info.cols * min(slab_size or info.slices, info.slices)
+    n_layouts = len(set(layouts)) if layouts else 1
+    memory += SEG_SLAB_VOXEL_BYTES * slab_voxels
+    memory += int(SEG_FRAME_VOXEL_BYTES * info.voxels * n_layouts)
+    inputs = {
+        "segfile": segfile,
+        "segMapping": segMapping,
+        "dcmfiles": dcmfiles if isinstance(dcmfiles, (str, Path)) else list(dcmfiles),
+        "multiLayer": multiLayer,
+        "slab_size": slab_size,
+        "layouts": layouts,
+    }
+    # the frames are encoded in the thread of the conversion, on a single core
+    return Job(job_id, _run_nii2dcmseg, inputs, memory, 1)
+
+
+def _total_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # not available on windows
+        return 0
+
+
+class ResourceScheduler:
+    def __init__(
+        self,
+        cpu_budget: int = None,
+        memory_budget: int = None,
+        executor: str = "process",
+        instrumentation: Instrumentation = None,
+    ):
+        """Run jobs in parallel while their estimated cores and memory fit into
+            the budgets. The smallest jobs are started first, so that small studies
+            finish with low latency while large ones wait for free memory. A job that
+            exceeds a budget on its own runs alone.
+
+        Args:
+            cpu_budget (int, optional): cores to keep busy. Defaults to all cores.
+            memory_budget (int, optional): bytes the running jobs may use together.
+             Defaults to 80% of the physical memory.
+            executor (str, optional): "process" for separate interpreters, "thread"
+             for jobs that release the GIL. Defaults to "process".
+            instrumentation (Instrumentation, optional): counts the finished and
+             failed jobs. Defaults to a new one.
+
+        Raises:
+            ValueError: unknown executor
+        """
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Unknown executor '{executor}'")
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.memory_budget = memory_budget or int(0.8 * _total_memory()) or None
+        self.executor = executor
+        self.instrumentation = instrumentation or Instrumentation()
+
+    def _fits(self, job: Job, cpus: int, memory: int) -> bool:
+        if cpus + job.cpus > self.cpu_budget:
+            return False
+        return self.memory_budget is None or memory + job.memory <= self.memory_budget
+
+    def run(self, jobs: Sequence[Job], callback: JobCallback = None) -> dict:
+        """Run all jobs
+
+        Args:
+            jobs (Sequence[Job]): the jobs, ids must be unique
+            callback (JobCallback, optional): called in this process as soon as a
+             job finished with the job, its result and the error or None, e.g. to
+             record the progress. Defaults to None.
+
+        Raises:
+            ValueError: duplicate job ids
+
+        Returns:
+            dict: the `outputs` and `failures` by job id, the `order` in which the
+             jobs were started, the total `seconds` and the `peak_memory` and
+             `peak_cpus` reserved by running jobs
+        """
+        ids = [job.id for job in jobs]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Jobs must have unique ids")
+
+        # smallest first, ties in submission order
+        pending = deque(sorted(jobs, key=lambda job: (job.memory, job.cpus)))
+        report = {
+            "outputs": {},
+            "failures": {},
+            "order": [],
+            "peak_memory": 0,
+            "peak_cpus": 0,
+        }
+        running = {}
+        cpus = memory = 0
+        start = time.perf_counter()
+
+        pool = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+        with pool(max_workers=self.cpu_budget) as executor:
+            while pending or running:
+                # strict order, a large job is not overtaken indefinitely
+                while pending and (not running or self._fits(pending[0], cpus, memory)):
+                    job = pending.popleft()
+                    if not running and not self._fits(job, 0, 0):
+                        logger.warning(f"Job {job.id} exceeds the budgets, runs alone")
+                    running[executor.submit(job.task, **job.inputs)] = job
+                    report["order"].append(job.id)
+                    cpus += job.cpus
+                    memory += job.memory
+                    report["peak_cpus"] = max(report["peak_cpus"], cpus)
+                    report["peak_memory"] = max(report["peak_memory"], memory)
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    cpus -= job.cpus
+                    memory -= job.memory
+                    result, error = None, None
+                    try:
+                        result = report["outputs"][job.id] = future.result()
+                        self.instrumentation.count("jobs_done")
+                    except Exception as err:
+                        error = f"{type(err).__name__}: {err}"
+                        report["failures"][job.id] = error
+                        self.instrumentation.count("jobs_failed")
+                        logger.warning(f"Job {job.id} failed: {err}")
+                    if callback is not None:
+                        callback(job, result, error)
+
+        report["seconds"] = round(time.perf_counter() - start, 4)
+        return report
@@ -19,7 +19,13 @@ def make_exec_bin():
     process.communicate()
 
 
-def run_bin(path: str, outpath:str = None,ignore_flag:str = "n",merge_flag:str = "2"):
+def run_bin(
+    path: str,
+    outpath: str = None,
+    ignore_flag: str = "n",
+    merge_flag: str = "2",
+    compress_flag: str = "y",
+):
     """run the binary on a given directory
 
     Args:
@@ -27,13 +33,13 @@ def run_bin(path: str, outpath:str = None,ignore_flag:str = "n",merge_flag:str =
     """
     if outpath is None:
         process = subprocess.Popen(
-            [PATH_TO_BIN, "-z","y","-m",merge_flag,"-i",ignore_flag, path],
+            [PATH_TO_BIN, "-z",compress_flag,"-m",merge_flag,"-i",ignore_flag, path],
             stdout=subprocess.PIPE,
             universal_newlines=True,
         )
     else:
         process = subprocess.Popen(
-            [PATH_TO_BIN, "-z","y","-m",merge_flag,"-i",ignore_flag,"-o", outpath, path],
+            [PATH_TO_BIN, "-z",compress_flag,"-m",merge_flag,"-i",ignore_flag,"-o", outpath, path],
             stdout=subprocess.PIPE,
             universal_newlines=True,
         )
@@ -0,0 +1,171 @@
+from typing import Dict, List
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# offset of the edge midpoints of a marching squares cell in doubled pixel
+# coordinates (row, column), the cell spans the pixels (r, c) to (r + 1, c + 1)
+_EDGE_OFFSETS = {"T": (0, 1), "R": (1, 2), "B": (2, 1), "L": (1, 0)}
+
+# directed segments of every cell configuration (tl=8, tr=4, br=2, bl=1),
+# oriented such that the foreground is always on the same side. Saddles (5, 10)
+# are resolved as separated corners, i.e. with 4-connectivity
+_CASE_SEGMENTS = {
+    1: [("L", "B")],
+    2: [("B", "R")],
+    3: [("L", "R")],
+    4: [("R", "T")],
+    5: [("L", "B"), ("R", "T")],
+    6: [("B", "T")],
+    7: [("L", "T")],
+    8: [("T", "L")],
+    9: [("T", "B")],
+    10: [("T", "L"), ("B", "R")],
+    11: [("T", "R")],
+    12: [("R", "L")],
+    13: [("R", "B")],
+    14: [("B", "L")],
+}
+
+
+def find_contours(masks: "np.ndarray") -> Dict[int, List["np.ndarray"]]:
+    """Extract the closed contours of a stack of binary masks with marching squares.
+        The cell configurations of the whole stack are classified and the segments
+        are linked into polylines with vectorized array operations.
+
+    Args:
+        masks (np.ndarray): binary masks with shape (slices, rows, columns)
+
+    Returns:
+        Dict[int, List[np.ndarray]]: for every slice with foreground, the contours
+         as (n, 2) arrays of (row, column) in pixel index coordinates
+    """
+    padded = np.pad(np.asarray(masks, dtype=bool), ((0, 0), (1, 1), (1, 1)))
+    padded = padded.view(np.uint8)
+    cases = (
+        (padded[:, :-1, :-1] << 3)
+        | (padded[:, :-1, 1:] << 2)
+        | (padded[:, 1:, 1:] << 1)
+        | padded[:, 1:, :-1]
+    )
+    n_slices, cell_rows, cell_cols = cases.shape
+    key_rows, key_cols = 2 * cell_rows + 1, 2 * cell_cols + 1
+
+    z, r, c = np.nonzero((cases != 0) & (cases != 15))
+    if len(z) == 0:
+        return {}
+    cell_cases = cases[z, r, c]
+
+    # every edge midpoint is identified by an integer key
+    starts, ends = [], []
+    for case, segments in _CASE_SEGMENTS.items():
+        selected = cell_cases == case
+        if not selected.any():
+            continue
+        zs, rs, cs = z[selected], 2 * r[selected], 2 * c[selected]
+        for start, end in segments:
+            for keys, edge in [(starts, start), (ends, end)]:
+                row_offset, col_offset = _EDGE_OFFSETS[edge]
+                keys.append(
+                    (zs * key_rows + rs + row_offset) * key_cols + cs + col_offset
+                )
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+
+    # each edge midpoint has exactly one outgoing segment, so the successor of
+    # every point can be found by a binary search in the sorted start points
+    order = np.argsort(starts)
+    nodes = starts[order]
+    n_nodes = len(nodes)
+    successors = np.searchsorted(nodes, ends[order])
+
+    # the successors form disjoint cycles, pointer jumping labels every point with
+    # the first point of its cycle in log2(n) vectorized steps
+    labels = np.arange(n_nodes)
+    jumps = successors
+    for _ in range(n_nodes.bit_length()):
+        labels = np.minimum(labels, labels[jumps])
+        jumps = jumps[jumps]
+
+    # cut every cycle before its first point and rank the points by their distance
+    # to the cut, the index n_nodes is the end of all the cut paths
+    firsts = np.nonzero(labels == np.arange(n_nodes))[0]
+    predecessors = np.empty(n_nodes, dtype=successors.dtype)
+    predecessors[successors] = np.arange(n_nodes)
+    jumps = np.append(successors, n_nodes)
+    jumps[predecessors[firsts]] = n_nodes
+    remaining = (jumps != n_nodes).astype(np.int64)
+    for _ in range(n_nodes.bit_length()):
+        remaining = remaining + remaining[jumps]
+        jumps = jumps[jumps]
+    walk = np.lexsort((-remaining[:n_nodes], labels))
+
+    keys = nodes[walk]
+    slices = keys // (key_rows * key_cols)
+    rows2, cols2 = np.divmod(keys % (key_rows * key_cols), key_cols)
+    # undo the doubling and the padding
+    points = np.stack([rows2 / 2.0 - 1, cols2 / 2.0 - 1], axis=1)
+    bounds = np.searchsorted(labels[walk], firsts)
+
+    contours: Dict[int, List["np.ndarray"]] = {}
+    for start, cycle in zip(bounds, np.split(points, bounds[1:])):
+        contours.setdefault(int(slices[start]), []).append(cycle)
+    return contours
+
+
+def _drop_collinear(points: "np.ndarray") -> "np.ndarray":
+    """remove the points of a closed polyline that lie on a straight line"""
+    incoming = points - np.roll(points, 1, axis=0)
+    outgoing = np.roll(points, -1, axis=0) - points
+    cross = incoming[:, 0] * outgoing[:, 1] - incoming[:, 1] * outgoing[:, 0]
+    corners = points[cross != 0]
+    return corners if len(corners) >= 3 else points
+
+
+def _douglas_peucker(points: "np.ndarray", tolerance: float) -> "np.ndarray":
+    """simplify an open polyline, the end points are always kept"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        direction = points[end] - points[start]
+        relative = points[start + 1:end] - points[start]
+        length = np.hypot(direction[0], direction[1])
+        if length > 0:
+            distance = (
+                np.abs(direction[0] * relative[:, 1] - direction[1] * relative[:, 0])
+                / length
+            )
+        else:
+            distance = np.hypot(relative[:, 0], relative[:, 1])
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+    return points[keep]
+
+
+def simplify_contour(points: "np.ndarray", tolerance: float) -> "np.ndarray":
+    """Simplify a closed contour with the Ramer-Douglas-Peucker algorithm
+
+    Args:
+        points (np.ndarray): (n, 2) points of the closed contour
+        tolerance (float): maximum distance in pixels of a removed point to the
+         simplified contour, 0 only removes collinear points
+
+    Returns:
+        np.ndarray: (m, 2) points of the simplified closed contour
+    """
+    points = _drop_collinear(points)
+    if tolerance <= 0 or len(points) < 4:
+        return points
+
+    # split the closed contour at the point farthest from the first one
+    farthest = int(np.argmax(np.sum((points - points[0]) ** 2, axis=1)))
+    first_half = _douglas_peucker(points[: farthest + 1], tolerance)
+    second_half = _douglas_peucker(np.vstack([points[farthest:], points[:1]]), tolerance)
+    return np.vstack([first_half[:-1], second_half[:-1]])
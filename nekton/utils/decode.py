@@ -0,0 +1,202 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Tuple
+
+from .dicom import DicomHeaderCache
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
+
+np = lazy_import("numpy")
+pydicom = lazy_import("pydicom")
+
+# attributes of the header the pixel data handlers need to decode a frame
+_PIXEL_ATTRIBUTES = [
+    "Rows",
+    "Columns",
+    "BitsAllocated",
+    "BitsStored",
+    "HighBit",
+    "PixelRepresentation",
+    "SamplesPerPixel",
+    "PhotometricInterpretation",
+    "PlanarConfiguration",
+    "NumberOfFrames",
+]
+
+
+def can_decode(transfer_syntax: str) -> bool:
+    """True if an installed pixel data handler of pydicom decodes the transfer syntax"""
+    transfer_syntax = pydicom.uid.UID(str(transfer_syntax))
+    return any(
+        handler.is_available() and handler.supports_transfer_syntax(transfer_syntax)
+        for handler in pydicom.config.pixel_data_handlers
+    )
+
+
+def mask_unused_bits(frame: "np.ndarray", bits_stored: int):
+    """sign extend or clear the bits above BitsStored in place"""
+    shift = 8 * frame.itemsize - bits_stored
+    if shift <= 0:
+        return
+    if frame.dtype.kind == "i":
+        frame <<= shift
+        frame >>= shift
+    else:
+        frame &= (1 << bits_stored) - 1
+
+
+def _decode_frame(
+    path: str, offset: int, transfer_syntax: str, attributes: dict
+) -> "np.ndarray":
+    """decode the pixel data of a single-frame dicom
+
+    The header is not parsed again if the offset of the pixel data is known from
+    the header index, a dataset with only the pixel attributes is decoded instead.
+    """
+    if offset is None:
+        return pydicom.dcmread(path).pixel_array
+
+    with open(path, "rb") as infile:
+        infile.seek(offset)
+        # encapsulated pixel data: tag, VR, reserved, undefined length, fragments
+        head = infile.read(12)
+        if head[:4] != b"\xe0\x7f\x10\x00":
+            raise ValueError(f"{path} has no pixel data at {offset}")
+        data = infile.read()
+
+    ds = pydicom.dataset.Dataset()
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    for keyword, value in attributes.items():
+        setattr(ds, keyword, value)
+    ds.PixelData = data
+    ds["PixelData"].is_undefined_length = True
+    return ds.pixel_array
+
+
+def _decode_into(
+    volume: "np.ndarray",
+    transfer_syntax: str,
+    attributes: dict,
+    tasks: List[Tuple[int, str, int]],
+):
+    for index, path, offset in tasks:
+        frame = volume[:, :, index]
+        frame[...] = _decode_frame(path, offset, transfer_syntax, attributes).T
+        mask_unused_bits(frame, attributes.get("BitsStored", 8 * frame.itemsize))
+
+
+def _decode_chunk(
+    volume_file: str,
+    shape: Tuple[int, int, int],
+    dtype: str,
+    transfer_syntax: str,
+    attributes: dict,
+    tasks: List[Tuple[int, str, int]],
+):
+    """decode frames in a worker into the shared mapping of the volume"""
+    volume = np.memmap(volume_file, dtype=dtype, mode="r+", shape=shape, order="F")
+    _decode_into(volume, transfer_syntax, attributes, tasks)
+    del volume
+
+
+def _shared_volume_file() -> str:
+    """new file for a volume shared with the workers, in memory if possible"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    handle, volume_file = tempfile.mkstemp(prefix="nekton-", suffix=".volume", dir=directory)
+    os.close(handle)
+    return volume_file
+
+
+def _remove_volume_file(volume_file: str, volume: "np.memmap") -> "np.ndarray":
+    """remove the file of a shared volume, the mapping stays valid on posix"""
+    try:
+        os.remove(volume_file)
+        return volume
+    except OSError:
+        # a mapped file cannot be removed on windows, the volume is copied first
+        copy = np.array(volume, order="F") if volume is not None else None
+        if volume is not None:
+            volume._mmap.close()
+        os.remove(volume_file)
+        return copy
+
+
+def decode_frames(
+    shape: Tuple[int, int, int],
+    dtype: "np.dtype",
+    dcmfiles: List[Path],
+    headers: List["Dataset"],
+    header_cache: DicomHeaderCache = None,
+    workers: int = None,
+) -> "np.ndarray":
+    """Decode the compressed pixel data of single-frame dicoms into the slices of a
+        volume. The frames are decoded by a process pool straight into a shared
+        mapping, which is returned as the volume without a copy, or serially with a
+        single worker.
+
+    Args:
+        shape (Tuple[int, int, int]): shape of the volume, along the dicom columns,
+         rows and slices
+        dtype (np.dtype): dtype of the volume
+        dcmfiles (List[Path]): dicom of every slice
+        headers (List[Dataset]): header of every slice
+        header_cache (DicomHeaderCache, optional): header index the headers were read
+         from; with it the workers read only the pixel data. Defaults to parsing the
+         dicoms again in the workers.
+        workers (int, optional): decoding processes. Defaults to all cores.
+
+    Returns:
+        np.ndarray: fortran ordered volume of the decoded frames
+    """
+    first = headers[0]
+    transfer_syntax = str(first.file_meta.TransferSyntaxUID)
+    attributes = {
+        keyword: first.get(keyword) for keyword in _PIXEL_ATTRIBUTES if keyword in first
+    }
+    tasks = [
+        (
+            index,
+            str(path),
+            header_cache.pixel_data_offset(path) if header_cache is not None else None,
+        )
+        for index, path in enumerate(dcmfiles)
+    ]
+
+    dtype = np.dtype(dtype)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        volume = np.empty(shape, dtype=dtype, order="F")
+        _decode_into(volume, transfer_syntax, attributes, tasks)
+        return volume
+
+    # the workers write into the pages of the returned volume, so the volume is
+    # held only once; the file is removed on success and on every error
+    volume_file = _shared_volume_file()
+    volume = None
+    try:
+        volume = np.memmap(volume_file, dtype=dtype, mode="w+", shape=shape, order="F")
+        chunks = [tasks[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _decode_chunk,
+                    volume_file,
+                    shape,
+                    dtype.str,
+                    transfer_syntax,
+                    attributes,
+                    chunk,
+                )
+                for chunk in chunks
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        volume = _remove_volume_file(volume_file, volume)
+    return volume
@@ -0,0 +1,305 @@
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
+
+from .geometry import dicom_slice_positions
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
+    from pydicom_seg.segmentation_dataset import SegmentationDataset
+
+np = lazy_import("numpy")
+pydicom = lazy_import("pydicom")
+pydicom_seg = lazy_import("pydicom_seg")
+
+# an encoded frame is either the bit-packed bytes of the frame or, if the frame
+# does not fill whole bytes, the boolean frame which is packed on finalize
+EncodedFrame = Union[bytes, "np.ndarray"]
+
+
+def encode_frame(frame: "np.ndarray") -> EncodedFrame:
+    """bit-pack a 2d binary frame, non-zero is foreground"""
+    frame = np.not_equal(frame, 0)
+    if frame.size % 8 != 0:
+        return frame.ravel()
+    return np.packbits(frame.ravel(), bitorder="little").tobytes()
+
+
+def slice_ranks(source_images: List["Dataset"]) -> List[int]:
+    """1-based rank of every DICOM along the slice normal, independent of the order
+        the DICOMs are listed in; ties and DICOMs without a position are ranked by
+        InstanceNumber and SOPInstanceUID
+
+    Args:
+        source_images (List[Dataset]): DICOMs of a single series
+
+    Returns:
+        List[int]: rank of each DICOM in the same order
+    """
+    keys = [
+        (int(ds.get("InstanceNumber", 0) or 0), str(ds.get("SOPInstanceUID", "")))
+        for ds in source_images
+    ]
+    if all(
+        "ImagePositionPatient" in ds and "ImageOrientationPatient" in ds
+        for ds in source_images
+    ):
+        positions = np.round(dicom_slice_positions(source_images), 4)
+        keys = [(position,) + key for position, key in zip(positions.tolist(), keys)]
+    order = sorted(range(len(source_images)), key=lambda i: keys[i])
+    ranks = [0] * len(order)
+    for rank, index in enumerate(order):
+        ranks[index] = rank + 1
+    return ranks
+
+
+class FrameItems:
+    """Functional group items that are the same for all frames of a segment or of
+    a source DICOM, created once and shared by the frames. Creating a pydicom
+    dataset costs far more than encoding a frame; writers of the same source
+    DICOMs, e.g. a single layer DICOM-SEG per slice, can share one instance.
+    """
+
+    def __init__(self):
+        self._segments: Dict[int, "Dataset"] = {}
+        # keyed by the id of the source, which is kept alive with its items
+        self._sources: Dict[int, Tuple["Dataset", "Dataset", Optional["Dataset"]]] = {}
+        self._code_sequences: Optional[Tuple["Dataset", "Dataset"]] = None
+
+    def segment(self, segment: int) -> "Dataset":
+        """SegmentIdentificationSequence item of a segment"""
+        if segment not in self._segments:
+            item = pydicom.Dataset()
+            item.ReferencedSegmentNumber = segment
+            self._segments[segment] = item
+        return self._segments[segment]
+
+    def source(self, source: "Dataset") -> Tuple["Dataset", Optional["Dataset"]]:
+        """DerivationImageSequence and PlanePositionSequence item of a source DICOM,
+        the latter is None for a source without ImagePositionPatient"""
+        if id(source) in self._sources:
+            return self._sources[id(source)][1:]
+        CodeSequence = pydicom_seg.dicom_utils.CodeSequence
+
+        if self._code_sequences is None:
+            self._code_sequences = (
+                CodeSequence("121322", "DCM", "Source image for image processing operation"),
+                CodeSequence("113076", "DCM", "Segmentation"),
+            )
+        purpose, derivation = self._code_sequences
+
+        reference = pydicom.Dataset()
+        reference.ReferencedSOPClassUID = source.SOPClassUID
+        reference.ReferencedSOPInstanceUID = source.SOPInstanceUID
+        reference.PurposeOfReferenceCodeSequence = purpose
+        derivation_image = pydicom.Dataset()
+        derivation_image.SourceImageSequence = [reference]
+        derivation_image.DerivationCodeSequence = derivation
+
+        plane_position = None
+        if "ImagePositionPatient" in source:
+            plane_position = pydicom.Dataset()
+            plane_position.ImagePositionPatient = source.ImagePositionPatient
+
+        self._sources[id(source)] = (source, derivation_image, plane_position)
+        return derivation_image, plane_position
+
+
+class SegFrameWriter:
+    """Incrementally encodes binary frames into a single DICOM-SEG.
+
+    In contrast to `pydicom_seg.MultiClassWriter` the segmentation is never
+    needed as a whole: frames are bit-packed as soon as they are added, one
+    per (segment, source DICOM) pair, and segments are allowed to overlap.
+
+    Args:
+        seg_map (Dataset): Dataset info extraced from the mapping json
+        source_images (List[Dataset]): DICOMs the frames can be linked to
+        segments (Iterable[int]): segment numbers that will be written
+        segments_overlap (str, optional): value of SegmentsOverlap. Defaults to "UNDEFINED".
+        items (FrameItems, optional): functional group items shared with other
+         writers of the same source DICOMs. Defaults to items of this writer.
+    """
+
+    def __init__(
+        self,
+        seg_map: "Dataset",
+        source_images: List["Dataset"],
+        segments: Iterable[int],
+        segments_overlap: str = "UNDEFINED",
+        items: FrameItems = None,
+    ):
+        segmentation_dataset = pydicom_seg.segmentation_dataset
+
+        reference = source_images[0]
+        self.source_images = source_images
+        self.segments_overlap = segments_overlap
+        self.dataset = segmentation_dataset.SegmentationDataset(
+            reference_dicom=reference,
+            rows=reference.Rows,
+            columns=reference.Columns,
+            segmentation_type=segmentation_dataset.SegmentationType.BINARY,
+        )
+        dimension_organization = pydicom_seg.dicom_utils.DimensionOrganizationSequence()
+        dimension_organization.add_dimension(
+            "ReferencedSegmentNumber", "SegmentIdentificationSequence"
+        )
+        dimension_organization.add_dimension(
+            "ImagePositionPatient", "PlanePositionSequence"
+        )
+        self.dataset.add_dimension_organization(dimension_organization)
+        pydicom_seg.writer_utils.copy_segmentation_template(
+            target=self.dataset,
+            template=seg_map,
+            segments=sorted(set(segments)),
+            skip_missing_segment=False,
+        )
+        self._declared_segments = set(
+            x.SegmentNumber for x in self.dataset.SegmentSequence
+        )
+        self._set_shared_functional_groups(reference)
+        self._frames: List[EncodedFrame] = []
+        # the sequences are only assembled on finalize, appending to them one
+        # item at a time is quadratic in the number of frames
+        self._frame_items: List["Dataset"] = []
+        self._referenced_sources: Dict[int, None] = {}
+        self.items = items or FrameItems()
+        self._slice_ranks = slice_ranks(source_images)
+
+    def _set_shared_functional_groups(self, reference: "Dataset"):
+        shared = pydicom.Dataset()
+        if "PixelSpacing" in reference:
+            shared.PixelMeasuresSequence = [pydicom.Dataset()]
+            pixel_measures = shared.PixelMeasuresSequence[0]
+            pixel_measures.PixelSpacing = reference.PixelSpacing
+            if "SliceThickness" in reference:
+                pixel_measures.SliceThickness = reference.SliceThickness
+        if "ImageOrientationPatient" in reference:
+            shared.PlaneOrientationSequence = [pydicom.Dataset()]
+            shared.PlaneOrientationSequence[
+                0
+            ].ImageOrientationPatient = reference.ImageOrientationPatient
+        self.dataset.SharedFunctionalGroupsSequence = pydicom.Sequence([shared])
+
+    @property
+    def number_of_frames(self) -> int:
+        return len(self._frames)
+
+    def encode(self, frame: "np.ndarray") -> EncodedFrame:
+        """bit-pack a binary frame, so it can be shared between writers
+
+        Args:
+            frame (np.ndarray): 2d frame with DICOM rows x columns, non-zero is foreground
+
+        Raises:
+            ValueError: frame does not match the DICOM rows x columns
+
+        Returns:
+            EncodedFrame: the encoded frame
+        """
+        if frame.shape != (self.dataset.Rows, self.dataset.Columns):
+            raise ValueError(
+                f"Invalid frame data shape {frame.shape}, expecting "
+                f"{self.dataset.Rows}x{self.dataset.Columns} images"
+            )
+        return encode_frame(frame)
+
+    def add_frame(
+        self,
+        frame: Union["np.ndarray", EncodedFrame],
+        segment: int,
+        source_index: int,
+    ) -> "Dataset":
+        """add a frame of a segment linked to one of the source DICOMs
+
+        Args:
+            frame (Union[np.ndarray, EncodedFrame]): 2d binary frame or a frame
+             returned by `encode`
+            segment (int): segment number the frame belongs to
+            source_index (int): index of the source DICOM of the frame
+
+        Raises:
+            IndexError: the segment is not declared in the mapping
+
+        Returns:
+            Dataset: the PerFrameFunctionalGroupsSequence item of the frame, its
+             segment, derivation and plane position items are shared with the
+             other frames of the same segment or source DICOM
+        """
+        if segment not in self._declared_segments:
+            raise IndexError(f"Segment {segment} not found in SegmentSequence")
+        if not isinstance(frame, bytes) and frame.ndim == 2:
+            frame = self.encode(frame)
+        self._frames.append(frame)
+        self._referenced_sources[source_index] = None
+        # only the frame content is created per frame
+        derivation_image, plane_position = self.items.source(
+            self.source_images[source_index]
+        )
+
+        frame_fg_item = pydicom.Dataset()
+        frame_fg_item.SegmentIdentificationSequence = [self.items.segment(segment)]
+        frame_fg_item.DerivationImageSequence = [derivation_image]
+        frame_fg_item.FrameContentSequence = [pydicom.Dataset()]
+        # spatial position of the source, stable however the files are listed
+        frame_fg_item.FrameContentSequence[0].DimensionIndexValues = [
+            segment,
+            self._slice_ranks[source_index],
+        ]
+        if plane_position is not None:
+            frame_fg_item.PlanePositionSequence = [plane_position]
+
+        self._frame_items.append(frame_fg_item)
+        return frame_fg_item
+
+    def _referenced_series(self) -> "pydicom.Sequence":
+        """ReferencedSeriesSequence of all the source DICOMs linked to a frame"""
+        # the items are collected in lists first, every access to a sequence of a
+        # dataset passes the dataset on to all items of the sequence
+        instances: Dict[str, List["Dataset"]] = {}
+        for source_index in self._referenced_sources:
+            source = self.source_images[source_index]
+            instance_item = pydicom.Dataset()
+            instance_item.ReferencedSOPClassUID = source.SOPClassUID
+            instance_item.ReferencedSOPInstanceUID = source.SOPInstanceUID
+            instances.setdefault(source.SeriesInstanceUID, []).append(instance_item)
+        series_items = []
+        for series_uid, instance_items in instances.items():
+            series_item = pydicom.Dataset()
+            series_item.SeriesInstanceUID = series_uid
+            series_item.ReferencedInstanceSequence = instance_items
+            series_items.append(series_item)
+        return pydicom.Sequence(series_items)
+
+    def finalize(self) -> "SegmentationDataset":
+        """write all frames added so far into the PixelData
+
+        Raises:
+            ValueError: no frame was added
+
+        Returns:
+            SegmentationDataset: created dicomseg file
+        """
+        if len(self._frames) == 0:
+            raise ValueError("Segmentation does not contain any labels")
+
+        if isinstance(self._frames[0], bytes):
+            pixel_data = b"".join(self._frames)
+        else:
+            pixel_data = np.packbits(
+                np.concatenate(self._frames), bitorder="little"
+            ).tobytes()
+        # PixelData has to be of even length
+        self.dataset.PixelData = pixel_data + b"\0" * (len(pixel_data) % 2)
+        self.dataset.NumberOfFrames = len(self._frames)
+        self.dataset.PerFrameFunctionalGroupsSequence = pydicom.Sequence(
+            self._frame_items
+        )
+        self.dataset.ReferencedSeriesSequence = self._referenced_series()
+        self.dataset.SegmentsOverlap = self.segments_overlap
+
+        # correct the acquition time and other info if neccesary
+        reference = self.source_images[0]
+        if "AcquisitionTime" in reference:
+            self.dataset.AcquisitionTime = reference.AcquisitionTime
+
+        return self.dataset
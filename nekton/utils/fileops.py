@@ -1,4 +1,47 @@
 import os
+from typing import List, Tuple
+
+
+def rename_files(renames: List[Tuple[str, str]]) -> List[str]:
+    """rename several files as one batch, either all of them are renamed or none.
+        Like a single rename, existing files at the new paths are replaced.
+
+    Args:
+        renames (List[Tuple[str, str]]): pairs of the full old and new paths
+
+    Raises:
+        RuntimeError: a file is missing, the new paths collide or renaming failed
+
+    Returns:
+        List[str]: full paths to the new files
+    """
+    renames = [(str(old), str(new)) for old, new in renames]
+    targets = [new for _, new in renames]
+
+    # validate the whole batch before touching a single file
+    for old, _ in renames:
+        if not os.path.exists(old):
+            raise RuntimeError(f"Unable to rename files: {old} does not exist")
+    # a file keeping its name may still be replaced by another one
+    renames = [(old, new) for old, new in renames if old != new]
+    moved_targets = [new for _, new in renames]
+    if len(set(moved_targets)) != len(moved_targets):
+        raise RuntimeError("Unable to rename files: duplicate target names")
+    sources = set(old for old, _ in renames)
+    for _, new in renames:
+        if new in sources:
+            raise RuntimeError(f"Unable to rename files: {new} is renamed itself")
+
+    done = []
+    try:
+        for old, new in renames:
+            os.replace(old, new)
+            done.append((old, new))
+    except Exception as err:
+        for old, new in reversed(done):
+            os.replace(new, old)
+        raise RuntimeError(f"Unable to rename files: {err}")
+    return targets
 
 
 def rename_file(complete_path: str, new_name: str) -> str:
@@ -16,11 +59,13 @@ def rename_file(complete_path: str, new_name: str) -> str:
     """
     try:
         new_name_wo_ext = os.path.splitext(new_name)[0]
-        file_name_wo_ext = os.path.splitext(os.path.basename(complete_path))[0]
-
-        new_name_path = complete_path.replace(file_name_wo_ext, new_name_wo_ext)
+        directory, file_name = os.path.split(complete_path)
+        file_name_wo_ext = os.path.splitext(file_name)[0]
 
-        os.rename(complete_path, new_name_path)
+        # only the file name is changed, the directory may contain the same stem
+        new_name_path = os.path.join(
+            directory, file_name.replace(file_name_wo_ext, new_name_wo_ext, 1)
+        )
     except Exception as err:
         raise RuntimeError(f"Unable to rename files: {err}")
-    return new_name_path
+    return rename_files([(complete_path, new_name_path)])[0]
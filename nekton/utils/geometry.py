@@ -0,0 +1,209 @@
+from typing import TYPE_CHECKING, List
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pydicom.dataset import Dataset
+
+np = lazy_import("numpy")
+
+# NifTi affines are in RAS, DICOM positions in LPS
+_RAS_TO_LPS = (-1.0, -1.0, 1.0)
+
+
+def dicom_slice_normal(dataset: "Dataset") -> "np.ndarray":
+    """normal of the image plane of a DICOM in patient (LPS) coordinates
+
+    Args:
+        dataset (Dataset): DICOM with ImageOrientationPatient
+
+    Returns:
+        np.ndarray: unit vector perpendicular to the rows and columns
+    """
+    orientation = np.asarray(dataset.ImageOrientationPatient, dtype=float)
+    return np.cross(orientation[:3], orientation[3:])
+
+
+def dicom_slice_positions(datasets: List["Dataset"]) -> "np.ndarray":
+    """position of every DICOM along the slice normal of the series
+
+    Args:
+        datasets (List[Dataset]): DICOMs of a single series
+
+    Returns:
+        np.ndarray: signed distance of each DICOM along the slice normal
+    """
+    normal = dicom_slice_normal(datasets[0])
+    positions = np.asarray(
+        [ds.ImagePositionPatient for ds in datasets], dtype=float
+    ).reshape(-1, 3)
+    return positions @ normal
+
+
+def nearest_slices(
+    sorted_positions: "np.ndarray", positions: "np.ndarray"
+) -> "np.ndarray":
+    """index of the nearest entry in a sorted array for every position
+
+    Args:
+        sorted_positions (np.ndarray): ascending slice positions
+        positions (np.ndarray): positions to be matched
+
+    Returns:
+        np.ndarray: index into `sorted_positions` for every position
+    """
+    if len(sorted_positions) == 1:
+        return np.zeros(len(positions), dtype=int)
+    idx = np.clip(np.searchsorted(sorted_positions, positions), 1, len(sorted_positions) - 1)
+    closer_left = np.abs(positions - sorted_positions[idx - 1]) <= np.abs(
+        positions - sorted_positions[idx]
+    )
+    return np.where(closer_left, idx - 1, idx)
+
+
+class SliceGeometry:
+    """Maps the slices of a NifTi volume onto the frames of a DICOM series.
+
+    The last axis of the NifTi is the slice axis. For every slice the index of
+    the matching source DICOM and the in-plane re-orientation of the slice to
+    DICOM rows x columns are stored.
+
+    Args:
+        slice_to_source (List[int]): index of the source DICOM for every NifTi slice
+        transpose (bool, optional): the first NifTi axis runs along the DICOM rows,
+         i.e. indexes the columns. Defaults to True.
+        flip_rows (bool, optional): the DICOM rows run opposite to the NifTi. Defaults to False.
+        flip_cols (bool, optional): the DICOM columns run opposite to the NifTi. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        slice_to_source: List[int],
+        transpose: bool = True,
+        flip_rows: bool = False,
+        flip_cols: bool = False,
+    ):
+        self.slice_to_source = slice_to_source
+        self.transpose = transpose
+        self.flip_rows = flip_rows
+        self.flip_cols = flip_cols
+
+    @classmethod
+    def from_affine(
+        cls,
+        affine: "np.ndarray",
+        n_slices: int,
+        datasets: List["Dataset"],
+        tolerance: float = 0.1,
+    ) -> "SliceGeometry":
+        """match the NifTi slices to the DICOMs using the patient coordinates
+
+        Args:
+            affine (np.ndarray): 4x4 voxel to RAS affine of the NifTi
+            n_slices (int): number of slices in the NifTi
+            datasets (List[Dataset]): DICOMs of the source series
+            tolerance (float, optional): allowed deviation of the slice positions
+             as a fraction of the slice spacing. Defaults to 0.1.
+
+        Raises:
+            ValueError: NifTi and DICOM geometry do not match
+
+        Returns:
+            SliceGeometry: the mapping between the NifTi and the DICOMs
+        """
+        try:
+            orientation = np.asarray(datasets[0].ImageOrientationPatient, dtype=float)
+            source_positions = dicom_slice_positions(datasets)
+        except (AttributeError, TypeError, ValueError) as err:
+            raise ValueError(f"DICOMs carry no patient geometry: {err}")
+
+        lps_affine = np.asarray(affine, dtype=float)[:3] * np.reshape(_RAS_TO_LPS, (3, 1))
+        axes = lps_affine[:, :3] / np.linalg.norm(lps_affine[:, :3], axis=0)
+        row_dir, col_dir = orientation[:3], orientation[3:]
+        normal = np.cross(row_dir, col_dir)
+
+        # in-plane NifTi axes have to be parallel to the DICOM rows and columns
+        dots = axes[:, :2].T @ np.stack([row_dir, col_dir], axis=1)
+        if np.allclose(np.abs(dots), np.eye(2), atol=1e-3):
+            transpose, flip_cols, flip_rows = True, dots[0, 0] < 0, dots[1, 1] < 0
+        elif np.allclose(np.abs(dots), np.eye(2)[::-1], atol=1e-3):
+            transpose, flip_rows, flip_cols = False, dots[0, 1] < 0, dots[1, 0] < 0
+        else:
+            raise ValueError("NifTi is not aligned with the DICOM image plane")
+
+        spacing = abs(lps_affine[:, 2] @ normal)
+        if spacing == 0:
+            raise ValueError("NifTi slice axis lies within the DICOM image plane")
+
+        # match every slice to the nearest DICOM along the normal
+        slice_positions = (
+            lps_affine[:, 3] + np.outer(np.arange(n_slices), lps_affine[:, 2])
+        ) @ normal
+        order = np.argsort(source_positions)
+        nearest = nearest_slices(source_positions[order], slice_positions)
+        error = np.abs(source_positions[order][nearest] - slice_positions)
+        if np.any(error > tolerance * spacing):
+            raise ValueError("NifTi slices do not match the DICOM slice positions")
+
+        return cls(order[nearest].tolist(), transpose, flip_rows, flip_cols)
+
+    def to_frame(self, nifti_slice: "np.ndarray") -> "np.ndarray":
+        """re-orient a single NifTi slice to DICOM rows x columns
+
+        Args:
+            nifti_slice (np.ndarray): 2d slice of the NifTi
+
+        Returns:
+            np.ndarray: view of the slice in DICOM frame layout
+        """
+        frame = nifti_slice.T if self.transpose else nifti_slice
+        if self.flip_rows:
+            frame = frame[::-1, :]
+        if self.flip_cols:
+            frame = frame[:, ::-1]
+        return frame
+
+    def to_slice(self, frame: "np.ndarray") -> "np.ndarray":
+        """inverse of `to_frame`, re-orient a DICOM frame to a NifTi slice
+
+        Args:
+            frame (np.ndarray): 2d frame with DICOM rows x columns
+
+        Returns:
+            np.ndarray: view of the frame in NifTi slice layout
+        """
+        if self.flip_cols:
+            frame = frame[:, ::-1]
+        if self.flip_rows:
+            frame = frame[::-1, :]
+        return frame.T if self.transpose else frame
+
+
+def dicom_series_affine(datasets: List["Dataset"]) -> "np.ndarray":
+    """RAS affine of a DICOM series with the NifTi axes running along the
+        DICOM columns, rows and slices (in this order)
+
+    Args:
+        datasets (List[Dataset]): DICOMs of a single series sorted along the slice normal
+
+    Returns:
+        np.ndarray: 4x4 voxel to RAS affine
+    """
+    first = datasets[0]
+    orientation = np.asarray(first.ImageOrientationPatient, dtype=float)
+    row_spacing, col_spacing = (float(x) for x in first.PixelSpacing)
+    origin = np.asarray(first.ImagePositionPatient, dtype=float)
+
+    if len(datasets) > 1:
+        last = np.asarray(datasets[-1].ImagePositionPatient, dtype=float)
+        slice_step = (last - origin) / (len(datasets) - 1)
+    else:
+        slice_step = dicom_slice_normal(first) * float(first.get("SliceThickness") or 1)
+
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * col_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = origin
+    affine[:3] *= np.reshape(_RAS_TO_LPS, (3, 1))
+    return affine
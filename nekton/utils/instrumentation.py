@@ -0,0 +1,110 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List
+
+# a hook receives every finished span and every counter increment as an event
+Hook = Callable[[dict], None]
+
+
+class Instrumentation:
+    def __init__(self, hooks: List[Hook] = None):
+        """Timing spans and counters of the phases of a conversion. The aggregates
+            are always kept, the single events are only passed on to the hooks.
+
+        Args:
+            hooks (List[Hook], optional): callables receiving the events. Defaults
+             to no hooks.
+        """
+        self.hooks = list(hooks or [])
+        self.spans: Dict[str, dict] = {}
+        self.counters: Dict[str, int] = {}
+        self._open_spans: List[str] = []
+
+    def add_hook(self, hook: Hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[None]:
+        """time the enclosed block as a phase of the conversion
+
+        Args:
+            name (str): name of the phase
+            **attributes: additional information passed on with the event
+        """
+        parent = self._open_spans[-1] if self._open_spans else None
+        self._open_spans.append(name)
+        error = None
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as err:
+            error = type(err).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._open_spans.pop()
+
+            stats = self.spans.setdefault(
+                name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+            if self.hooks:
+                event = dict(attributes, type="span", name=name, seconds=seconds)
+                event["parent"] = parent
+                if error is not None:
+                    event["error"] = error
+                self._emit(event)
+
+    def count(self, name: str, value: int = 1, **attributes):
+        """increment a counter
+
+        Args:
+            name (str): name of the counter
+            value (int, optional): increment. Defaults to 1.
+            **attributes: additional information passed on with the event
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.hooks:
+            self._emit(dict(attributes, type="counter", name=name, value=value))
+
+    def count_bytes(self, name: str, *paths: Path):
+        """increment a counter by the size of files, e.g. `bytes_read`"""
+        self.count(name, sum(os.path.getsize(path) for path in paths))
+
+    def summary(self) -> dict:
+        """aggregated seconds per phase and the totals of all counters"""
+        return {
+            "spans": {name: dict(stats) for name, stats in self.spans.items()},
+            "counters": dict(self.counters),
+        }
+
+    def _emit(self, event: dict):
+        event["timestamp"] = time.time()
+        for hook in self.hooks:
+            hook(event)
+
+
+class JsonLinesExporter:
+    def __init__(self, path: Path):
+        """Hook appending every event as a line of json to a local file
+
+        Args:
+            path (Path): path of the metrics file
+        """
+        self.path = Path(path)
+
+    def __call__(self, event: dict):
+        with open(self.path, "a") as outfile:
+            outfile.write(json.dumps(event, default=str) + "\n")
+
+
+def read_json_lines(path: Path) -> List[dict]:
+    """read the events written by a `JsonLinesExporter`"""
+    with open(path) as infile:
+        return [json.loads(line) for line in infile if line.strip()]
@@ -1,9 +1,12 @@
 import json
-import jsonschema
 import os
 
+from .lazy import lazy_import
 
-def _create_validator() -> jsonschema.Draft4Validator:
+jsonschema = lazy_import("jsonschema")
+
+
+def _create_validator() -> "jsonschema.Draft4Validator":
     """Create a JSON validator instance from dcmqi schema files.
     In order to allow offline usage, the required schemas a pre-loaded from the
     dcmqi repository located at `nekton/externals/dcmqi`.
@@ -32,21 +35,31 @@ def _create_validator() -> jsonschema.Draft4Validator:
     )
 
 
-def write_json(dictionary: dict, path: str) -> str:
-    """write a dictionary as json
+def write_json(dictionary: dict, path: str, indent: int = 4) -> str:
+    """write a dictionary as json. The file is written next to the target and
+        moved in place, so that readers never see a partially written json.
 
     Args:
         dictionary (dict): a dictionary that has to be converted to json
         path (str): path to output json file
+        indent (int, optional): indentation of the json, None writes it compactly
+         in a single line. Defaults to 4.
 
     Returns:
         str: path to output json file
     """
+    partial = f"{path}.{os.getpid()}.partial"
     try:
-        json_object = json.dumps(dictionary, indent=4)
-        with open(path, "w") as outfile:
+        if indent is None:
+            json_object = json.dumps(dictionary, separators=(",", ":"))
+        else:
+            json_object = json.dumps(dictionary, indent=indent)
+        with open(partial, "w") as outfile:
             outfile.write(json_object)
+        os.replace(partial, path)
     except Exception as err:
+        if os.path.exists(partial):
+            os.remove(partial)
         raise RuntimeError(f"Unable to write json: {err}")
 
     return path
@@ -0,0 +1,37 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module which is only imported on first attribute access
+
+    Args:
+        name (str): fully qualified name of the module to be imported
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def _load(self) -> types.ModuleType:
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """defer the import of a heavy dependency until it is actually used
+
+    Args:
+        name (str): fully qualified name of the module
+
+    Returns:
+        types.ModuleType: a module which is imported on first attribute access
+    """
+    return LazyModule(name)
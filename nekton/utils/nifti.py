@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from nibabel.nifti1 import Nifti1Image
+
+np = lazy_import("numpy")
+nib = lazy_import("nibabel")
+
+
+def cached_nifti(niftifile: Path, cache_dir: Path) -> Path:
+    """Decompress a `.nii.gz` once into an uncompressed `.nii` in the cache directory.
+        The cached file is keyed by the path, size and modification time of the
+        source, so a changed source is decompressed again and replaces the copy of
+        its previous version.
+
+    Args:
+        niftifile (Path): path to the compressed nifti
+        cache_dir (Path): directory of the decompressed files
+
+    Returns:
+        Path: path to the uncompressed nifti
+    """
+    stat = os.stat(niftifile)
+    source = hashlib.sha1(os.path.abspath(niftifile).encode()).hexdigest()[:16]
+    version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:8]
+    prefix = f"{Path(niftifile).name.split('.')[0]}_{source}_"
+    cached = Path(os.path.join(cache_dir, f"{prefix}{version}.nii"))
+
+    if not cached.exists():
+        os.makedirs(cache_dir, exist_ok=True)
+        # decompress next to the target, so that a half-written file is never used
+        partial = Path(f"{cached}.{os.getpid()}.partial")
+        with gzip.open(niftifile, "rb") as infile, open(partial, "wb") as outfile:
+            shutil.copyfileobj(infile, outfile, 1 << 20)
+        os.replace(partial, cached)
+
+        # copies of previous versions of the source are never read again
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name.endswith(".nii") and name != cached.name:
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:  # e.g. still mapped on windows
+                    pass
+    return cached
+
+
+def load_nifti(niftifile: Path, cache_dir: Path = None) -> "Nifti1Image":
+    """Load a nifti with its voxels memory-mapped read-only if it is uncompressed
+
+    Args:
+        niftifile (Path): path to the nifti
+        cache_dir (Path, optional): decompress a `.nii.gz` once into this directory
+         and map the uncompressed copy. Defaults to reading `.nii.gz` directly.
+
+    Returns:
+        Nifti1Image: the image, the voxels are only read on access
+    """
+    if cache_dir is not None and str(niftifile).endswith(".gz"):
+        niftifile = cached_nifti(niftifile, cache_dir)
+    return nib.load(str(niftifile), mmap="r")
+
+
+def is_memory_mapped(img: "Nifti1Image") -> bool:
+    """True if the voxels of the image can be viewed through a memory map"""
+    filename = img.get_filename()
+    return filename is not None and not filename.endswith(".gz")
+
+
+def label_volume(img: "Nifti1Image") -> "np.ndarray":
+    """All voxels of a label map in their stored dtype, without a float cast.
+        For uncompressed files this is a view into the memory map, so that only
+        the pages of the slices that are accessed are read.
+
+    Args:
+        img (Nifti1Image): the label map
+
+    Returns:
+        np.ndarray: the voxels of the label map
+    """
+    return np.asanyarray(img.dataobj)
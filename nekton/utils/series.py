@@ -0,0 +1,325 @@
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from .decode import can_decode, decode_frames, mask_unused_bits
+from .dicom import DicomHeaderCache
+from .geometry import dicom_series_affine, dicom_slice_normal, dicom_slice_positions
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from nibabel.nifti1 import Nifti1Image
+    from pydicom.dataset import Dataset
+
+np = lazy_import("numpy")
+nib = lazy_import("nibabel")
+pydicom = lazy_import("pydicom")
+
+# uncompressed transfer syntaxes whose pixel data is read straight into the volume
+NATIVE_TRANSFER_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+
+# dicom attributes copied into the json sidecar, named like in the dcm2niix sidecar
+_SIDECAR_ATTRIBUTES = OrderedDict(
+    [
+        ("Modality", "Modality"),
+        ("Manufacturer", "Manufacturer"),
+        ("ManufacturersModelName", "ManufacturerModelName"),
+        ("PatientPosition", "PatientPosition"),
+        ("SoftwareVersions", "SoftwareVersions"),
+        ("SeriesDescription", "SeriesDescription"),
+        ("ProtocolName", "ProtocolName"),
+        ("ScanOptions", "ScanOptions"),
+        ("ImageType", "ImageType"),
+        ("SeriesNumber", "SeriesNumber"),
+        ("AcquisitionNumber", "AcquisitionNumber"),
+        ("ConvolutionKernel", "ConvolutionKernel"),
+        ("SliceThickness", "SliceThickness"),
+        ("KVP", "KVP"),
+        ("XRayExposure", "Exposure"),
+    ]
+)
+
+
+def _same(values: list) -> bool:
+    return all(value == values[0] for value in values[1:])
+
+
+def native_support(headers: List["Dataset"]) -> str:
+    """Check if a series can be converted in-process: single-frame grayscale slices,
+        uncompressed or in a transfer syntax pydicom can decode, on a regular grid,
+        without echoes or repeated positions
+
+    Args:
+        headers (List[Dataset]): headers of the dicoms of a single series
+
+    Returns:
+        str: the reason why the series is not supported, empty if it is
+    """
+    if len(headers) == 0:
+        return "no dicoms"
+    for header in headers:
+        transfer_syntax = getattr(header.get("file_meta"), "TransferSyntaxUID", None)
+        if transfer_syntax not in NATIVE_TRANSFER_SYNTAXES and not (
+            transfer_syntax and can_decode(transfer_syntax)
+        ):
+            return f"transfer syntax {transfer_syntax}"
+        if int(header.get("NumberOfFrames", 1) or 1) != 1:
+            return "multi-frame dicom"
+        if int(header.get("SamplesPerPixel", 1)) != 1:
+            return "color dicom"
+        if int(header.get("BitsAllocated", 0)) not in (8, 16, 32):
+            return f"{header.get('BitsAllocated')} bits allocated"
+        for attribute in ["ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing"]:
+            if attribute not in header:
+                return f"missing {attribute}"
+
+    for attribute in [
+        "Rows",
+        "Columns",
+        "BitsAllocated",
+        "BitsStored",
+        "PixelRepresentation",
+        "RescaleSlope",
+        "RescaleIntercept",
+        "EchoNumbers",
+    ]:
+        if not _same([header.get(attribute) for header in headers]):
+            return f"varying {attribute}"
+    transfer_syntaxes = [str(header.file_meta.TransferSyntaxUID) for header in headers]
+    if not _same(transfer_syntaxes):
+        return "varying TransferSyntaxUID"
+    for attribute in ["ImageOrientationPatient", "PixelSpacing"]:
+        values = np.asarray([header.get(attribute) for header in headers], dtype=float)
+        if not np.allclose(values, values[0], atol=1e-4):
+            return f"varying {attribute}"
+
+    positions = np.sort(dicom_slice_positions(headers))
+    if len(positions) > 1:
+        steps = np.diff(positions)
+        if np.any(steps < 1e-3):
+            return "repeated slice positions"
+        if not np.allclose(steps, steps.mean(), rtol=1e-2):
+            return "irregular slice spacing"
+
+        # the slices have to be stacked along the normal, i.e. without gantry tilt
+        ordered = sort_series(headers)
+        step = np.asarray(ordered[-1].ImagePositionPatient, dtype=float) - np.asarray(
+            ordered[0].ImagePositionPatient, dtype=float
+        )
+        normal = dicom_slice_normal(ordered[0])
+        if not np.allclose(step / np.linalg.norm(step), normal, atol=1e-3):
+            return "slices not stacked along the normal"
+    return ""
+
+
+def group_series(
+    dcmfiles: List[Path], headers: List["Dataset"]
+) -> Dict[str, Tuple[List[Path], List["Dataset"]]]:
+    """group dicoms by SeriesInstanceUID, keeping the order of the first appearance"""
+    series: Dict[str, Tuple[List[Path], List["Dataset"]]] = OrderedDict()
+    for path, header in zip(dcmfiles, headers):
+        paths, series_headers = series.setdefault(
+            str(header.get("SeriesInstanceUID", "")), ([], [])
+        )
+        paths.append(path)
+        series_headers.append(header)
+    return series
+
+
+def sort_series(headers: List["Dataset"]) -> List["Dataset"]:
+    """headers of a series sorted along the slice normal"""
+    order = np.argsort(dicom_slice_positions(headers), kind="stable")
+    return [headers[i] for i in order]
+
+
+def _volume_dtype(header: "Dataset") -> "np.dtype":
+    kind = "i" if int(header.get("PixelRepresentation", 0)) == 1 else "u"
+    return np.dtype(f"<{kind}{int(header.BitsAllocated) // 8}")
+
+
+def _pixel_data_offset(path: Path, nbytes: int) -> int:
+    """Offset of the pixel data values in an uncompressed dicom. The pixel data is
+        usually the last element, so it is looked up from the end of the file and
+        the header is only parsed when it is not.
+    """
+    length = nbytes + nbytes % 2
+    size = os.path.getsize(path)
+    with open(path, "rb") as infile:
+        # explicit VR: tag, VR, reserved, length; implicit VR: tag, length
+        for element_header in (12, 8):
+            start = size - length - element_header
+            if start < 0:
+                continue
+            infile.seek(start)
+            head = infile.read(element_header)
+            if (
+                head[:4] == PIXEL_DATA_TAG
+                and int.from_bytes(head[-4:], "little") == length
+            ):
+                return start + element_header
+
+        infile.seek(0)
+        pydicom.dcmread(infile, stop_before_pixels=True)
+        start = infile.tell()
+        head = infile.read(12)
+    if head[:4] != PIXEL_DATA_TAG:
+        raise ValueError(f"{path} has no pixel data")
+    return start + (12 if head[4:6] in (b"OB", b"OW") else 8)
+
+
+def read_series_volume(
+    dcmfiles: List[Path],
+    headers: List["Dataset"],
+    workers: int = None,
+    header_cache: DicomHeaderCache = None,
+) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Read a single-frame series into a preallocated volume. Uncompressed slices
+        are read by threads straight from the files into the volume, whose memory
+        layout matches the dicom frames, so the pixel data is not copied. Compressed
+        slices are decoded in parallel by `decode_frames`.
+
+    Args:
+        dcmfiles (List[Path]): dicoms of a single series supported by `native_support`
+        headers (List[Dataset]): headers of the dicoms in the same order
+        workers (int, optional): number of reading threads or decoding processes.
+         Defaults to up to 8 threads or all cores.
+        header_cache (DicomHeaderCache, optional): header index the headers were read
+         from, locates the compressed pixel data. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the stored values with axes along the dicom
+         columns, rows and slices, and the 4x4 RAS affine of the volume
+    """
+    order = np.argsort(dicom_slice_positions(headers), kind="stable")
+    dcmfiles = [dcmfiles[i] for i in order]
+    headers = [headers[i] for i in order]
+    first = headers[0]
+    rows, cols = int(first.Rows), int(first.Columns)
+
+    # fortran order: every slice is a contiguous rows x columns frame
+    shape = (cols, rows, len(dcmfiles))
+    if str(first.file_meta.TransferSyntaxUID) not in NATIVE_TRANSFER_SYNTAXES:
+        volume = decode_frames(
+            shape, _volume_dtype(first), dcmfiles, headers, header_cache, workers
+        )
+        return volume, dicom_series_affine(headers)
+    volume = np.empty(shape, dtype=_volume_dtype(first), order="F")
+
+    nbytes = rows * cols * volume.itemsize
+    bits_stored = int(first.get("BitsStored", 8 * volume.itemsize))
+
+    def read_slice(index: int):
+        frame = volume[:, :, index]
+        offset = _pixel_data_offset(dcmfiles[index], nbytes)
+        with open(dcmfiles[index], "rb") as infile:
+            infile.seek(offset)
+            if infile.readinto(memoryview(frame.reshape(-1, order="A")).cast("B")) != nbytes:
+                raise ValueError(f"{dcmfiles[index]} has truncated pixel data")
+        mask_unused_bits(frame, bits_stored)
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(read_slice, range(len(dcmfiles))))
+
+    return volume, dicom_series_affine(headers)
+
+
+def series_nifti(
+    volume: "np.ndarray", affine: "np.ndarray", header: "Dataset"
+) -> "Nifti1Image":
+    """NifTi of a volume with the rescale of the series in the scaling fields. The
+        rows are stored bottom-up as dcm2niix does, so that the voxel arrays of both
+        engines are the same.
+
+    Args:
+        volume (np.ndarray): values with axes along the dicom columns, rows and slices
+        affine (np.ndarray): 4x4 RAS affine of the volume
+        header (Dataset): header of a dicom of the series
+
+    Returns:
+        Nifti1Image: the image with the affine in the qform and sform
+    """
+    flip = np.eye(4)
+    flip[1, 1], flip[1, 3] = -1, volume.shape[1] - 1
+    affine = affine @ flip
+    img = nib.Nifti1Image(volume[:, ::-1], affine)
+    img.set_sform(affine, code=1)
+    img.set_qform(affine, code=1)
+    img.header.set_xyzt_units("mm", "sec")
+    slope = float(header.get("RescaleSlope", 1) or 1)
+    intercept = float(header.get("RescaleIntercept", 0) or 0)
+    if slope != 1 or intercept != 0:
+        img.header.set_slope_inter(slope, intercept)
+    return img
+
+
+def _sanitize(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9.\-]", "_", value.strip())
+
+
+def dcm2niix_name(directory: Path, header: "Dataset") -> str:
+    """name dcm2niix gives the output of a series by default (`%f_%p_%t_%s`)
+
+    Args:
+        directory (Path): directory of the dicoms
+        header (Dataset): header of a dicom of the series
+
+    Returns:
+        str: folder, protocol, study date and time and series number
+    """
+    protocol = header.get("ProtocolName") or header.get("SeriesDescription") or ""
+    study_time = str(header.get("StudyTime", "")).split(".")[0]
+    parts = [
+        os.path.basename(os.path.normpath(str(directory))),
+        str(protocol),
+        str(header.get("StudyDate", "")) + study_time,
+        str(header.get("SeriesNumber", "")),
+    ]
+    return "_".join(_sanitize(part) for part in parts if part)
+
+
+def _json_value(value):
+    """plain json value of a dicom element value, e.g. of a DS or IS"""
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+
+
+def bids_sidecar(header: "Dataset", software_version: str) -> dict:
+    """BIDS-like sidecar of a series with the keys of the dcm2niix sidecar
+
+    Args:
+        header (Dataset): header of a dicom of the series
+        software_version (str): version of the converting software
+
+    Returns:
+        dict: the sidecar
+    """
+    sidecar = {}
+    for key, keyword in _SIDECAR_ATTRIBUTES.items():
+        value = header.get(keyword)
+        if value is None or value == "":
+            continue
+        if isinstance(value, pydicom.multival.MultiValue):
+            sidecar[key] = [_json_value(item) for item in value]
+        else:
+            sidecar[key] = _json_value(value)
+
+    acquisition_time = str(header.get("AcquisitionTime", ""))
+    if len(acquisition_time) >= 6:
+        sidecar["AcquisitionTime"] = (
+            f"{acquisition_time[:2]}:{acquisition_time[2:4]}:{acquisition_time[4:6]}"
+            f"{acquisition_time[6:] or '.000000'}"
+        )
+    sidecar["ImageOrientationPatientDICOM"] = [
+        float(value) for value in header.ImageOrientationPatient
+    ]
+    sidecar["ConversionSoftware"] = "nekton"
+    sidecar["ConversionSoftwareVersion"] = software_version
+    return sidecar
@@ -0,0 +1,137 @@
+import datetime
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .fileops import rename_files
+from .json_helpers import read_json, write_json
+
+PROVENANCE_KEY = "NektonProvenance"
+
+
+class SidecarManager:
+    def __init__(self, indent: int = None):
+        """Collects the json sidecars of the outputs of a conversion in memory, so
+            that every sidecar is written once, compactly and atomically, and renames
+            the outputs together with their sidecars as one batch.
+
+        Args:
+            indent (int, optional): indentation of the written sidecars. Defaults to
+             compact jsons.
+        """
+        self.indent = indent
+        self._sidecars: Dict[str, dict] = {}
+
+    @staticmethod
+    def sidecar_path(output: Path) -> Path:
+        """path of the json sidecar of an output, e.g. `scan.json` for `scan.nii.gz`"""
+        directory, name = os.path.split(str(output))
+        for suffix in [".nii.gz", ".nii"]:
+            if name.endswith(suffix):
+                name = name[: -len(suffix)]
+                break
+        else:
+            name = os.path.splitext(name)[0]
+        return Path(os.path.join(directory, name + ".json"))
+
+    def load(self, output: Path) -> dict:
+        """the sidecar of an output, read from disk on first access
+
+        Args:
+            output (Path): path to the output
+
+        Returns:
+            dict: the metadata of the sidecar, changes are kept in memory until `write`
+        """
+        path = str(self.sidecar_path(output))
+        if path not in self._sidecars:
+            self._sidecars[path] = read_json(path) if os.path.exists(path) else {}
+        return self._sidecars[path]
+
+    def __len__(self) -> int:
+        return len(self._sidecars)
+
+    def set(self, output: Path, metadata: dict) -> dict:
+        """replace the sidecar of an output, e.g. of a new output"""
+        self._sidecars[str(self.sidecar_path(output))] = metadata
+        return metadata
+
+    def update(self, output: Path, metadata: dict) -> dict:
+        """merge metadata into the sidecar of an output"""
+        sidecar = self.load(output)
+        sidecar.update(metadata)
+        return sidecar
+
+    def add_provenance(
+        self, output: Path, converter: str, timings: Dict[str, float] = None
+    ) -> dict:
+        """add the nekton version, the converter and the phase timings to a sidecar
+
+        Args:
+            output (Path): path to the output
+            converter (str): name of the converter that created the output
+            timings (Dict[str, float], optional): seconds per phase of the conversion.
+             Defaults to no timings.
+
+        Returns:
+            dict: the updated sidecar
+        """
+        from .. import __version__
+
+        provenance = {
+            "Version": __version__,
+            "Converter": converter,
+            "Created": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        if timings:
+            provenance["Timings"] = {
+                phase: round(seconds, 6) for phase, seconds in timings.items()
+            }
+        return self.update(output, {PROVENANCE_KEY: provenance})
+
+    def rename(self, renames: List[Tuple[Path, Path]]) -> List[Path]:
+        """rename outputs and their existing sidecars as one batch
+
+        Args:
+            renames (List[Tuple[Path, Path]]): pairs of the old and new output paths
+
+        Raises:
+            RuntimeError: renaming failed, no file is renamed
+
+        Returns:
+            List[Path]: the new output paths
+        """
+        batch = []
+        moved = []
+        for old, new in renames:
+            batch.append((old, new))
+            old_sidecar = str(self.sidecar_path(old))
+            new_sidecar = str(self.sidecar_path(new))
+            if old_sidecar == new_sidecar:
+                continue
+            if os.path.exists(old_sidecar):
+                batch.append((old_sidecar, new_sidecar))
+            moved.append((old_sidecar, new_sidecar))
+
+        rename_files(batch)
+
+        # pop all entries first, a new path may be the old path of another output
+        sidecars = {
+            old: self._sidecars.pop(old) for old, _ in moved if old in self._sidecars
+        }
+        for old, new in moved:
+            if old in sidecars:
+                self._sidecars[new] = sidecars[old]
+        return [Path(new) for _, new in renames]
+
+    def write(self) -> List[Path]:
+        """write every sidecar in memory once and forget it
+
+        Returns:
+            List[Path]: paths of the written sidecars
+        """
+        written = []
+        for path, sidecar in self._sidecars.items():
+            written.append(Path(write_json(sidecar, path, self.indent)))
+        self._sidecars.clear()
+        return written
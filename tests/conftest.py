@@ -1,5 +1,7 @@
 # add root-dir to sys path for tests
 import sys
+import os
+import glob
 import site
 import pytest
 
@@ -10,6 +12,9 @@ parent_dir = f"{d(d(abspath(__file__)))}"
 sys.path.append(f"{parent_dir}")
 from nekton.dcm2nii import Dcm2Nii  # noqa
 from nekton.nii2dcm import Nii2DcmSeg  # noqa
+from nekton.dcmseg2nii import DcmSeg2Nii  # noqa
+from nekton.nii2gsps import Nii2Gsps  # noqa
+from nekton.utils.json_helpers import read_json, write_json  # noqa
 
 
 @pytest.fixture
@@ -25,3 +30,47 @@ def converter_nii():
 @pytest.fixture
 def converter_dcmseg():
     yield Nii2DcmSeg()
+
+
+@pytest.fixture
+def converter_segnii():
+    yield DcmSeg2Nii()
+
+
+@pytest.fixture
+def converter_gsps():
+    yield Nii2Gsps()
+
+
+@pytest.fixture
+def overlapping_masks(site_package_path, tmp_path):
+    # two overlapping binary masks of the CT5N series and a mapping with a segment each
+    import nibabel as nib
+    import numpy as np
+
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = [path for path in glob.glob(dir_dcms) if ".json" not in path]
+
+    seg_img = nib.load("tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz")
+    seg = np.asanyarray(seg_img.dataobj)
+    masks = [seg == 1, np.zeros_like(seg)]
+    masks[1][2:8, 2:8, 3:] = 1
+    path_masks = []
+    for i, mask in enumerate(masks):
+        path_masks.append(str(tmp_path / f"mask_{i}.nii.gz"))
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), seg_img.affine), path_masks[-1])
+
+    mapping = read_json("tests/test_data/sample_segmentation/mapping.json")
+    second_segment = dict(mapping["segmentAttributes"][0][0], labelID=2)
+    mapping["segmentAttributes"][0].append(second_segment)
+    path_mapping = write_json(mapping, str(tmp_path / "mapping.json"))
+
+    yield {
+        "dcmfiles": path_dcms,
+        "masks": masks,
+        "segfiles": path_masks,
+        "mapping": path_mapping,
+        "affine": seg_img.affine,
+    }
@@ -7,9 +7,21 @@ from os.path import abspath
 from os.path import dirname as d
 
 from nekton.utils.json_helpers import read_json, write_json, verify_label_dcmqii_json
-from nekton.utils.dicom import is_file_a_dicom
+from nekton.utils.dicom import (
+    DicomHeaderCache,
+    deduplicate_dicoms,
+    header_memory,
+    is_file_a_dicom,
+    read_header,
+)
 from nekton.utils.bin import make_exec_bin, run_bin
-from nekton.utils.fileops import rename_file
+from nekton.utils.fileops import rename_file, rename_files
+from nekton.utils.instrumentation import (
+    Instrumentation,
+    JsonLinesExporter,
+    read_json_lines,
+)
+from nekton.utils.sidecar import SidecarManager
 
 
 @pytest.mark.utilstest
@@ -131,3 +143,157 @@ def test_0_6_schema_validator():
     not_existing_json = "./not-existing.json"
     with pytest.raises(NameError):
         verify_label_dcmqii_json(not_existing_json)
+
+
+@pytest.mark.utilstest
+def test_0_7_instrumentation(tmp_path):
+    events = []
+    metrics_file = tmp_path / "metrics.jsonl"
+    instrumentation = Instrumentation(hooks=[events.append])
+    instrumentation.add_hook(JsonLinesExporter(metrics_file))
+
+    with instrumentation.span("outer"):
+        for i in range(3):
+            with instrumentation.span("inner", slice=i):
+                pass
+    instrumentation.count("bytes_read", 10)
+    instrumentation.count("bytes_read", 5)
+    with pytest.raises(ValueError):
+        with instrumentation.span("failing"):
+            raise ValueError()
+
+    summary = instrumentation.summary()
+    assert summary["spans"]["inner"]["count"] == 3
+    assert summary["spans"]["outer"]["seconds"] >= summary["spans"]["inner"]["seconds"]
+    assert summary["counters"] == {"bytes_read": 15}
+
+    assert [event["name"] for event in events] == ["inner"] * 3 + [
+        "outer",
+        "bytes_read",
+        "bytes_read",
+        "failing",
+    ]
+    assert events[0]["parent"] == "outer" and events[0]["slice"] == 0
+    assert events[-1]["error"] == "ValueError"
+    assert read_json_lines(metrics_file) == events
+
+
+@pytest.mark.utilstest
+def test_0_8_dicom_header_cache(site_package_path, tmp_path):
+    import shutil
+
+    dicom_file = os.path.join(site_package_path, "pydicom/data/test_files/CT_small.dcm")
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"{i}.dcm"))
+        shutil.copy(dicom_file, paths[-1])
+
+    cache = DicomHeaderCache(max_entries=2)
+    header = cache.read(paths[0])
+    assert "PixelData" not in header
+    assert cache.read(paths[0]) is header
+    assert paths[0] in cache and paths[1] not in cache
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+
+    # least recently used entries are evicted beyond the limits
+    cache.read(paths[1])
+    cache.read(paths[2])
+    assert paths[0] not in cache and len(cache) == 2
+    assert cache.stats["evictions"] == 1
+
+    # a modified file is read again
+    os.utime(paths[2], (0, 0))
+    assert paths[2] not in cache
+    assert cache.read(paths[2]) is not header
+    assert cache.stats["misses"] == 4
+
+    small_cache = DicomHeaderCache(max_bytes=1)
+    small_cache.read(paths[0])
+    assert small_cache.stats["entries"] == 0 and small_cache.stats["bytes"] == 0
+
+    # the cap bounds the memory of the parsed headers, not their size in the files
+    header, size = read_header(paths[0])
+    assert header_memory(header) > 10 * size
+    small_cache = DicomHeaderCache(max_bytes=10 * size)
+    small_cache.read(paths[0])
+    assert small_cache.stats["entries"] == 0
+
+
+@pytest.mark.utilstest
+def test_0_9_rename_files_batch(tmp_path):
+    # the directory contains the stem of the file
+    directory = tmp_path / "scan"
+    directory.mkdir()
+    file_path = directory / "scan.txt"
+    file_path.write_text("")
+    out_path = rename_file(str(file_path), "renamed")
+    assert out_path == str(directory / "renamed.txt")
+    assert os.path.exists(out_path)
+
+    first, second = tmp_path / "a.txt", tmp_path / "b.txt"
+    first.write_text("a")
+    second.write_text("b")
+
+    # colliding targets are refused before anything is renamed
+    with pytest.raises(RuntimeError):
+        rename_files([(first, tmp_path / "c.txt"), (second, tmp_path / "c.txt")])
+    assert first.exists() and second.exists()
+
+    # a failing rename rolls back the renames of the batch
+    with pytest.raises(RuntimeError):
+        rename_files(
+            [(first, tmp_path / "c.txt"), (second, tmp_path / "missing" / "d.txt")]
+        )
+    assert first.exists() and second.exists()
+    assert not (tmp_path / "c.txt").exists()
+
+
+@pytest.mark.utilstest
+def test_0_10_sidecar_manager(tmp_path):
+    output = tmp_path / "scan_5.nii.gz"
+    output.write_text("")
+    sidecar = tmp_path / "scan_5.json"
+    write_json({"Modality": "CT"}, sidecar)
+    assert SidecarManager.sidecar_path(output) == sidecar
+
+    sidecars = SidecarManager()
+    sidecars.update(output, {"SeriesNumber": 5})
+    sidecars.add_provenance(output, "Dcm2Nii", {"dcm2niix": 0.5})
+    new_output = tmp_path / "renamed_5.nii.gz"
+    assert sidecars.rename([(output, new_output)]) == [new_output]
+    assert not output.exists() and not sidecar.exists()
+
+    # nothing is written before `write`, then once and compactly
+    assert read_json(tmp_path / "renamed_5.json") == {"Modality": "CT"}
+    assert sidecars.write() == [tmp_path / "renamed_5.json"]
+    assert sidecars.write() == []
+    metadata = read_json(tmp_path / "renamed_5.json")
+    assert metadata["Modality"] == "CT" and metadata["SeriesNumber"] == 5
+    assert metadata["NektonProvenance"]["Converter"] == "Dcm2Nii"
+    assert metadata["NektonProvenance"]["Timings"] == {"dcm2niix": 0.5}
+    assert "\n" not in (tmp_path / "renamed_5.json").read_text()
+
+
+@pytest.mark.utilstest
+def test_0_11_deduplicate_dicoms(site_package_path, tmp_path):
+    import shutil
+    import pydicom
+
+    dicom_file = os.path.join(site_package_path, "pydicom/data/test_files/CT_small.dcm")
+    paths = [tmp_path / name for name in ["a.dcm", "b.dcm", "c.dcm", "d.dcm"]]
+    for path in paths[:3]:
+        shutil.copy(dicom_file, path)
+    # same instance, different content
+    ds = pydicom.dcmread(dicom_file)
+    ds.SeriesDescription = "reprocessed"
+    ds.save_as(str(paths[3]))
+    headers = [pydicom.dcmread(path, stop_before_pixels=True) for path in paths]
+
+    unique, unique_headers, dropped = deduplicate_dicoms(paths, headers)
+    assert unique == paths[:1] and unique_headers == headers[:1]
+    assert dropped == {path: paths[0] for path in paths[1:]}
+
+    # only byte-identical copies are dropped by content
+    unique, _, dropped = deduplicate_dicoms(paths, headers, content_hash=True)
+    assert unique == [paths[0], paths[3]]
+    assert dropped == {paths[1]: paths[0], paths[2]: paths[0]}
@@ -1,5 +1,17 @@
 import pytest
+import glob
 import os
+import shutil
+import tempfile
+import nibabel as nib
+import numpy as np
+import pydicom
+from nekton.benchmarks import make_study
+from nekton.dcm2nii import Dcm2Nii
+from nekton.utils.dicom import DicomHeaderCache, read_header
+from nekton.utils.instrumentation import Instrumentation
+from nekton.utils.json_helpers import read_json
+from nekton.utils.sidecar import SidecarManager
 
 
 @pytest.mark.dcm2nii
@@ -81,3 +93,187 @@ def test_2_4_check_store_new_loc(converter_nii, site_package_path):
     assert len(output_paths) == 1
     assert str(out_dir) in str(output_paths[0])
     [os.remove(path) for path in output_paths]
+
+
+@pytest.mark.dcm2nii
+def test_2_5_check_instrumentation(site_package_path):
+    path_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/"
+    )
+    events = []
+    converter = Dcm2Nii(instrumentation=Instrumentation(hooks=[events.append]))
+
+    output_paths = converter.run(path_dcms, name="instrumented")
+    spans = [event["name"] for event in events if event["type"] == "span"]
+    assert spans == ["discovery", "slice_thickness_check", "dcm2niix", "rename"]
+
+    counters = converter.instrumentation.summary()["counters"]
+    assert counters["dicoms_found"] == 5
+    # only the headers are read before dcm2niix
+    dcmfiles = converter.get_all_dicoms(path_dcms)
+    headers_size = sum(read_header(path)[1] for path in dcmfiles)
+    files_size = sum(os.path.getsize(path) for path in dcmfiles)
+    assert counters["bytes_read"] == headers_size < files_size
+    assert counters["bytes_written"] == sum(os.path.getsize(p) for p in output_paths)
+    [os.remove(path) for path in output_paths]
+
+
+@pytest.mark.dcm2nii
+def test_2_6_check_provenance_sidecar(site_package_path, tmp_path):
+    path_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/"
+    )
+    converter = Dcm2Nii(provenance=True)
+
+    output_paths = converter.run(path_dcms, tmp_path, "provenance")
+    assert len(output_paths) == 1
+    assert os.path.basename(output_paths[0]).startswith("provenance_")
+
+    # the dcm2niix sidecar is renamed along and extended
+    sidecar_path = SidecarManager.sidecar_path(output_paths[0])
+    sidecar = read_json(sidecar_path)
+    assert "Modality" in sidecar
+    provenance = sidecar["NektonProvenance"]
+    assert provenance["Converter"] == "Dcm2Nii"
+    assert set(provenance["Timings"]) == {
+        "discovery",
+        "slice_thickness_check",
+        "dcm2niix",
+        "rename",
+    }
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [os.path.basename(output_paths[0]), sidecar_path.name]
+    )
+
+
+@pytest.mark.dcm2nii
+def test_2_7_check_native_engine(site_package_path, tmp_path):
+    study = tmp_path / "CT5N"
+    shutil.copytree(
+        os.path.join(
+            site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/"
+        ),
+        study,
+        ignore=shutil.ignore_patterns("*.json", "*.nii*"),
+    )
+    (tmp_path / "dcm2niix").mkdir()
+    (tmp_path / "native").mkdir()
+
+    reference = Dcm2Nii().run(study, tmp_path / "dcm2niix", "ct")
+    instrumentation = Instrumentation()
+    converter = Dcm2Nii(instrumentation=instrumentation, engine="native")
+    output_paths = converter.run(study, tmp_path / "native", "ct")
+    assert [path.name for path in output_paths] == [path.name for path in reference]
+    assert "dcm2niix" not in instrumentation.summary()["spans"]
+
+    # same voxels stored in the same order as dcm2niix
+    expected = nib.load(str(reference[0]))
+    converted = nib.load(str(output_paths[0]))
+    assert np.allclose(converted.affine, expected.affine, atol=1e-3)
+    assert np.array_equal(np.asanyarray(converted.dataobj), np.asanyarray(expected.dataobj))
+    assert np.array_equal(converted.get_fdata(), expected.get_fdata())
+
+    sidecar = read_json(SidecarManager.sidecar_path(output_paths[0]))
+    assert sidecar["Modality"] == "CT" and sidecar["SeriesNumber"] == 5
+    assert sidecar["ConversionSoftware"] == "nekton"
+
+    with pytest.raises(ValueError):
+        Dcm2Nii(engine="unknown")
+
+
+@pytest.mark.dcm2nii
+def test_2_8_check_native_fallback(tmp_path):
+    study = make_study(tmp_path / "study", 5, rows=16, cols=16)
+    # irregular slice spacing is left to dcm2niix
+    ds = pydicom.dcmread(study["dcmfiles"][-1])
+    ds.ImagePositionPatient = [0.0, 0.0, 20.0]
+    ds.save_as(study["dcmfiles"][-1])
+
+    instrumentation = Instrumentation()
+    converter = Dcm2Nii(instrumentation=instrumentation, engine="native", compress=False)
+    output_paths = converter.run(study["dicom_dir"], tmp_path)
+    assert all(path.name.endswith(".nii") for path in output_paths)
+    assert instrumentation.summary()["counters"]["native_fallbacks"] == 1
+    assert "dcm2niix" in instrumentation.summary()["spans"]
+
+
+@pytest.mark.dcm2nii
+def test_2_9_check_native_compressed(tmp_path):
+    study = make_study(tmp_path / "study", 6, rows=16, cols=24)
+    compressed = tmp_path / "rle"
+    compressed.mkdir()
+    for path in study["dcmfiles"]:
+        ds = pydicom.dcmread(path)
+        ds.compress(pydicom.uid.RLELossless)
+        ds.save_as(str(compressed / path.name))
+    (tmp_path / "uncompressed").mkdir()
+    expected = Dcm2Nii(engine="native").run(
+        study["dicom_dir"], tmp_path / "uncompressed"
+    )
+
+    # decoded in a pool of workers, with and without the header index
+    for header_cache in [None, DicomHeaderCache()]:
+        instrumentation = Instrumentation()
+        converter = Dcm2Nii(
+            instrumentation=instrumentation,
+            engine="native",
+            workers=2,
+            header_cache=header_cache,
+        )
+        output_paths = converter.run(compressed, tmp_path)
+        assert "dcm2niix" not in instrumentation.summary()["spans"]
+        assert np.array_equal(
+            np.asanyarray(nib.load(str(output_paths[0])).dataobj),
+            np.asanyarray(nib.load(str(expected[0])).dataobj),
+        )
+
+    # the shared volume is removed, also when a worker fails
+    from nekton.utils.decode import decode_frames
+
+    def volume_files():
+        return [
+            path
+            for directory in ["/dev/shm", tempfile.gettempdir()]
+            for path in glob.glob(os.path.join(directory, "nekton-*.volume"))
+        ]
+
+    before = volume_files()
+    dcmfiles = sorted(compressed.iterdir())
+    headers = [pydicom.dcmread(path, stop_before_pixels=True) for path in dcmfiles]
+    with pytest.raises(Exception):
+        decode_frames(
+            (24, 16, len(dcmfiles)), np.int16, dcmfiles[:-1] + [tmp_path / "missing"],
+            headers, workers=2,
+        )
+    assert volume_files() == before
+
+
+@pytest.mark.dcm2nii
+def test_2_10_check_deduplication(tmp_path):
+    study = make_study(tmp_path / "study", 5, rows=16, cols=16)
+    (tmp_path / "reference").mkdir()
+    expected = Dcm2Nii().run(study["dicom_dir"], tmp_path / "reference")
+    # repeated pulls of the same instances under other file names
+    for path in study["dcmfiles"][:2]:
+        shutil.copy(path, study["dicom_dir"] / f"copy_{path.name}")
+
+    for engine in ["dcm2niix", "native"]:
+        out_directory = tmp_path / engine
+        out_directory.mkdir()
+        instrumentation = Instrumentation()
+        converter = Dcm2Nii(
+            instrumentation=instrumentation, engine=engine, deduplicate="uid"
+        )
+        output_paths = converter.run(study["dicom_dir"], out_directory)
+        assert len(output_paths) == 1
+        assert instrumentation.summary()["counters"]["duplicates_dropped"] == 2
+        assert sorted(path.name for path in converter.duplicates) == sorted(
+            f"copy_{path.name}" for path in study["dcmfiles"][:2]
+        )
+        converted, reference = nib.load(str(output_paths[0])), nib.load(str(expected[0]))
+        assert np.allclose(converted.affine, reference.affine, atol=1e-3)
+        assert np.array_equal(converted.get_fdata(), reference.get_fdata())
+    assert "dcm2niix" not in instrumentation.summary()["spans"]
+
+    with pytest.raises(ValueError):
+        Dcm2Nii(deduplicate="filename")
@@ -1,6 +1,8 @@
 import pytest
 import os
 import glob
+import shutil
+import numpy as np
 import nibabel as nib
 import pydicom
 from pydicom.dataset import Dataset
@@ -50,12 +52,14 @@ def test_3_2_check_check_all_dicoms(converter_dcmseg, site_package_path):
 
 @pytest.mark.nii2dcmseg
 def test_3_3_check_create_dicomseg(site_package_path, converter_dcmseg):
+    from nekton.utils.dicomseg import SegFrameWriter
+
     mapping = converter_dcmseg._load_segmap(
         "tests/test_data/sample_segmentation/mapping.json"
     )
     seg = nib.load(
         "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
-    ).get_fdata()[..., -2:-1]
+    ).get_fdata()[..., -2]
 
     dir_dcms = os.path.join(
         site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
@@ -63,16 +67,41 @@ def test_3_3_check_create_dicomseg(site_package_path, converter_dcmseg):
     path_dcm = [path for path in glob.glob(dir_dcms) if ".json" not in path][0]
     dcm_ds = pydicom.dcmread(path_dcm)
 
-    out_ds = converter_dcmseg._create_dicomseg(mapping, seg, dcm_ds)
+    writer = SegFrameWriter(mapping, [dcm_ds], [1], segments_overlap="NO")
+    writer.add_frame(seg.T == 1, 1, 0)
+    out_ds = writer.finalize()
 
     assert type(out_ds) is SegmentationDataset
     assert dcm_ds.AcquisitionTime == out_ds.AcquisitionTime
+    assert out_ds.NumberOfFrames == 1
 
 
 @pytest.mark.nii2dcmseg
-def test_3_4_check_multilabel_converter(converter_dcmseg):
-    with pytest.raises(NotImplementedError):
-        converter_dcmseg.multilabel_converter([], [])
+def test_3_4_check_multilabel_converter(converter_dcmseg, overlapping_masks):
+    path_dcms = overlapping_masks["dcmfiles"]
+    path_masks = overlapping_masks["segfiles"]
+    path_mapping = overlapping_masks["mapping"]
+
+    dcmsegs = converter_dcmseg.multilabel_converter(path_masks, path_mapping, path_dcms)
+    assert len(dcmsegs) == 1
+
+    dcmseg = pydicom.dcmread(dcmsegs[0])
+    assert len(dcmseg.SegmentSequence) == 2
+    assert dcmseg.NumberOfFrames == 4 + 2
+    assert dcmseg.SegmentsOverlap == "UNDEFINED"
+    # every frame references the source dicom at the same position
+    source_uids = {
+        pydicom.dcmread(path).SOPInstanceUID: pydicom.dcmread(path).ImagePositionPatient
+        for path in path_dcms
+    }
+    for frame in dcmseg.PerFrameFunctionalGroupsSequence:
+        uid = frame.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        position = frame.PlanePositionSequence[0].ImagePositionPatient
+        assert source_uids[uid] == position
+
+    # one mask per segment of the mapping is needed
+    with pytest.raises(AssertionError):
+        converter_dcmseg.multilabel_converter(path_masks[:1], path_mapping, path_dcms)
 
 
 @pytest.mark.nii2dcmseg
@@ -135,3 +164,316 @@ def test_3_6_check_check_all_labels(converter_dcmseg):
         converter_dcmseg._check_all_lables(fake_mapping, seg)
 
     converter_dcmseg._check_all_lables(mapping, seg)
+
+
+@pytest.mark.nii2dcmseg
+@pytest.mark.parametrize("multi_layer, n_outputs", [(False, 4), (True, 1)])
+def test_3_8_check_multiclass_converter_slabs(
+    site_package_path, converter_dcmseg, multi_layer, n_outputs
+):
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = [path for path in glob.glob(dir_dcms) if ".json" not in path]
+    path_mapping = "tests/test_data/sample_segmentation/mapping.json"
+    path_seg_nifti = "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+
+    dcmsegs = converter_dcmseg.multiclass_converter(
+        path_seg_nifti, path_mapping, path_dcms, multiLayer=multi_layer, slab_size=2
+    )
+
+    assert len(dcmsegs) == n_outputs
+    for dcmseg in dcmsegs:
+        assert pydicom.dcmread(dcmseg).SegmentationType == "BINARY"
+        # like the output of the whole volume, labels never overlap
+        assert pydicom.dcmread(dcmseg).SegmentsOverlap == "NO"
+        os.remove(dcmseg)
+    # the .nii.gz is decompressed once instead of once per slab
+    assert converter_dcmseg.instrumentation.summary()["spans"]["decompress"]["count"] == 1
+
+
+@pytest.mark.nii2dcmseg
+@pytest.mark.parametrize("slab_size", [None, 5])
+def test_3_9_check_multiclass_converter_slabs_roundtrip(
+    converter_dcmseg, converter_segnii, tmp_path, slab_size
+):
+    from nekton.benchmarks import make_study
+
+    study = make_study(tmp_path, 12, rows=16, cols=24, density="dense")
+    dcmsegs = converter_dcmseg.multiclass_converter(
+        study["segfile"],
+        study["mapping"],
+        study["dcmfiles"],
+        multiLayer=True,
+        slab_size=slab_size,
+    )
+    nifti, _ = converter_segnii.run(dcmsegs[0], study["dcmfiles"], tmp_path, "roundtrip")
+
+    expected = np.asanyarray(nib.load(study["segfile"]).dataobj)
+    assert np.array_equal(np.asanyarray(nib.load(nifti).dataobj), expected)
+
+
+@pytest.mark.nii2dcmseg
+def test_3_10_check_memory_mapped_segmentation(
+    site_package_path, converter_dcmseg, tmp_path
+):
+    from nekton.nii2dcm import Nii2DcmSeg
+    from nekton.utils.nifti import cached_nifti, label_volume, load_nifti
+
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = [path for path in glob.glob(dir_dcms) if ".json" not in path]
+    path_mapping = "tests/test_data/sample_segmentation/mapping.json"
+    path_seg_nifti = "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+    seg_img = nib.load(path_seg_nifti)
+
+    # uncompressed files are mapped without a dtype conversion
+    path_seg_nii = str(tmp_path / "CT5N_segmentation.nii")
+    nib.save(seg_img, path_seg_nii)
+    seg = label_volume(load_nifti(path_seg_nii))
+    assert isinstance(seg, np.memmap)
+    assert seg.dtype == seg_img.get_data_dtype()
+    assert not seg.flags.writeable
+
+    dcmsegs = converter_dcmseg.multiclass_converter(path_seg_nii, path_mapping, path_dcms)
+    assert len(dcmsegs) == 4
+
+    # compressed files are decompressed once into the cache
+    cache_dir = tmp_path / "cache"
+    converter = Nii2DcmSeg(cache_dir=cache_dir)
+    converter.multiclass_converter(path_seg_nifti, path_mapping, path_dcms)
+    cached = os.listdir(cache_dir)
+    assert len(cached) == 1 and cached[0].endswith(".nii")
+    mtime = os.path.getmtime(cache_dir / cached[0])
+
+    dcmsegs = converter.multiclass_converter(
+        path_seg_nifti, path_mapping, path_dcms, multiLayer=True, slab_size=2
+    )
+    assert len(dcmsegs) == 1
+    assert os.listdir(cache_dir) == cached
+    assert os.path.getmtime(cache_dir / cached[0]) == mtime
+    assert np.array_equal(
+        label_volume(load_nifti(path_seg_nifti, cache_dir)), np.asanyarray(seg_img.dataobj)
+    )
+
+    # a changed source replaces the copy of its previous version
+    changed_nifti = str(tmp_path / "CT5N_segmentation.nii.gz")
+    shutil.copy(path_seg_nifti, changed_nifti)
+    first = cached_nifti(changed_nifti, cache_dir)
+    os.utime(changed_nifti, ns=(0, os.stat(changed_nifti).st_mtime_ns + 10 ** 9))
+    second = cached_nifti(changed_nifti, cache_dir)
+    assert first != second
+    assert sorted(os.listdir(cache_dir)) == sorted(cached + [second.name])
+    for path in glob.glob("tests/test_data/sample_segmentation/dicomseg/*"):
+        os.remove(path)
+
+
+@pytest.mark.nii2dcmseg
+def test_3_11_check_multiclass_converter_layouts(converter_dcmseg, tmp_path):
+    from nekton.benchmarks import make_study
+
+    study = make_study(tmp_path, 10, rows=16, cols=16, density="sparse")
+    layouts = ("single", "multi")
+    dcmsegs = converter_dcmseg.multiclass_converter(
+        study["segfile"], study["mapping"], study["dcmfiles"], layouts=layouts
+    )
+    single = converter_dcmseg.multiclass_converter(
+        study["segfile"], study["mapping"], study["dcmfiles"], layouts=["single"]
+    )
+
+    # every layout is stored in its own folder
+    assert len(dcmsegs) == len(single) + 1
+    assert {os.path.basename(os.path.dirname(path)) for path in dcmsegs} == set(layouts)
+    assert os.path.basename(os.path.dirname(dcmsegs[-1])) == "multi"
+    n_frames = sum(pydicom.dcmread(path).NumberOfFrames for path in dcmsegs[:-1])
+    assert pydicom.dcmread(dcmsegs[-1]).NumberOfFrames == n_frames
+
+    # the layouts of one pass are the same as converted on their own
+    separate = {os.path.basename(path): pydicom.dcmread(path) for path in single}
+    multi = converter_dcmseg.multiclass_converter(
+        study["segfile"], study["mapping"], study["dcmfiles"], layouts=["multi"]
+    )
+    separate["multi"] = pydicom.dcmread(multi[0])
+    for path in dcmsegs:
+        dcmseg = pydicom.dcmread(path)
+        layout = os.path.basename(os.path.dirname(path))
+        expected = separate["multi" if layout == "multi" else os.path.basename(path)]
+        assert dcmseg.PixelData == expected.PixelData
+        assert (
+            dcmseg.PerFrameFunctionalGroupsSequence
+            == expected.PerFrameFunctionalGroupsSequence
+        )
+
+    with pytest.raises(ValueError):
+        converter_dcmseg.multiclass_converter(
+            study["segfile"], study["mapping"], study["dcmfiles"], layouts=["stacked"]
+        )
+
+
+@pytest.mark.nii2dcmseg
+def test_3_12_check_header_cache(site_package_path):
+    from nekton.nii2dcm import Nii2DcmSeg
+    from nekton.utils.dicom import DicomHeaderCache
+
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = [path for path in glob.glob(dir_dcms) if ".json" not in path]
+    path_mapping = "tests/test_data/sample_segmentation/mapping.json"
+    path_seg_nifti = "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+
+    cache = DicomHeaderCache()
+    converter = Nii2DcmSeg(header_cache=cache)
+    for multi_layer in [False, True, False]:
+        dcmsegs = converter.multiclass_converter(
+            path_seg_nifti, path_mapping, path_dcms, multiLayer=multi_layer
+        )
+        for dcmseg in dcmsegs:
+            os.remove(dcmseg)
+
+    # every source dicom is only read once, the cached headers stay untouched
+    assert cache.stats["misses"] == len(path_dcms)
+    assert cache.stats["hits"] > 0
+    assert converter.instrumentation.summary()["counters"]["header_cache_misses"] == len(
+        path_dcms
+    )
+
+
+@pytest.mark.nii2dcmseg
+def test_3_13_check_create_dicomseg_keeps_source(site_package_path, converter_dcmseg):
+    from nekton.utils.dicomseg import SegFrameWriter
+
+    mapping = converter_dcmseg._load_segmap(
+        "tests/test_data/sample_segmentation/mapping.json"
+    )
+    seg = nib.load(
+        "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+    ).get_fdata()[..., -2]
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcm = [path for path in glob.glob(dir_dcms) if ".json" not in path][0]
+    dcm_ds = pydicom.dcmread(path_dcm, stop_before_pixels=True)
+    del dcm_ds.ImagePositionPatient
+
+    writer = SegFrameWriter(mapping, [dcm_ds], [1])
+    frame_item = writer.add_frame(seg.T == 1, 1, 0)
+    writer.finalize()
+    assert "PlanePositionSequence" not in frame_item
+    assert "ImagePositionPatient" not in dcm_ds
+
+
+@pytest.mark.nii2dcmseg
+def test_3_14_check_deduplicate_source_dicoms(tmp_path):
+    import shutil
+    from nekton.benchmarks import make_study
+    from nekton.nii2dcm import Nii2DcmSeg
+
+    study = make_study(tmp_path, 6, rows=16, cols=16, density="dense")
+    copies = []
+    for path in study["dcmfiles"][:3]:
+        copies.append(tmp_path / f"copy_{path.name}")
+        shutil.copy(path, copies[-1])
+    dcmfiles = copies + list(study["dcmfiles"])
+
+    with pytest.raises(AssertionError):
+        Nii2DcmSeg().multiclass_converter(
+            study["segfile"], study["mapping"], dcmfiles, slab_size=2
+        )
+
+    for slab_size in [None, 2]:
+        converter = Nii2DcmSeg(deduplicate="content")
+        dcmsegs = converter.multiclass_converter(
+            study["segfile"], study["mapping"], dcmfiles, slab_size=slab_size
+        )
+        assert len(dcmsegs) > 0
+        assert sorted(converter.duplicates) == sorted(study["dcmfiles"][:3])
+        assert converter.instrumentation.summary()["counters"]["duplicates_dropped"] == 3
+
+    # a binary mask per label
+    seg_img = nib.load(str(study["segfile"]))
+    seg = np.asanyarray(seg_img.dataobj)
+    path_masks = []
+    for label in range(1, 4):
+        path_masks.append(str(tmp_path / f"mask_{label}.nii.gz"))
+        nib.save(
+            nib.Nifti1Image((seg == label).astype(np.uint8), seg_img.affine),
+            path_masks[-1],
+        )
+    with pytest.raises(AssertionError):
+        Nii2DcmSeg().multilabel_converter(path_masks, study["mapping"], dcmfiles)
+    converter = Nii2DcmSeg(deduplicate="uid")
+    dcmsegs = converter.multilabel_converter(path_masks, study["mapping"], dcmfiles)
+    assert len(dcmsegs) == 1
+    assert sorted(converter.duplicates) == sorted(study["dcmfiles"][:3])
+
+
+@pytest.mark.nii2dcmseg
+def test_3_15_check_dimension_index_along_normal(site_package_path, converter_dcmseg):
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = sorted(path for path in glob.glob(dir_dcms) if ".json" not in path)
+    path_mapping = "tests/test_data/sample_segmentation/mapping.json"
+    path_seg_nifti = "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+
+    indices = []
+    for dcmfiles in [path_dcms, path_dcms[::-1]]:
+        dcmsegs = converter_dcmseg.multiclass_converter(
+            path_seg_nifti, path_mapping, dcmfiles, layouts=["multi"]
+        )
+        dcmseg = pydicom.dcmread(dcmsegs[0])
+        os.remove(dcmsegs[0])
+        indices.append(
+            [
+                (
+                    frame.DerivationImageSequence[0]
+                    .SourceImageSequence[0]
+                    .ReferencedSOPInstanceUID,
+                    list(frame.FrameContentSequence[0].DimensionIndexValues),
+                    frame.PlanePositionSequence[0].ImagePositionPatient[2],
+                )
+                for frame in dcmseg.PerFrameFunctionalGroupsSequence
+            ]
+        )
+
+    # the index of a frame does not depend on the order of the input files
+    assert sorted(indices[0]) == sorted(indices[1])
+    # and grows along the slices
+    by_position = sorted(indices[0], key=lambda frame: frame[2])
+    ranks = [index[1] for _, index, _ in by_position]
+    assert ranks == sorted(ranks)
+
+
+@pytest.mark.nii2dcmseg
+def test_3_16_check_multiclass_converter_slab_size_invariant(converter_dcmseg, tmp_path):
+    from nekton.benchmarks import make_study
+
+    study = make_study(tmp_path, 8, rows=16, cols=24, density="dense")
+    outputs = []
+    for slab_size in [None, 3]:
+        dcmsegs = converter_dcmseg.multiclass_converter(
+            study["segfile"],
+            study["mapping"],
+            study["dcmfiles"],
+            slab_size=slab_size,
+            layouts=["single", "multi"],
+        )
+        outputs.append([(path, pydicom.dcmread(path)) for path in dcmsegs])
+        shutil.rmtree(os.path.dirname(os.path.dirname(dcmsegs[0])))
+
+    # the slab size only bounds the memory, the dicomsegs are the same
+    whole, slabs = outputs
+    assert [path for path, _ in whole] == [path for path, _ in slabs]
+    for (_, expected), (_, dcmseg) in zip(whole, slabs):
+        assert (dcmseg.Rows, dcmseg.Columns) == (16, 24)
+        assert dcmseg.NumberOfFrames == expected.NumberOfFrames
+        assert dcmseg.PixelData == expected.PixelData
+        for keyword in [
+            "SegmentSequence",
+            "SharedFunctionalGroupsSequence",
+            "PerFrameFunctionalGroupsSequence",
+            "ReferencedSeriesSequence",
+        ]:
+            assert dcmseg[keyword] == expected[keyword]
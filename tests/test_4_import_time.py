@@ -0,0 +1,57 @@
+import pytest
+import subprocess
+import sys
+
+from os.path import abspath
+from os.path import dirname as d
+
+# budget for the cumulative import time of a nekton module in microseconds,
+# generous enough for slow CI runners but far below the cost of the heavy deps
+IMPORT_TIME_THRESHOLD_US = 150000
+HEAVY_DEPENDENCIES = ["SimpleITK", "pydicom_seg", "nibabel", "jsonschema", "numpy"]
+# `-X importtime` and the lazy module attributes (PEP 562) need python 3.7
+requires_py37 = pytest.mark.skipif(sys.version_info < (3, 7), reason="needs python 3.7")
+
+
+def _import_times(statement: str) -> dict:
+    """run an import statement in a fresh interpreter with `-X importtime`
+
+    Returns:
+        dict: cumulative import time in us for every imported module
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=d(d(abspath(__file__))),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.benchmark
+@requires_py37
+@pytest.mark.parametrize("module", ["nekton", "nekton.dcm2nii", "nekton.nii2dcm"])
+def test_4_1_import_time_threshold(module):
+    times = _import_times(f"import {module}")
+
+    for dependency in HEAVY_DEPENDENCIES:
+        assert dependency not in times, f"{dependency} imported eagerly by {module}"
+    assert times[module] < IMPORT_TIME_THRESHOLD_US
+
+
+@pytest.mark.benchmark
+@requires_py37
+def test_4_2_lazy_converter_access():
+    times = _import_times("from nekton import Dcm2Nii")
+    # only the dependencies of the requested converter are loaded
+    assert "nekton.utils.bin" in times
+    assert "nekton.nii2dcm" not in times
+    for dependency in HEAVY_DEPENDENCIES:
+        assert dependency not in times
@@ -0,0 +1,90 @@
+import pytest
+import os
+import numpy as np
+import nibabel as nib
+import pydicom
+from nekton.utils.json_helpers import read_json, verify_label_dcmqii_json
+
+
+@pytest.fixture
+def overlapping_dcmseg(converter_dcmseg, overlapping_masks):
+    # multi segment dicomseg from two overlapping binary masks
+    dcmseg = converter_dcmseg.multilabel_converter(
+        overlapping_masks["segfiles"],
+        overlapping_masks["mapping"],
+        overlapping_masks["dcmfiles"],
+    )[0]
+    yield (
+        dcmseg,
+        overlapping_masks["dcmfiles"],
+        overlapping_masks["masks"],
+        overlapping_masks["affine"],
+    )
+
+
+@pytest.mark.dcmseg2nii
+def test_5_1_check_end2end_dcmseg_to_nifti(converter_segnii, overlapping_dcmseg, tmp_path):
+    dcmseg, path_dcms, masks, affine = overlapping_dcmseg
+
+    out_nifti, out_json = converter_segnii.run(dcmseg, path_dcms, tmp_path, "decoded")
+    assert os.path.exists(out_nifti)
+    assert verify_label_dcmqii_json(out_json)
+    labels = [attr["labelID"] for attr in read_json(out_json)["segmentAttributes"][0]]
+    assert labels == [1, 2]
+
+    # same voxels in patient space, the higher segment wins where they overlap
+    expected = np.where(masks[1], 2, np.where(masks[0], 1, 0)).astype(np.uint8)
+    expected = nib.as_closest_canonical(nib.Nifti1Image(expected, affine))
+    decoded = nib.as_closest_canonical(nib.load(out_nifti))
+    assert np.allclose(decoded.affine, expected.affine, atol=1e-4)
+    assert np.array_equal(np.asanyarray(decoded.dataobj), np.asanyarray(expected.dataobj))
+
+
+@pytest.mark.dcmseg2nii
+def test_5_2_check_chunked_decoding(overlapping_dcmseg, tmp_path):
+    from nekton.dcmseg2nii import DcmSeg2Nii
+
+    dcmseg, path_dcms, _, _ = overlapping_dcmseg
+    out_chunked = DcmSeg2Nii(frames_per_chunk=1).run(dcmseg, path_dcms, tmp_path, "chunked")
+    out_whole = DcmSeg2Nii().run(dcmseg, path_dcms, tmp_path, "whole")
+    assert np.array_equal(
+        np.asanyarray(nib.load(out_chunked[0]).dataobj),
+        np.asanyarray(nib.load(out_whole[0]).dataobj),
+    )
+
+
+@pytest.mark.dcmseg2nii
+def test_5_3_check_invalid_inputs(converter_segnii, overlapping_dcmseg):
+    dcmseg, path_dcms, _, _ = overlapping_dcmseg
+
+    # source dicom instead of a dicomseg
+    with pytest.raises(RuntimeError):
+        converter_segnii.run(path_dcms[0], path_dcms)
+
+    # referenced series is missing slices
+    with pytest.raises(RuntimeError):
+        converter_segnii.run(dcmseg, path_dcms[:1])
+
+
+@pytest.mark.dcmseg2nii
+def test_5_4_check_header_cache_and_metainfo(overlapping_dcmseg, tmp_path):
+    from nekton.dcmseg2nii import DcmSeg2Nii
+    from nekton.utils.dicom import DicomHeaderCache
+
+    dcmseg, path_dcms, _, _ = overlapping_dcmseg
+    cache = DicomHeaderCache()
+    converter = DcmSeg2Nii(header_cache=cache)
+    for name in ["first", "second"]:
+        converter.run(dcmseg, path_dcms, tmp_path, name)
+    # the referenced dicoms are read once through the cache
+    assert cache.stats["misses"] == len(path_dcms)
+    assert converter.instrumentation.summary()["counters"]["header_cache_hits"] == len(
+        path_dcms
+    )
+
+    # a missing code tag is left out of the mapping
+    ds = pydicom.dcmread(dcmseg)
+    del ds.SegmentSequence[0].SegmentedPropertyTypeCodeSequence[0].CodeMeaning
+    metainfo = DcmSeg2Nii._dcmqi_metainfo(ds)
+    type_code = metainfo["segmentAttributes"][0][0]["SegmentedPropertyTypeCodeSequence"]
+    assert "CodeMeaning" not in type_code and "CodeValue" in type_code
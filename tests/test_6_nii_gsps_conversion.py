@@ -0,0 +1,104 @@
+import pytest
+import os
+import glob
+import numpy as np
+import pydicom
+from nekton.utils.contours import find_contours, simplify_contour
+
+
+@pytest.mark.nii2gsps
+def test_6_1_check_find_contours():
+    masks = np.zeros((2, 6, 6), dtype=bool)
+    masks[0, 1:3, 1:4] = True
+    # two pixels only touching diagonally are separate contours
+    masks[1, 2, 2] = masks[1, 3, 3] = True
+
+    contours = find_contours(masks)
+    assert sorted(contours) == [0, 1]
+    assert len(contours[0]) == 1
+    assert len(contours[1]) == 2
+
+    # the contour runs along the pixel borders of the 2x3 rectangle
+    corners = simplify_contour(contours[0][0], 0)
+    assert len(corners) == 8
+    assert corners[:, 0].min() == 0.5 and corners[:, 0].max() == 2.5
+    assert corners[:, 1].min() == 0.5 and corners[:, 1].max() == 3.5
+
+    assert find_contours(np.zeros((1, 4, 4))) == {}
+
+    # on a noisy mask every contour is closed and every edge midpoint used once
+    noisy = np.random.RandomState(0).rand(3, 32, 32) < 0.5
+    for contours in find_contours(noisy).values():
+        points = np.concatenate(contours)
+        assert len(np.unique(points, axis=0)) == len(points)
+        for contour in contours:
+            steps = np.hypot(*(np.roll(contour, -1, axis=0) - contour).T)
+            assert np.isin(steps, [np.sqrt(0.5), 1.0]).all()
+
+
+@pytest.mark.nii2gsps
+def test_6_2_check_simplify_contour():
+    rows, cols = np.mgrid[:64, :64]
+    disc = (rows - 32) ** 2 + (cols - 32) ** 2 < 20 ** 2
+    contour = find_contours(disc[None])[0][0]
+
+    coarse = simplify_contour(contour, 1.0)
+    fine = simplify_contour(contour, 0.1)
+    assert len(coarse) < len(fine) < len(contour)
+    # simplified points stay on the contour
+    assert all((contour == point).all(axis=1).any() for point in coarse)
+
+
+@pytest.mark.nii2gsps
+def test_6_3_check_end2end_multiclass_converter(site_package_path, converter_gsps):
+    dir_dcms = os.path.join(
+        site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/*"
+    )
+    path_dcms = [path for path in glob.glob(dir_dcms) if ".json" not in path]
+    path_mapping = "tests/test_data/sample_segmentation/mapping.json"
+    path_seg_nifti = "tests/test_data/sample_segmentation/CT5N_segmentation.nii.gz"
+
+    gsps_files = converter_gsps.multiclass_converter(
+        path_seg_nifti, path_mapping, path_dcms
+    )
+    assert len(gsps_files) == 1
+
+    gsps = pydicom.dcmread(gsps_files[0])
+    assert gsps.Modality == "PR"
+    referenced = {
+        ref.ReferencedSOPInstanceUID
+        for ref in gsps.ReferencedSeriesSequence[0].ReferencedImageSequence
+    }
+    assert referenced == {pydicom.dcmread(path).SOPInstanceUID for path in path_dcms}
+    # one annotation per non-empty slice, all closed polylines in the image
+    assert len(gsps.GraphicAnnotationSequence) == 4
+    for annotation in gsps.GraphicAnnotationSequence:
+        assert annotation.GraphicLayer == "SEGMENT_1"
+        for graphic in annotation.GraphicObjectSequence:
+            points = np.reshape(graphic.GraphicData, (-1, 2))
+            assert graphic.NumberOfGraphicPoints == len(points)
+            assert (points[0] == points[-1]).all()
+            assert points.min() >= 0 and points.max() <= 16
+    os.remove(gsps_files[0])
+
+
+@pytest.mark.nii2gsps
+def test_6_4_check_deduplicate_source_dicoms(tmp_path):
+    import shutil
+    from nekton.benchmarks import make_study
+    from nekton.nii2gsps import Nii2Gsps
+
+    study = make_study(tmp_path, 6, rows=16, cols=16, density="dense")
+    copy = tmp_path / f"copy_{study['dcmfiles'][0].name}"
+    shutil.copy(study["dcmfiles"][0], copy)
+    dcmfiles = [copy] + list(study["dcmfiles"])
+
+    with pytest.raises(AssertionError):
+        Nii2Gsps().multiclass_converter(study["segfile"], study["mapping"], dcmfiles)
+
+    converter = Nii2Gsps(deduplicate="uid")
+    gsps_files = converter.multiclass_converter(
+        study["segfile"], study["mapping"], dcmfiles
+    )
+    assert len(gsps_files) == 1
+    assert converter.duplicates == {study["dcmfiles"][0]: copy}
@@ -0,0 +1,56 @@
+import pytest
+import copy
+import multiprocessing
+import os
+import pydicom
+from nekton.benchmarks import compare_layouts, compare_to_baseline, make_study, run_suite
+from nekton.benchmarks.suite import _IMPORTS, _OPERATIONS, _peak_rss_mb
+
+
+def _spawned_workers_start(timeout: float = 60) -> bool:
+    """the suite runs every case in a spawned interpreter, which has to import nekton"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        try:
+            pool.apply_async(_peak_rss_mb).get(timeout)
+        except Exception:
+            return False
+    return True
+
+
+@pytest.mark.benchmark
+def test_7_1_synthetic_study(tmp_path):
+    study = make_study(tmp_path, 6, rows=16, cols=24, n_series=2, density="sparse")
+    assert len(os.listdir(study["dicom_dir"])) == 12
+    assert len(study["dcmfiles"]) == 6
+    assert os.path.exists(study["segfile"]) and os.path.exists(study["mapping"])
+
+    ds = pydicom.dcmread(study["dcmfiles"][0])
+    assert ds.pixel_array.shape == (16, 24)
+
+
+@pytest.mark.benchmark
+def test_7_2_run_suite_and_compare(tmp_path):
+    # the imports of every operation are resolved before it is timed
+    assert set(_IMPORTS) == set(_OPERATIONS)
+    if not _spawned_workers_start():
+        pytest.skip("spawned workers cannot import nekton")
+    report = run_suite(tmp_path, sizes=[4], rows=16, cols=16)
+    results = report["results"]
+    assert len(results) == 15
+    assert "multiclass_converter[multi-layer-sparse-4]" in results
+    assert "find_contours[noisy-4]" in results
+    for result in results.values():
+        assert result["seconds"] > 0
+        assert result["slices_per_second"] > 0
+        assert result["peak_rss_mb"] > 0
+
+    assert compare_to_baseline(report, report) == []
+    comparisons = compare_layouts(report)
+    assert len(comparisons) == 1
+    assert comparisons[0].startswith("multiclass_converter[both-layouts-dense-4]")
+
+    baseline = copy.deepcopy(report)
+    baseline["results"]["Dcm2Nii.run[single-4]"]["seconds"] /= 10
+    regressions = compare_to_baseline(report, baseline)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("Dcm2Nii.run[single-4]: seconds")
@@ -0,0 +1,235 @@
+import pytest
+import os
+import pydicom
+import shutil
+import threading
+import time
+from nekton.batch import BatchItem, BatchRunner, Manifest
+from nekton.benchmarks import make_study
+from nekton.dcm2nii import Dcm2Nii
+from nekton.scheduler import (
+    Job,
+    ResourceScheduler,
+    dcm2nii_cpus,
+    dcm2nii_job,
+    nii2dcmseg_job,
+    volume_info,
+)
+
+
+@pytest.mark.batch
+def test_8_1_retry_and_resume(tmp_path):
+    calls = []
+
+    def task(value, fail_times=0):
+        calls.append(value)
+        if calls.count(value) <= fail_times:
+            raise ValueError(f"failing {value}")
+        output = tmp_path / f"{value}.out"
+        output.write_text(str(value))
+        return [output]
+
+    manifest = tmp_path / "manifest.jsonl"
+    items = [
+        BatchItem("a", {"value": 1}),
+        BatchItem("b", {"value": 2, "fail_times": 1}),
+        BatchItem("c", {"value": 3, "fail_times": 5}),
+    ]
+    runner = BatchRunner(task, manifest, retries=1, backoff=0)
+    summary = runner.run(items)
+    assert summary["done"] == 2 and summary["failed"] == 1
+    assert summary["failures"] == {"c": "ValueError: failing 3"}
+    assert calls == [1, 2, 2, 3, 3]
+
+    # a restart only retries the failed item
+    summary = BatchRunner(task, manifest, retries=0, backoff=0).run(items)
+    assert summary["skipped"] == 2 and summary["failed"] == 1
+    assert calls[5:] == [3]
+
+    # missing outputs are converted again
+    os.remove(tmp_path / "1.out")
+    summary = BatchRunner(task, manifest, retries=0, backoff=0).run(items[:1])
+    assert summary["done"] == 1
+
+    records = Manifest(manifest).records
+    assert records["a"]["status"] == "done"
+    assert records["a"]["outputs"] == [str(tmp_path / "1.out")]
+    assert records["c"]["status"] == "failed" and records["c"]["attempts"] == 1
+
+    with pytest.raises(ValueError):
+        runner.run([items[0], items[0]])
+
+
+@pytest.mark.batch
+def test_8_2_resume_dcm2nii(site_package_path, tmp_path):
+    study = tmp_path / "CT5N"
+    shutil.copytree(
+        os.path.join(
+            site_package_path, "pydicom/data/test_files/dicomdirtests/98892001/CT5N/"
+        ),
+        study,
+    )
+    manifest = tmp_path / "manifest.jsonl"
+    # the outputs and the sidecars are written next to the dicoms
+    items = [BatchItem("CT5N", {"dicom_directory": study, "name": "study"})]
+
+    summary = BatchRunner(Dcm2Nii().run, manifest).run(items)
+    assert summary["done"] == 1
+
+    summary = BatchRunner(Dcm2Nii().run, manifest).run(items)
+    assert summary["skipped"] == 1 and summary["done"] == 0
+
+    # a modified input is converted again
+    (study / "new_file").write_text("")
+    runner = BatchRunner(Dcm2Nii().run, manifest)
+    summary = runner.run(items)
+    assert summary["done"] == 1
+    assert runner.instrumentation.summary()["spans"]["batch_item"]["count"] == 1
+
+    manifest_lines = len(manifest.read_text().splitlines())
+    Manifest(manifest).compact()
+    assert len(manifest.read_text().splitlines()) == 1 < manifest_lines
+
+
+@pytest.mark.batch
+def test_8_3_scheduler_budgets():
+    lock = threading.Lock()
+    running, peak = [], []
+
+    def task(value):
+        with lock:
+            running.append(value)
+            peak.append(list(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(value)
+        if value == "bad":
+            raise ValueError(value)
+        return [value]
+
+    jobs = [
+        Job("large", task, {"value": "large"}, memory=80),
+        Job("huge", task, {"value": "huge"}, memory=500),
+        Job("small", task, {"value": "small"}, memory=10),
+        Job("medium", task, {"value": "medium"}, memory=40),
+        Job("bad", task, {"value": "bad"}, memory=20),
+    ]
+    scheduler = ResourceScheduler(cpu_budget=4, memory_budget=100, executor="thread")
+    report = scheduler.run(jobs)
+
+    # smallest first, the running jobs never exceed the memory budget
+    assert report["order"] == ["small", "bad", "medium", "large", "huge"]
+    memory = {job.id: job.memory for job in jobs}
+    for concurrent in peak:
+        assert sum(memory[value] for value in concurrent) <= 100 or concurrent == ["huge"]
+    assert ["small", "bad", "medium"] in peak
+    assert report["peak_memory"] == 500 and report["peak_cpus"] == 3
+
+    assert report["outputs"]["small"] == ["small"] and len(report["outputs"]) == 4
+    assert report["failures"] == {"bad": "ValueError: bad"}
+    assert scheduler.instrumentation.summary()["counters"] == {
+        "jobs_done": 4,
+        "jobs_failed": 1,
+    }
+
+    with pytest.raises(ValueError):
+        ResourceScheduler(executor="cluster")
+
+
+@pytest.mark.batch
+def test_8_4_scheduler_mixed_jobs(tmp_path):
+    study = make_study(tmp_path / "study", 4, rows=16, cols=24)
+    info = volume_info(study["dcmfiles"])
+    assert (info.rows, info.cols, info.slices, info.bytes_per_voxel) == (16, 24, 4, 2)
+
+    jobs = [
+        dcm2nii_job("nifti", study["dicom_dir"], tmp_path, name="study"),
+        nii2dcmseg_job(
+            "seg", study["segfile"], study["mapping"], study["dcmfiles"], slab_size=2
+        ),
+        nii2dcmseg_job(
+            "seg-layouts",
+            study["segfile"],
+            study["mapping"],
+            study["dcmfiles"],
+            layouts=["single", "multi"],
+        ),
+    ]
+    assert jobs[2].memory > jobs[1].memory > jobs[0].memory
+
+    report = ResourceScheduler(cpu_budget=2).run(jobs)
+    assert report["failures"] == {}
+    assert len(report["outputs"]["nifti"]) == 1
+    assert len(report["outputs"]["seg"]) > 0
+    layouts = set(path.parent.name for path in report["outputs"]["seg-layouts"])
+    assert layouts == {"single", "multi"}
+    assert report["peak_cpus"] == 2
+
+
+@pytest.mark.batch
+def test_8_5_scheduler_job_cpus(tmp_path, monkeypatch):
+    study = make_study(tmp_path / "study", 4, rows=16, cols=24)
+    compressed = tmp_path / "rle"
+    compressed.mkdir()
+    for path in study["dcmfiles"]:
+        ds = pydicom.dcmread(path)
+        ds.compress(pydicom.uid.RLELossless)
+        ds.save_as(str(compressed / path.name))
+
+    monkeypatch.setattr("nekton.scheduler.os.cpu_count", lambda: 8)
+    assert dcm2nii_cpus(study["dcmfiles"]) == 1
+    assert dcm2nii_cpus(study["dcmfiles"], "native") == 1
+    assert dcm2nii_cpus(study["dcmfiles"], "native", workers=3) == 3
+    rle_files = sorted(compressed.iterdir())
+    assert dcm2nii_cpus(rle_files, "native") == 8
+    assert dcm2nii_cpus(rle_files, "native", workers=2) == 2
+    assert dcm2nii_cpus(rle_files, "native", workers=16) == 8
+
+    # the converter settings are passed on to the job
+    (tmp_path / "out").mkdir()
+    job = dcm2nii_job("rle", compressed, tmp_path / "out", engine="native", workers=2)
+    assert job.cpus == 2
+    monkeypatch.undo()
+    report = ResourceScheduler(cpu_budget=2, executor="thread").run([job])
+    assert report["failures"] == {} and len(report["outputs"]["rle"]) == 1
+
+
+@pytest.mark.batch
+def test_8_6_executor_rounds(tmp_path):
+    rounds = []
+
+    def executor(items, finished):
+        rounds.append([item.id for item in items])
+        for item in reversed(items):
+            if item.inputs["value"] == "bad" or (item.id == "b" and len(rounds) == 1):
+                finished(item, [], f"ValueError: {item.id}")
+            else:
+                output = tmp_path / f"{item.id}.out"
+                output.write_text(item.id)
+                finished(item, [output], None)
+
+    items = [
+        BatchItem("a", {"value": "good"}),
+        BatchItem("b", {"value": "flaky"}),
+        BatchItem("c", {"value": "bad"}),
+    ]
+    manifest = tmp_path / "manifest.jsonl"
+    summary = BatchRunner(None, manifest, retries=2, backoff=0, executor=executor).run(
+        items
+    )
+    # the failed items are retried together in the next round
+    assert rounds == [["a", "b", "c"], ["b", "c"], ["c"]]
+    assert summary["items"] == {"a": "done", "b": "done", "c": "failed"}
+    assert summary["failures"] == {"c": "ValueError: c"}
+    records = Manifest(manifest).records
+    assert records["b"]["attempts"] == 2 and records["c"]["attempts"] == 3
+
+    # a restart skips the converted items, without a manifest file too
+    rounds.clear()
+    summary = BatchRunner(None, manifest, retries=0, executor=executor).run(items)
+    assert rounds == [["c"]] and summary["skipped"] == 2
+    summary = BatchRunner(None, None, retries=0, executor=executor).run(items)
+    assert summary["done"] == 2 and summary["failed"] == 1
+
+    with pytest.raises(ValueError):
+        BatchRunner(None, manifest)
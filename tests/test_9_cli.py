@@ -0,0 +1,142 @@
+import pytest
+import json
+import os
+import subprocess
+import sys
+from nekton.benchmarks import make_study
+from nekton.cli import expand_inputs, main
+
+
+@pytest.fixture
+def studies(tmp_path):
+    yield [
+        make_study(tmp_path / "studies" / f"study_{i}", 4, rows=16, cols=16)
+        for i in range(2)
+    ]
+
+
+@pytest.mark.cli
+def test_9_1_dcm2nii_glob_json(studies, tmp_path, capsys):
+    state = tmp_path / "state.jsonl"
+    argv = [
+        "dcm2nii",
+        str(tmp_path / "studies" / "*" / "dicom"),
+        "--out-dir",
+        str(tmp_path / "nifti"),
+        "--engine",
+        "native",
+        "--compression",
+        "none",
+        "--workers",
+        "2",
+        "--state",
+        str(state),
+        "--profile",
+        "--json",
+    ]
+    assert main(argv) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["command"] == "dcm2nii"
+    assert report["summary"]["done"] == 2 and report["summary"]["failed"] == 0
+    for item in report["items"]:
+        assert len(item["outputs"]) == 1 and item["outputs"][0].endswith(".nii")
+        assert os.path.exists(item["outputs"][0])
+    assert report["profile"]["spans"]["native"]["count"] == 2
+
+    # a rerun skips the converted studies
+    assert main(argv) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["summary"]["skipped"] == 2 and report["summary"]["done"] == 0
+
+
+@pytest.mark.cli
+def test_9_2_nii2seg_manifest(studies, tmp_path, capsys):
+    manifest = tmp_path / "inputs.txt"
+    lines = [
+        json.dumps(
+            {
+                "segfile": str(study["segfile"]),
+                "dicom_dir": str(study["dicom_dir"]),
+                "mapping": str(study["mapping"]),
+            }
+        )
+        for study in studies
+    ]
+    manifest.write_text("# segmentations\n" + "\n".join(lines) + "\n")
+    assert len(expand_inputs([], manifest)) == 2
+
+    argv = ["nii2seg", "--manifest", str(manifest), "--layouts", "single", "multi"]
+    assert main(argv + ["--workers", "1", "--profile"]) == 0
+    out = capsys.readouterr().out
+    assert "2 done, 0 skipped, 0 failed" in out
+    assert "encode" in out and "assemble" in out
+    for study in studies:
+        folder = os.path.join(os.path.dirname(study["segfile"]), "dicomseg")
+        assert sorted(os.listdir(folder)) == ["multi", "single"]
+
+    # a failing input sets the exit status
+    bad = tmp_path / "bad.nii.gz"
+    bad.write_text("")
+    argv = ["nii2seg", str(bad), "--dicom-dir", str(studies[0]["dicom_dir"])]
+    assert main(argv + ["--mapping", str(studies[0]["mapping"]), "--json"]) == 1
+    assert json.loads(capsys.readouterr().out)["summary"]["failed"] == 1
+
+    with pytest.raises(SystemExit):
+        main(["nii2seg", str(tmp_path / "missing*.nii.gz")])
+
+
+@pytest.mark.cli
+def test_9_3_module_entry_point():
+    result = subprocess.run(
+        [sys.executable, "-m", "nekton", "--version"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0 and result.stdout.startswith("nekton ")
+
+
+@pytest.mark.cli
+def test_9_4_discovery_in_jobs_and_defaults(studies, tmp_path, capsys, monkeypatch):
+    from nekton import cli
+    from nekton.batch import retry_delay
+    from nekton.dcm2nii import Dcm2Nii
+    from nekton.nii2dcm import Nii2DcmSeg
+
+    study = studies[0]
+    cache_dir = tmp_path / "cache"
+    argv = [
+        "nii2seg",
+        str(study["segfile"]),
+        "--dicom-dir",
+        str(study["dicom_dir"]),
+        "--mapping",
+        str(study["mapping"]),
+        "--cache-dir",
+        str(cache_dir),
+        "--workers",
+        "1",
+        "--json",
+    ]
+    # the parent does not parse the dicoms, the job does
+    monkeypatch.setattr(
+        Dcm2Nii, "get_all_dicoms", staticmethod(lambda *args: pytest.fail("discovery"))
+    )
+    jobs, _ = cli._nii2seg_jobs(cli.build_parser().parse_args(argv), [{"path": "x"}])
+    assert jobs[0].inputs["dcmfiles"] == study["dicom_dir"]
+    assert jobs[0].inputs["slab_size"] is None and jobs[0].inputs["layouts"] is None
+    monkeypatch.undo()
+
+    # like the library default, a single layer dicomseg per slice with labels
+    assert main(argv) == 0
+    report = json.loads(capsys.readouterr().out)
+    expected = Nii2DcmSeg().multiclass_converter(
+        study["segfile"], study["mapping"], sorted(study["dcmfiles"])
+    )
+    assert sorted(report["items"][0]["outputs"]) == sorted(map(str, expected))
+    # the dicoms found are remembered in the cache directory
+    assert len(list(cache_dir.glob("dicoms_*.json"))) == 1
+    assert Dcm2Nii.get_all_dicoms(study["dicom_dir"], cache_dir) == sorted(
+        study["dcmfiles"]
+    )
+
+    assert [retry_delay(attempt, 1.0, 3.0) for attempt in [1, 2, 3]] == [1.0, 2.0, 3.0]